@@ -1,6 +1,7 @@
 import httpx
 import os
 import logging
+import re
 from pathlib import Path
 from dotenv import load_dotenv
 from typing import Any, Dict, List, Optional
@@ -18,6 +19,9 @@ load_dotenv(dotenv_path=dotenv_path)
 
 
 BASE_URL_SALESFORCE_API = os.environ.get("SALESFORCE_API_URL") # Carga desde variable de entorno
+# Normalización de teléfonos (mismas variables y regla que salesforce-api y twilio-api).
+PHONE_DEFAULT_COUNTRY_CODE = os.environ.get("PHONE_DEFAULT_COUNTRY_CODE", "1")
+PHONE_NATIONAL_DIGITS = int(os.environ.get("PHONE_NATIONAL_DIGITS", 10))
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +40,43 @@ def _get_auth_token(audience: str) -> str:
         logger.error(f"No se pudo obtener el token de autenticación para la audiencia {audience}: {e}")
         raise
 
+def _phone_key(phone: Optional[str]) -> Optional[str]:
+    """
+    Clave E.164 sin '+' del teléfono, igual que `phone_index_key` de
+    salesforce-api: '555-123-4567' y '+1 (555) 123-4567' -> '15551234567'.
+    """
+    if not phone:
+        return None
+    raw = str(phone).strip()
+    digits = re.sub(r'\D', '', raw)
+    if not raw.startswith('+'):
+        if digits.startswith('00'):
+            digits = digits[2:]
+        elif len(digits) == PHONE_NATIONAL_DIGITS:
+            digits = PHONE_DEFAULT_COUNTRY_CODE + digits
+    return digits if 7 <= len(digits) <= 15 else None
+
+def _find_caller_id_contact(tool_context: ToolContext, full_name: str, dob: Optional[str] = None, phone: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Busca entre los contactos precargados por el identificador de llamada
+    (State.Case.CALLER_ID_CONTACTS) uno que coincida con el nombre y, si se
+    indican, con la fecha de nacimiento y el teléfono. Devuelve None si no hay
+    coincidencia, en cuyo caso se debe consultar a Salesforce como siempre.
+    """
+    candidates = tool_context.state.get(State.Case.CALLER_ID_CONTACTS) or []
+    wanted_name = " ".join(full_name.lower().split())
+    wanted_phone = _phone_key(phone) if phone else None
+    for contact in candidates:
+        name = " ".join(f"{contact.get('FirstName') or ''} {contact.get('LastName') or ''}".lower().split())
+        if name != wanted_name:
+            continue
+        if dob and contact.get("DOB__c") != dob:
+            continue
+        if phone and (not wanted_phone or wanted_phone not in {_phone_key(contact.get(field)) for field in ("Phone", "MobilePhone")}):
+            continue
+        return contact
+    return None
+
 def find_contact_by_name(full_name: str, tool_context: ToolContext) -> Dict[str, Any]:
     """
     Busca un contacto en la API de Salesforce por su nombre completo.
@@ -50,6 +91,13 @@ def find_contact_by_name(full_name: str, tool_context: ToolContext) -> Dict[str,
         tool_context.state[State.Case.CLIENT_FOUND] = False
         return {"status": "error", "message": message}
 
+    contact = _find_caller_id_contact(tool_context, full_name)
+    if contact:
+        logger.info(f"Contacto '{full_name}' encontrado entre los precargados por el teléfono del llamante: {contact.get('Id')}")
+        tool_context.state[State.Case.CLIENT_FOUND] = True
+        tool_context.state[State.Account.ID] = contact.get("AccountId")
+        return {"status": "success", "found": True, "contact_id": contact.get("Id"), "account_id": contact.get("AccountId")}
+
     logger.info(f"Intentando encontrar contacto con el nombre: {full_name}")
     try:
         auth_token = _get_auth_token(BASE_URL_SALESFORCE_API)
@@ -67,7 +115,19 @@ def find_contact_by_name(full_name: str, tool_context: ToolContext) -> Dict[str,
             if response.status_code == 404:
                 logger.info(f"Contacto no encontrado para: {full_name} (API devolvió 404).")
                 tool_context.state[State.Case.CLIENT_FOUND] = False
-                return {"status": "success", "found": False, "message": f"Contacto con nombre '{full_name}' no encontrado."}
+                # No debe quedar en el estado la cuenta de una búsqueda anterior.
+                tool_context.state[State.Account.ID] = None
+                result = {"status": "success", "found": False, "message": f"Contacto con nombre '{full_name}' no encontrado."}
+                # La API incluye nombres parecidos (acentos, apellido faltante, orden) para
+                # confirmarlos con el cliente en lugar de volver a pedirle el nombre.
+                try:
+                    similar_names = response.json().get("similar_names", [])
+                except ValueError:
+                    similar_names = []
+                if similar_names:
+                    result["similar_names"] = similar_names
+                    result["message"] += " Hay contactos con nombres parecidos; confirma con el cliente si alguno es el suyo."
+                return result
 
             response.raise_for_status()  # Lanza una excepción para otros errores (e.g., 5xx)
             data = response.json()
@@ -85,6 +145,7 @@ def find_contact_by_name(full_name: str, tool_context: ToolContext) -> Dict[str,
             elif data.get("status") == "not_found":
                 logger.info(f"Contacto no encontrado para: {full_name}")
                 tool_context.state[State.Case.CLIENT_FOUND] = False
+                tool_context.state[State.Account.ID] = None
                 return {"status": "success", "found": False, "message": data.get("message")}
 
             else:  # Maneja otros estados de la API como 'error'
@@ -139,8 +200,15 @@ def create_contact(full_name: str, tool_context: ToolContext) -> Dict[str, Any]:
                 # Guardar el AccountId, no el ContactId, en el estado de la cuenta.
                 if account_id:
                     tool_context.state[State.Account.ID] = account_id
+                    tool_context.state[State.Account.PENDING_CONTACT_ID] = None
                     # Un cliente recién creado se considera "verificado" para poder continuar con el flujo.
                     tool_context.state[State.Case.CLIENT_VERIFIED] = True
+                elif data.get("account_association", {}).get("status") == "pending":
+                    # La API asocia la cuenta en segundo plano; se resuelve antes de crear el servicio al cliente.
+                    # Se descarta cualquier cuenta previa para que no se use en lugar de la del nuevo contacto.
+                    tool_context.state[State.Account.ID] = None
+                    tool_context.state[State.Account.PENDING_CONTACT_ID] = contact_id
+                    tool_context.state[State.Case.CLIENT_VERIFIED] = True
                 return {"status": "success", "created": True, "contact_id": contact_id, "account_id": account_id, "contact_data": contact}
             else:
                 error_message = data.get("message", "Error desconocido de la API al crear contacto.")
@@ -176,6 +244,13 @@ def verify_contact_by_dob(full_name: str, dob: str, tool_context: ToolContext) -
         f"Intentando verificar contacto: {full_name} con DOB: {dob}. Intento #{attempts + 1}"
     )
 
+    contact = _find_caller_id_contact(tool_context, full_name, dob=dob)
+    if contact:
+        logger.info(f"Verificación exitosa con el contacto precargado por el teléfono del llamante: {contact.get('Id')}")
+        tool_context.state[State.Case.CLIENT_VERIFIED] = True
+        tool_context.state[State.Account.ID] = contact.get("AccountId")
+        return {"status": "success", "verified": True, "contact_id": contact.get("Id")}
+
     try:
         auth_token = _get_auth_token(BASE_URL_SALESFORCE_API)
         headers = {"Authorization": f"Bearer {auth_token}"}
@@ -236,6 +311,13 @@ def verify_contact_by_dob_phone(full_name: str, dob: str, phone: str, tool_conte
         f"Intentando verificar contacto: {full_name} con DOB: {dob} y Teléfono: {phone}. Intento #{attempts + 1}"
     )
 
+    contact = _find_caller_id_contact(tool_context, full_name, dob=dob, phone=phone)
+    if contact:
+        logger.info(f"Verificación por teléfono exitosa con el contacto precargado: {contact.get('Id')}")
+        tool_context.state[State.Case.CLIENT_VERIFIED] = True
+        tool_context.state[State.Account.ID] = contact.get("AccountId")
+        return {"status": "success", "verified": True, "contact_id": contact.get("Id")}
+
     try:
         auth_token = _get_auth_token(BASE_URL_SALESFORCE_API)
         headers = {"Authorization": f"Bearer {auth_token}"}
@@ -277,6 +359,41 @@ def verify_contact_by_dob_phone(full_name: str, dob: str, phone: str, tool_conte
         tool_context.state[State.Case.CLIENT_VERIFIED] = False
         return {"status": "error", "message": message}
 
+def _resolve_pending_account_id(tool_context: ToolContext) -> Optional[str]:
+    """
+    Obtiene el AccountId de un contacto recién creado cuya cuenta la API asocia en
+    segundo plano. Devuelve None si no hay asociación pendiente o no terminó a tiempo.
+    """
+    contact_id = tool_context.state.get(State.Account.PENDING_CONTACT_ID)
+    if not contact_id:
+        return None
+
+    try:
+        auth_token = _get_auth_token(BASE_URL_SALESFORCE_API)
+        headers = {"Authorization": f"Bearer {auth_token}"}
+
+        with httpx.Client() as client:
+            # La API espera hasta 'wait' segundos a que termine la asociación.
+            response = client.get(
+                f"{BASE_URL_SALESFORCE_API}/contact/{contact_id}/account",
+                params={"wait": 8},
+                headers=headers,
+                timeout=12.0
+            )
+            data = response.json()
+    except Exception as e:
+        logger.error(f"Error al consultar la cuenta del contacto {contact_id}: {e}")
+        return None
+
+    account_id = data.get("account_id") if data.get("status") == "associated" else None
+    if account_id:
+        logger.info(f"Cuenta {account_id} asociada al contacto {contact_id}.")
+        tool_context.state[State.Account.ID] = account_id
+        tool_context.state[State.Account.PENDING_CONTACT_ID] = None
+    else:
+        logger.warning(f"La cuenta del contacto {contact_id} aún no está asociada (estado: {data.get('status')}).")
+    return account_id
+
 def create_customer_service(
     call_type: str,
     relationship: str,
@@ -290,8 +407,15 @@ def create_customer_service(
     """
     Crea un nuevo registro de servicio al cliente (Customer_Service__c) en Salesforce.
     Esta herramienta debe usarse después de que el cliente ha sido verificado y se necesita registrar la interacción.
+    Si la API acepta el registro para envío diferido, devuelve status "pending" con su tracking_key:
+    la solicitud quedó registrada, pero aún no tiene Id en Salesforce.
     """
-    account_id = tool_context.state.get(State.Account.ID)
+    # Con un contacto recién creado pendiente de asociar, la cuenta es la suya y no
+    # la que hubiera en el estado.
+    if tool_context.state.get(State.Account.PENDING_CONTACT_ID):
+        account_id = _resolve_pending_account_id(tool_context)
+    else:
+        account_id = tool_context.state.get(State.Account.ID)
     if not account_id:
         message = "No se encontró un 'AccountId' en el estado. No se puede crear el servicio al cliente."
         logger.error(message)
@@ -328,6 +452,11 @@ def create_customer_service(
                 service_id = service_record.get("Id")
                 logger.info(f"Registro de servicio al cliente creado exitosamente con ID: {service_id}")
                 return {"status": "success", "created": True, "service_id": service_id, "service_data": service_record}
+            elif data.get("status") == "accepted":
+                # La API lo enviará a Salesforce en segundo plano; el Id no es necesario para la conversación.
+                tracking_key = data.get("tracking_key")
+                logger.info(f"Registro de servicio al cliente aceptado para envío diferido: {tracking_key}")
+                return {"status": "pending", "created": False, "queued": True, "tracking_key": tracking_key, "service_data": data.get("customer_service", {})}
             else:
                 error_message = data.get("message", "Error desconocido de la API al crear el servicio.")
                 logger.error(f"La API devolvió un error lógico al crear el servicio: {error_message}")
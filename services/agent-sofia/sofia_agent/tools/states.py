@@ -30,6 +30,7 @@ class State:
 
     class Account:
         ID = "account_id"
+        PENDING_CONTACT_ID = "account_pending_contact_id" # Contacto recién creado cuya cuenta la API aún está asociando en segundo plano
 
     class Case:
         CLIENT_FOUND = "case_client_found"
@@ -38,6 +39,7 @@ class State:
         CLIENT_VERIFICATION_ATTEMPTED = "case_client_verification_attempted"
         CLIENT_VERIFICATION_ATTEMPTS = "case_client_verification_attempts"
         CUSTOMER_SERVICE_CREATED = "case_customer_service_created"
+        CALLER_ID_CONTACTS = "case_caller_id_contacts" # Contactos cuyo teléfono coincide con el del llamante, precargados por twilio-api al iniciar la llamada
     
     class Customer_Service:
         CALL_TYPE = "customer_service_call_type" # Esto se llena si la llamada la hicimos nosotros o la realizo el cliente a nosotros
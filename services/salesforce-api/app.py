@@ -1,5 +1,8 @@
 from simple_salesforce import Salesforce, SalesforceAuthenticationFailed, SalesforceGeneralError
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import os
 import time
 import datetime
@@ -7,6 +10,16 @@ import sys
 import threading
 import re
 import logging
+import queue
+import json
+import hashlib
+import uuid
+import fcntl
+from collections import OrderedDict
+from urllib.parse import quote_plus
+from name_index import NameIndex, fold_name
+from contact_mirror import ContactMirror, ContactMirrorSync
+from sobject_metadata import compile_validator, default_validator
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -41,53 +54,773 @@ if missing_secrets:
 
 logging.info("Todas las credenciales de Salesforce se han cargado correctamente desde las variables de entorno.")
 
-# --- Inicialización de Flask y Conexión Singleton a Salesforce ---
+# --- Configuración de la Conexión ---
+# Pool de conexiones HTTP hacia Salesforce, dimensionado para los hilos de gunicorn (THREADS).
+GUNICORN_THREADS = int(os.environ.get("THREADS", 8))
+GUNICORN_WORKERS = int(os.environ.get("WORKERS", 4))
+SF_HTTP_POOL_SIZE = int(os.environ.get("SF_HTTP_POOL_SIZE", GUNICORN_THREADS))
+# Edad máxima del token antes de renovarlo de forma proactiva. Debe ser menor que
+# el tiempo de expiración de sesión de la organización (2 horas por defecto).
+SF_SESSION_REFRESH_SECONDS = float(os.environ.get("SF_SESSION_REFRESH_SECONDS", 90 * 60))
+# Espera antes de reintentar una renovación proactiva que falló.
+SF_LOGIN_RETRY_SECONDS = float(os.environ.get("SF_LOGIN_RETRY_SECONDS", 30))
+
+# --- Configuración de la Caché de Contactos ---
+# Resultados de búsqueda y verificación por nombre (y nombre + DOB). Los "no
+# encontrado" se guardan con un TTL menor. Backends:
+#   "memory": LRU por proceso (cada worker de gunicorn tiene la suya). La
+#             invalidación de `/contact/create` solo llega al worker que creó el
+#             contacto, así que con más de un worker (WORKERS) no se guardan los
+#             "no encontrado": otro worker seguiría respondiendo que no existe.
+#   "file":   un archivo por nombre en CONTACT_CACHE_DIR, compartido por los
+#             workers que usen ese directorio; la invalidación es visible para
+#             todos ellos. Con el valor por defecto (/tmp) es local a cada
+#             instancia de Cloud Run: otras instancias no ven la invalidación.
+#   "off":    sin caché.
+CONTACT_CACHE_BACKEND = os.environ.get("CONTACT_CACHE_BACKEND", "memory").lower()
+CONTACT_CACHE_SIZE = int(os.environ.get("CONTACT_CACHE_SIZE", 5000))
+CONTACT_CACHE_TTL = float(os.environ.get("CONTACT_CACHE_TTL", 300))
+CONTACT_CACHE_NEGATIVE_TTL = float(os.environ.get("CONTACT_CACHE_NEGATIVE_TTL", 30))
+CONTACT_CACHE_DIR = os.environ.get("CONTACT_CACHE_DIR", "/tmp/sofia-contact-cache")
+
+# --- Configuración del Índice de Teléfonos ---
+# Los teléfonos se comparan por su clave E.164 (solo dígitos, con código de país).
+# Un número nacional de PHONE_NATIONAL_DIGITS dígitos recibe PHONE_DEFAULT_COUNTRY_CODE.
+PHONE_DEFAULT_COUNTRY_CODE = os.environ.get("PHONE_DEFAULT_COUNTRY_CODE", "1")
+PHONE_NATIONAL_DIGITS = int(os.environ.get("PHONE_NATIONAL_DIGITS", 10))
+# Campo de texto del Contacto con la clave E.164, marcado como External ID para que
+# Salesforce lo indexe (p. ej. "Phone_Key__c"). Esta API lo llena al crear contactos;
+# las ediciones hechas en Salesforce deben mantenerlo con un Flow. Si está vacío,
+# se usa el índice de búsqueda de SOSL (IN PHONE FIELDS).
+PHONE_INDEX_FIELD = os.environ.get("PHONE_INDEX_FIELD", "")
+
+if PHONE_INDEX_FIELD and not re.fullmatch(r'\w+', PHONE_INDEX_FIELD):
+    logging.critical(f"Error crítico: PHONE_INDEX_FIELD '{PHONE_INDEX_FIELD}' no es un nombre de campo válido.")
+    sys.exit(1)
+
+# --- Configuración del Índice Local de Nombres ---
+# Índice en memoria de todos los contactos (nombre sin acentos, en cualquier orden)
+# para /contact/search. Cada worker carga el suyo al recibir la primera búsqueda
+# y lo recarga cada NAME_INDEX_REFRESH_SECONDS; mientras no está listo se usa SOSL.
+NAME_INDEX_ENABLED = os.environ.get("NAME_INDEX_ENABLED", "false").lower() == "true"
+NAME_INDEX_REFRESH_SECONDS = float(os.environ.get("NAME_INDEX_REFRESH_SECONDS", 15 * 60))
+NAME_INDEX_MIN_SCORE = float(os.environ.get("NAME_INDEX_MIN_SCORE", 0.5))
+NAME_SEARCH_MAX_RESULTS = int(os.environ.get("NAME_SEARCH_MAX_RESULTS", 10))
+# Nombres parecidos que /contact/find incluye en su 404 ("similar_names"). Solo se
+# calculan con el índice ya cargado, sin consultar a Salesforce; 0 los desactiva.
+NAME_FIND_SUGGESTIONS = int(os.environ.get("NAME_FIND_SUGGESTIONS", 3))
+
+# --- Configuración de la Réplica Local de Contactos ---
+# Copia en memoria de los campos de Contact que lee esta API, cargada con una
+# consulta completa y actualizada cada CONTACT_MIRROR_SYNC_SECONDS con Get
+# Updated / Get Deleted. /contact/find y las verificaciones responden desde ella
+# mientras su última sincronización no supere CONTACT_MIRROR_MAX_STALENESS.
+CONTACT_MIRROR_ENABLED = os.environ.get("CONTACT_MIRROR_ENABLED", "false").lower() == "true"
+CONTACT_MIRROR_SYNC_SECONDS = float(os.environ.get("CONTACT_MIRROR_SYNC_SECONDS", 60))
+CONTACT_MIRROR_MAX_STALENESS = float(os.environ.get("CONTACT_MIRROR_MAX_STALENESS", 5 * 60))
+# Instantánea en disco compartida por los workers: solo uno hace la carga completa
+# (consulta de todos los contactos) y los demás esperan y cargan el archivo; un
+# worker nuevo parte de ella. Con CONTACT_MIRROR_SNAPSHOT_PATH vacío cada worker
+# de gunicorn hace su propia carga completa al arrancar (WORKERS consultas de
+# todos los contactos a la vez, y el mismo costo en cada reinicio de worker).
+CONTACT_MIRROR_SNAPSHOT_PATH = os.environ.get("CONTACT_MIRROR_SNAPSHOT_PATH", "/tmp/sofia-contact-mirror.json")
+# Si es "true", un nombre ausente de la réplica se responde como "no encontrado"
+# sin consultar a Salesforce (un contacto creado hace menos de un ciclo no aparecería).
+CONTACT_MIRROR_TRUST_MISSES = os.environ.get("CONTACT_MIRROR_TRUST_MISSES", "false").lower() == "true"
+
+# --- Configuración de Escritura Diferida (Write-Behind) ---
+# Con WRITE_BEHIND_ENABLED=true, /customer_service/create y /script_case validan,
+# guardan el registro en disco y responden 202 con una clave de seguimiento; un
+# hilo los envía con la API sObject Collections en lotes de hasta
+# WRITE_BEHIND_BATCH_SIZE (máx. 200) o cada WRITE_BEHIND_FLUSH_SECONDS.
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_BATCH_SIZE = min(int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 200)), 200)
+WRITE_BEHIND_FLUSH_SECONDS = float(os.environ.get("WRITE_BEHIND_FLUSH_SECONDS", 2))
+# Directorio del diario; debe ser compartido por los workers (y persistente si se
+# quiere sobrevivir a un reinicio del contenedor). En Cloud Run /tmp es memoria de
+# la instancia y NO es durable: si la instancia se detiene (reducción de escala,
+# despliegue) con registros pendientes, esos registros ya respondidos con 202 se
+# pierden. Para no perderlos hace falta un volumen persistente con soporte de
+# flock (p. ej. NFS/Filestore) o dejar WRITE_BEHIND_ENABLED=false.
+WRITE_BEHIND_DIR = os.environ.get("WRITE_BEHIND_DIR", "/tmp/sofia-write-behind")
+# Máximo de registros pendientes por worker; con el buffer lleno la petición se
+# crea en línea (como sin escritura diferida) en lugar de acumular más.
+WRITE_BEHIND_MAX_BUFFERED = int(os.environ.get("WRITE_BEHIND_MAX_BUFFERED", 5000))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", 8))
+# Reintentos con espera exponencial: RETRY, 2x, 4x, ... hasta 5 minutos.
+WRITE_BEHIND_RETRY_SECONDS = float(os.environ.get("WRITE_BEHIND_RETRY_SECONDS", 5))
+# Tiempo que se conserva el resultado de un registro enviado para consultas de estado.
+WRITE_BEHIND_RESULT_TTL = float(os.environ.get("WRITE_BEHIND_RESULT_TTL", 24 * 3600))
+
+# --- Configuración de Metadatos de sObjects ---
+# Los valores de picklist y los campos requeridos de Customer_Service__c y
+# Script_Case__c se leen con describe() y se refrescan cada SOBJECT_METADATA_TTL
+# segundos. Con SOBJECT_METADATA_ENABLED=false se usan los valores fijos del código.
+SOBJECT_METADATA_ENABLED = os.environ.get("SOBJECT_METADATA_ENABLED", "true").lower() == "true"
+SOBJECT_METADATA_TTL = float(os.environ.get("SOBJECT_METADATA_TTL", 3600))
+# Si describe falla, se reintenta antes de que venza el TTL.
+SOBJECT_METADATA_RETRY_SECONDS = float(os.environ.get("SOBJECT_METADATA_RETRY_SECONDS", 60))
+
+# --- Configuración de Búsqueda por Lotes ---
+# Máximo de nombres por petición a /contact/find/batch.
+CONTACT_BATCH_MAX_ITEMS = int(os.environ.get("CONTACT_BATCH_MAX_ITEMS", 2000))
+# simple_salesforce envía la SOQL en la URL (GET /query?q=...) y Salesforce limita
+# la URI a ~16.000 caracteres; cada consulta IN se corta por debajo de este largo codificado.
+SOQL_MAX_URL_CHARS = int(os.environ.get("SOQL_MAX_URL_CHARS", 12000))
+
+# --- Configuración de Creación de Contactos ---
+# "sequential": una petición por paso (create, query, update). Valor por defecto.
+# "composite": crea el contacto, busca la cuenta del Flow y la asocia en una sola
+#              petición a la Composite API (opcional).
+CONTACT_CREATE_MODE = os.environ.get("CONTACT_CREATE_MODE", "sequential").lower()
+# Si la cuenta del Flow aún no existe, se vuelve a buscar con espera exponencial
+# (INITIAL, 2x, 4x, ... hasta MAX) sin superar ACCOUNT_POLL_TIMEOUT en total.
+ACCOUNT_POLL_INITIAL_DELAY = float(os.environ.get("ACCOUNT_POLL_INITIAL_DELAY", 0.25))
+ACCOUNT_POLL_MAX_DELAY = float(os.environ.get("ACCOUNT_POLL_MAX_DELAY", 2))
+ACCOUNT_POLL_TIMEOUT = float(os.environ.get("ACCOUNT_POLL_TIMEOUT", 8))
+
+# "sync": /contact/create espera a la cuenta del Flow antes de responder.
+# "async": responde en cuanto existe el contacto y la asociación se completa en
+#          segundo plano; el estado se consulta en GET /contact/<id>/account.
+CONTACT_ACCOUNT_ASSOCIATION = os.environ.get("CONTACT_ACCOUNT_ASSOCIATION", "sync").lower()
+ACCOUNT_ASSOCIATION_WORKERS = int(os.environ.get("ACCOUNT_ASSOCIATION_WORKERS", 2))
+ACCOUNT_ASSOCIATION_QUEUE_SIZE = int(os.environ.get("ACCOUNT_ASSOCIATION_QUEUE_SIZE", 500))
+# Trabajos terminados que se conservan para responder consultas de estado.
+ACCOUNT_ASSOCIATION_HISTORY = int(os.environ.get("ACCOUNT_ASSOCIATION_HISTORY", 2000))
+# Espera máxima que un cliente puede pedir en GET /contact/<id>/account?wait=<segundos>.
+ACCOUNT_STATUS_MAX_WAIT = float(os.environ.get("ACCOUNT_STATUS_MAX_WAIT", 10))
+
+if CONTACT_ACCOUNT_ASSOCIATION not in ("sync", "async"):
+    logging.critical(f"Error crítico: CONTACT_ACCOUNT_ASSOCIATION '{CONTACT_ACCOUNT_ASSOCIATION}' no es válido. Opciones: sync, async")
+    sys.exit(1)
+
+if CONTACT_CREATE_MODE not in ("composite", "sequential"):
+    logging.critical(f"Error crítico: CONTACT_CREATE_MODE '{CONTACT_CREATE_MODE}' no es válido. Opciones: composite, sequential")
+    sys.exit(1)
+
+# --- Inicialización de Flask ---
 app = Flask(__name__)
-sf_connection = None
 
-# -- Crea la coneccion con salesforce
-def get_salesforce_connection():
+# --- Estadísticas de Ejecución ---
+class RuntimeStats:
     """
-    Establece y gestiona una conexión singleton con Salesforce.
+    Contadores, tiempos acumulados y gauges en memoria del proceso.
 
-    Esta función implementa el patrón singleton para la conexión a Salesforce,
-    asegurando que solo se cree una instancia de conexión durante el ciclo de
-    vida de la aplicación. Esto mejora el rendimiento al reutilizar la
-    conexión existente en lugar de crear una nueva para cada solicitud.
+    Cada worker de gunicorn mantiene sus propias estadísticas. Los gauges se
+    registran como funciones que se evalúan al momento de tomar la instantánea.
+    """
 
-    La configuración de la conexión (usuario, clave de consumidor, archivo de
-    clave privada y dominio) se obtiene de las variables de entorno.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def incr(self, name: str, amount: float = 1):
+        """Incrementa el contador `name` en `amount`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        """Registra una duración en segundos (cantidad, suma y máximo)."""
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def snapshot_counters(self) -> dict:
+        """Devuelve una copia de los contadores del proceso."""
+        with self._lock:
+            return dict(self._counters)
+
+    def register_gauge(self, name: str, func):
+        """Registra una función sin argumentos cuyo valor se reporta como gauge."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """Devuelve una copia de todas las estadísticas del proceso."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {
+                name: {**values, "avg": values["sum"] / values["count"] if values["count"] else 0.0}
+                for name, values in self._timings.items()
+            }
+            gauges = dict(self._gauges)
+        return {
+            "pid": os.getpid(),
+            "counters": counters,
+            "timings": timings,
+            "gauges": {name: func() for name, func in gauges.items()},
+        }
+
+stats = RuntimeStats()
+
+# --- Pool de Conexiones HTTP hacia Salesforce ---
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.incr("salesforce_http.connections_opened")
+        return super()._new_conn()
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.incr("salesforce_http.connections_opened")
+        return super()._new_conn()
+
+class SalesforceHTTPAdapter(HTTPAdapter):
+    """
+    Adaptador de `requests` que cuenta las peticiones enviadas y las conexiones
+    TCP/TLS abiertas, para medir cuántas peticiones reutilizan una conexión viva.
+    """
 
-    Returns:
-        simple_salesforce.Salesforce: La instancia de conexión a Salesforce.
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        stats.incr("salesforce_http.requests")
+        return super().send(request, **kwargs)
+
+def _salesforce_connection_reuse_ratio() -> float:
+    counters = stats.snapshot_counters()
+    sent = counters.get("salesforce_http.requests", 0)
+    if not sent:
+        return 0.0
+    return 1 - counters.get("salesforce_http.connections_opened", 0) / sent
+
+def build_salesforce_http_session() -> requests.Session:
+    """
+    Crea la sesión HTTP compartida por todas las llamadas a Salesforce.
 
-    Raises:
-        SalesforceAuthenticationFailed: Si las credenciales son incorrectas.
-        SalesforceGeneralError: Si ocurre un error general al conectar con la API.
-        Exception: Para cualquier otro error inesperado durante la conexión.
+    El pool mantiene hasta SF_HTTP_POOL_SIZE conexiones keep-alive por host (la
+    instancia de la organización y el endpoint de login); con `pool_block=True`
+    los hilos esperan una conexión libre en lugar de abrir conexiones extra.
+    """
+    session = requests.Session()
+    adapter = SalesforceHTTPAdapter(pool_connections=2, pool_maxsize=SF_HTTP_POOL_SIZE, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# --- Conexión a Salesforce con Renovación del Token ---
+class ManagedSalesforce(Salesforce):
+    """
+    Conexión de simple_salesforce cuya renovación ante INVALID_SESSION_ID pasa
+    por el `SalesforceConnectionManager`, de modo que cuando varios hilos
+    reciben el 401 a la vez solo uno vuelve a iniciar sesión y los demás
+    reutilizan el token nuevo. simple_salesforce reintenta la llamada después.
     """
-    global sf_connection
-    if sf_connection is None:
+
+    def __init__(self, *args, manager=None, **kwargs):
+        # Se asignan antes de super().__init__: Salesforce resuelve los atributos
+        # desconocidos como objetos de Salesforce (SFType) vía __getattr__.
+        self._manager = manager
+        self._initialized = False
+        super().__init__(*args, **kwargs)
+        self._initialized = True
+
+    def _refresh_session(self):
+        # El constructor de Salesforce inicia sesión llamando a este método.
+        if self._manager is None or not self._initialized:
+            super()._refresh_session()
+            return
+        self._manager.refresh_expired(self)
+
+    def _login(self):
+        """Inicia sesión de nuevo con las credenciales JWT originales."""
+        super()._refresh_session()
+
+class SalesforceConnectionManager:
+    """
+    Gestiona la conexión compartida a Salesforce del proceso.
+
+    - Inicio de sesión único (single-flight): si varios hilos necesitan la
+      conexión a la vez, solo uno hace el login JWT y los demás esperan su
+      resultado.
+    - Renovación proactiva: cuando el token supera `refresh_after` segundos,
+      un solo hilo inicia sesión en segundo plano de la petición mientras los
+      demás siguen usando la conexión vigente; al terminar se reemplaza.
+    - Renovación reactiva: ante una sesión expirada se renueva una sola vez
+      para todos los hilos y simple_salesforce reintenta la llamada.
+    - Todas las conexiones comparten el mismo pool HTTP.
+    """
+
+    def __init__(self, http_session: requests.Session, refresh_after: float, retry_after: float):
+        self.http_session = http_session
+        self.refresh_after = refresh_after
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._connection = None
+        self._logged_in_at = 0.0
+        self._next_refresh_at = 0.0
+        stats.register_gauge("salesforce_auth.session_age_seconds", self.session_age)
+
+    def session_age(self) -> float:
+        """Segundos desde el último inicio de sesión (0 si aún no hay conexión)."""
+        return round(time.monotonic() - self._logged_in_at, 3) if self._connection else 0.0
+
+    def get(self) -> Salesforce:
+        """Devuelve la conexión vigente, iniciando o renovando la sesión si corresponde."""
+        connection = self._connection
+        if connection is not None:
+            if time.monotonic() < self._next_refresh_at:
+                return connection
+            # Renovación proactiva: solo un hilo la hace; el resto sigue con la conexión actual.
+            if not self._lock.acquire(blocking=False):
+                return connection
+            try:
+                if self._connection is connection and time.monotonic() >= self._next_refresh_at:
+                    stats.incr("salesforce_auth.proactive_refreshes")
+                    try:
+                        self._connection = self._new_connection()
+                    except Exception:
+                        self._next_refresh_at = time.monotonic() + self.retry_after
+                return self._connection
+            finally:
+                self._lock.release()
+
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._new_connection()
+            return self._connection
+
+    def refresh_expired(self, connection: ManagedSalesforce):
+        """
+        Renueva el token de `connection` tras un INVALID_SESSION_ID. Si otro
+        hilo ya obtuvo un token nuevo, se copia en lugar de iniciar sesión.
+        """
+        expired_token = connection.session_id
+        with self._lock:
+            if connection.session_id != expired_token:
+                stats.incr("salesforce_auth.expired_refreshes_shared")
+                return
+            current = self._connection
+            if current is not None and current is not connection and current.session_id != expired_token:
+                connection.session_id, connection.sf_instance = current.session_id, current.sf_instance
+                connection._generate_headers()
+                stats.incr("salesforce_auth.expired_refreshes_shared")
+                return
+
+            logging.warning("La sesión de Salesforce expiró. Iniciando sesión de nuevo.")
+            stats.incr("salesforce_auth.expired_refreshes")
+            self._timed_login(connection._login)
+            self._connection = connection
+            self._mark_logged_in()
+
+    def _new_connection(self) -> ManagedSalesforce:
         logging.info("Estableciendo nueva conexión con Salesforce...")
+        connection = self._timed_login(lambda: ManagedSalesforce(
+            username=SF_USERNAME,
+            consumer_key=SF_CONSUMER_KEY,
+            privatekey=SF_PRIVATE_KEY_CONTENT, # Se usa el contenido de la clave directamente
+            domain=SF_DOMAIN,
+            session=self.http_session,
+            manager=self,
+        ))
+        self._mark_logged_in()
+        logging.info("¡Conexión con Salesforce exitosa!")
+        return connection
+
+    def _mark_logged_in(self):
+        self._logged_in_at = time.monotonic()
+        self._next_refresh_at = self._logged_in_at + self.refresh_after
+
+    def _timed_login(self, login):
+        started_at = time.monotonic()
         try:
-            sf_connection = Salesforce(
-                username=SF_USERNAME,
-                consumer_key=SF_CONSUMER_KEY,
-                privatekey=SF_PRIVATE_KEY_CONTENT, # Se usa el contenido de la clave directamente
-                domain=SF_DOMAIN,
-            )
-            logging.info("¡Conexión con Salesforce exitosa!")
+            result = login()
         except SalesforceAuthenticationFailed as e:
+            stats.incr("salesforce_auth.login_failures")
             # Esta excepción tiene .message en lugar de .content
             logging.error(f"Error de autenticación con Salesforce: {e.code} - {e.message}")
             raise
         except SalesforceGeneralError as e:
+            stats.incr("salesforce_auth.login_failures")
             logging.error(f"Error de Salesforce al conectar: {e.code} - {e.content}")
             raise
         except Exception as e:
+            stats.incr("salesforce_auth.login_failures")
             logging.error(f"Error inesperado durante la conexión: {e}")
             raise
-    return sf_connection
+        stats.incr("salesforce_auth.logins")
+        stats.observe("salesforce_auth.login_seconds", time.monotonic() - started_at)
+        return result
+
+salesforce_connections = SalesforceConnectionManager(
+    build_salesforce_http_session(), SF_SESSION_REFRESH_SECONDS, SF_LOGIN_RETRY_SECONDS
+)
+stats.register_gauge("salesforce_http.connection_reuse_ratio", _salesforce_connection_reuse_ratio)
+stats.register_gauge("salesforce_http.pool_size", lambda: SF_HTTP_POOL_SIZE)
+
+# --- Caché de Contactos ---
+class MemoryContactStore:
+    """Entradas por nombre en un OrderedDict con desalojo LRU, local al proceso."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class FileContactStore:
+    """
+    Entradas por nombre como archivos JSON en un directorio local compartido.
+    Las escrituras son atómicas (archivo temporal + os.replace). Las entradas
+    vencidas se descartan al leerlas y en un barrido periódico.
+    """
+
+    def __init__(self, directory: str, max_age: float):
+        self.directory = directory
+        self.max_age = max_age
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self._sweep_expired()
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _sweep_expired(self):
+        now = time.time()
+        if now - self._last_sweep < self.max_age:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(os.listdir(self.directory))
+
+class ContactCache:
+    """
+    Caché de lectura de contactos por nombre normalizado.
+
+    Cada nombre tiene una entrada con "ranuras" por operación ("find",
+    "dob:<fecha>", ...), cada una con su propio vencimiento: los resultados
+    positivos viven `ttl` segundos y los negativos (`None`) `negative_ttl` (con
+    0 no se guardan). Así `invalidate` elimina de una sola vez todo lo guardado
+    para un nombre.
+
+    Los aciertos y fallos se cuentan por operación en `stats`.
+    """
+
+    OPERATIONS = ("find", "verify_dob", "verify_dob_phone")
+
+    def __init__(self, store, ttl: float, negative_ttl: float):
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        for operation in self.OPERATIONS:
+            stats.register_gauge(f"contact_cache.{operation}.hit_ratio", lambda op=operation: self.hit_ratio(op))
+        stats.register_gauge("contact_cache.size", lambda: len(self.store))
+
+    @staticmethod
+    def normalize_name(full_name: str) -> str:
+        """Sin distinción de mayúsculas, igual que la comparación de 'Name' en SOQL."""
+        return full_name.strip().casefold()
+
+    def lookup(self, operation: str, full_name: str, slot: str):
+        """
+        Devuelve `(True, valor)` si hay un resultado vigente en la ranura (el
+        valor es None para un "no encontrado" cacheado) o `(False, None)`.
+        """
+        entry = self.store.get(self.normalize_name(full_name)) or {}
+        cached = entry.get(slot)
+        if cached is not None and cached["expires_at"] > time.time():
+            stats.incr(f"contact_cache.{operation}.hits")
+            if cached["value"] is None:
+                stats.incr(f"contact_cache.{operation}.negative_hits")
+            return True, cached["value"]
+        stats.incr(f"contact_cache.{operation}.misses")
+        return False, None
+
+    def peek(self, full_name: str, slot: str):
+        """Devuelve el valor vigente de la ranura sin contar acierto ni fallo (None si no hay)."""
+        cached = (self.store.get(self.normalize_name(full_name)) or {}).get(slot)
+        if cached is not None and cached["expires_at"] > time.time():
+            return cached["value"]
+        return None
+
+    def store_result(self, full_name: str, slot: str, value):
+        """
+        Guarda el resultado de una consulta; `None` se guarda como negativo.
+
+        Un contacto que trae AccountId vacío no se guarda: puede tener una
+        asociación asíncrona pendiente, y la invalidación al terminarla solo llega
+        a la caché del worker que la ejecutó.
+        """
+        if isinstance(value, dict) and "AccountId" in value and not value["AccountId"]:
+            stats.incr("contact_cache.skipped_without_account")
+            return
+        if value is None and self.negative_ttl <= 0:
+            return
+        key = self.normalize_name(full_name)
+        now = time.time()
+        entry = {
+            name: cached for name, cached in (self.store.get(key) or {}).items()
+            if cached["expires_at"] > now
+        }
+        entry[slot] = {"value": value, "expires_at": now + (self.ttl if value is not None else self.negative_ttl)}
+        self.store.put(key, entry)
+
+    def invalidate(self, full_name: str):
+        """Elimina todos los resultados guardados para el nombre."""
+        if not full_name:
+            return
+        self.store.delete(self.normalize_name(full_name))
+        stats.incr("contact_cache.invalidations")
+
+    def hit_ratio(self, operation: str) -> float:
+        counters = stats.snapshot_counters()
+        hits = counters.get(f"contact_cache.{operation}.hits", 0)
+        total = hits + counters.get(f"contact_cache.{operation}.misses", 0)
+        return hits / total if total else 0.0
+
+class NullContactStore:
+    """Almacén vacío para CONTACT_CACHE_BACKEND=off: nunca guarda nada."""
+
+    def get(self, key: str):
+        return None
+
+    def put(self, key: str, entry: dict):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def __len__(self):
+        return 0
+
+CONTACT_CACHE_BACKENDS = {
+    "memory": lambda: MemoryContactStore(CONTACT_CACHE_SIZE),
+    "file": lambda: FileContactStore(CONTACT_CACHE_DIR, max(CONTACT_CACHE_TTL, CONTACT_CACHE_NEGATIVE_TTL)),
+    "off": lambda: NullContactStore(),
+}
+
+if CONTACT_CACHE_BACKEND not in CONTACT_CACHE_BACKENDS:
+    logging.critical(f"Error crítico: CONTACT_CACHE_BACKEND '{CONTACT_CACHE_BACKEND}' no es válido. Opciones: {', '.join(CONTACT_CACHE_BACKENDS)}")
+    sys.exit(1)
+
+# Ver la nota del backend "memory" en la configuración.
+contact_cache_negative_ttl = 0 if CONTACT_CACHE_BACKEND == "memory" and GUNICORN_WORKERS > 1 else CONTACT_CACHE_NEGATIVE_TTL
+contact_cache = ContactCache(CONTACT_CACHE_BACKENDS[CONTACT_CACHE_BACKEND](), CONTACT_CACHE_TTL, contact_cache_negative_ttl)
+
+# --- Índice Local de Nombres ---
+NAME_INDEX_QUERY = "SELECT Id, Name, DOB__c, AccountId, Phone FROM Contact"
+
+class NameIndexLoader:
+    """
+    Carga todos los contactos en `index` en un hilo daemon y los recarga
+    periódicamente. El hilo se inicia en el primer `ensure_started` (después
+    del fork de gunicorn); hasta la primera carga completa `ready` es False.
+
+    Con la réplica local de contactos activa (`mirror_runner`), el índice se
+    alimenta de la réplica y no consulta a Salesforce por su cuenta.
+    """
+
+    def __init__(self, index: NameIndex, refresh_seconds: float):
+        self.index = index
+        self.refresh_seconds = refresh_seconds
+        self.mirror_runner = None
+        self._loaded = False
+        self.loaded_at = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        stats.register_gauge("name_index.size", lambda: len(self.index))
+        stats.register_gauge("name_index.age_seconds", lambda: round(time.time() - self.loaded_at, 1) if self.loaded_at else -1)
+
+    @property
+    def ready(self) -> bool:
+        if self.mirror_runner is not None:
+            return self.mirror_runner.fresh()
+        return self._loaded
+
+    def ensure_started(self):
+        if self.mirror_runner is not None:
+            self.mirror_runner.ensure_started()
+            return
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self._refresh_loop, name="name-index-loader", daemon=True).start()
+            self._started = True
+
+    def _refresh_loop(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.index.replace_all(get_salesforce_connection().query_all_iter(NAME_INDEX_QUERY))
+                self._loaded, self.loaded_at = True, time.time()
+                stats.observe("name_index.load_seconds", time.monotonic() - started)
+                logging.info(f"Índice de nombres cargado con {len(self.index)} contactos en {time.monotonic() - started:.1f}s.")
+            except Exception as e:
+                stats.incr("name_index.load_failures")
+                logging.error(f"Error al cargar el índice de nombres: {e}")
+            time.sleep(self.refresh_seconds if self.ready else SF_LOGIN_RETRY_SECONDS)
+
+name_index = NameIndex(min_score=NAME_INDEX_MIN_SCORE)
+name_index_loader = NameIndexLoader(name_index, NAME_INDEX_REFRESH_SECONDS)
+
+# --- Réplica Local de Contactos ---
+class ContactMirrorRunner:
+    """
+    Ejecuta `ContactMirrorSync` en un hilo daemon cada `interval` segundos. El
+    hilo se inicia en el primer `ensure_started` (después del fork de gunicorn)
+    y, si hay instantánea en disco, parte de ella en lugar de la carga completa;
+    si hace falta la carga completa, la hace un solo worker (ver `ContactMirrorSync`).
+    """
+
+    def __init__(self, sync: ContactMirrorSync, interval: float, max_staleness: float):
+        self.sync = sync
+        self.mirror = sync.mirror
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self._started = False
+        self._start_lock = threading.Lock()
+        stats.register_gauge("contact_mirror.size", lambda: len(self.mirror))
+        stats.register_gauge("contact_mirror.age_seconds", lambda: round(self.mirror.age_seconds(), 1) if self.mirror.last_sync_at else -1)
+
+    def fresh(self) -> bool:
+        age = self.mirror.age_seconds()
+        return age is not None and age <= self.max_staleness
+
+    def ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self._sync_loop, name="contact-mirror-sync", daemon=True).start()
+            self._started = True
+
+    def _sync_loop(self):
+        if self.sync.snapshot_path and self.mirror.load_snapshot(self.sync.snapshot_path):
+            logging.info(f"Réplica de contactos cargada desde '{self.sync.snapshot_path}' con {len(self.mirror)} contactos.")
+        while True:
+            started = time.monotonic()
+            try:
+                result = self.sync.sync_once(get_salesforce_connection())
+                stats.observe(f"contact_mirror.{result['mode']}_seconds", time.monotonic() - started)
+                stats.incr("contact_mirror.updated", result.get("updated", 0))
+                stats.incr("contact_mirror.deleted", result.get("deleted", 0))
+                if result["mode"] in ("bootstrap", "snapshot"):
+                    logging.info(f"Réplica de contactos cargada ({result['mode']}) con {result['contacts']} contactos en {time.monotonic() - started:.1f}s.")
+            except Exception as e:
+                stats.incr("contact_mirror.sync_failures")
+                logging.error(f"Error al sincronizar la réplica de contactos: {e}")
+            time.sleep(self.interval)
+
+contact_mirror = ContactMirror()
+contact_mirror_runner = ContactMirrorRunner(
+    ContactMirrorSync(contact_mirror, snapshot_path=CONTACT_MIRROR_SNAPSHOT_PATH),
+    CONTACT_MIRROR_SYNC_SECONDS,
+    CONTACT_MIRROR_MAX_STALENESS,
+)
+
+if CONTACT_MIRROR_ENABLED and NAME_INDEX_ENABLED:
+    contact_mirror.listeners.append(name_index)
+    name_index_loader.mirror_runner = contact_mirror_runner
+
+def mirror_lookup(full_name: str, dob: str = None, phone_key: str = None):
+    """
+    Busca en la réplica local el primer contacto con ese nombre (y, si se indican,
+    fecha de nacimiento y clave de teléfono).
+
+    Returns:
+        tuple: `(True, contacto)` si la réplica responde (contacto None solo con
+        CONTACT_MIRROR_TRUST_MISSES) o `(False, None)` si hay que consultar Salesforce.
+    """
+    if not CONTACT_MIRROR_ENABLED:
+        return False, None
+    contact_mirror_runner.ensure_started()
+    if not contact_mirror_runner.fresh():
+        stats.incr("contact_mirror.stale_skips")
+        return False, None
+
+    matches = contact_mirror.find_by_name(full_name)
+    if dob:
+        matches = [contact for contact in matches if contact.get('DOB__c') == dob]
+    if phone_key:
+        matches = [contact for contact in matches if _phone_matches(contact, phone_key)]
+    if matches:
+        stats.incr("contact_mirror.hits")
+        return True, matches[0]
+    stats.incr("contact_mirror.misses")
+    return (True, None) if CONTACT_MIRROR_TRUST_MISSES else (False, None)
+
+# -- Crea la coneccion con salesforce
+def get_salesforce_connection():
+    """
+    Devuelve la conexión compartida con Salesforce del proceso.
+
+    La conexión la gestiona `salesforce_connections`: el primer login es único
+    aunque lleguen varias peticiones a la vez, el token se renueva antes de
+    expirar y, si aun así expira, se renueva una sola vez y la llamada se
+    reintenta de forma transparente. Todas las llamadas comparten un pool de
+    conexiones HTTP keep-alive dimensionado para los hilos de gunicorn.
+
+    La configuración de la conexión (usuario, clave de consumidor, archivo de
+    clave privada y dominio) se obtiene de las variables de entorno.
+
+    Returns:
+        simple_salesforce.Salesforce: La instancia de conexión a Salesforce.
+
+    Raises:
+        SalesforceAuthenticationFailed: Si las credenciales son incorrectas.
+        SalesforceGeneralError: Si ocurre un error general al conectar con la API.
+        Exception: Para cualquier otro error inesperado durante la conexión.
+    """
+    return salesforce_connections.get()
 def _escape_soql_str(value: str) -> str:
     """
     Escapa una cadena de texto para su uso seguro en una consulta SOQL.
@@ -111,6 +844,21 @@ def _escape_soql_str(value: str) -> str:
         return "NULL"
     return f"'{str(value).replace('\\', '\\\\').replace("'", "\\'")}'"
 
+def similar_contact_names(full_name: str) -> list:
+    """
+    Hasta NAME_FIND_SUGGESTIONS nombres parecidos a `full_name` según el índice
+    local. Si el índice no está listo devuelve una lista vacía en lugar de caer
+    a SOSL, para que un "no encontrado" no cueste otra llamada a Salesforce.
+    """
+    if not (NAME_INDEX_ENABLED and NAME_FIND_SUGGESTIONS > 0):
+        return []
+    name_index_loader.ensure_started()
+    if not name_index_loader.ready:
+        stats.incr("name_search.suggestions_skipped")
+        return []
+    stats.incr("name_search.suggestions")
+    return [candidate["contact"]["Name"] for candidate in name_index.search(full_name, limit=NAME_FIND_SUGGESTIONS)]
+
 # --- Funcion encontrar un contacto
 @app.route('/contact/find', methods=['POST'])
 def find_contact():
@@ -130,18 +878,26 @@ def find_contact():
     full_name = full_name.strip()
 
     try:
-        # Se escapa el nombre completo para usarlo de forma segura en la consulta.
-        safe_full_name = _escape_soql_str(full_name) # Revertimos a la consulta SOQL original, que es más rápida para este caso.
-        # Se modifica la consulta para usar el campo 'Name' en lugar de FirstName y LastName.
-        # Esto simplifica la lógica y puede mejorar el rendimiento al usar un único campo indexado.
-        query = (
-            f"SELECT Id, FirstName, LastName, Email, AccountId FROM Contact WHERE Name = {safe_full_name} LIMIT 1"
-        )
-        result = sf.query(query)
-        logging.info(f"Ejecutando SOQL query: {query}")
-
-        if result.get('totalSize', 0) > 0:
-            contact = result['records'][0]
+        # Con la réplica local activa se responde sin llamar a Salesforce.
+        served, contact = mirror_lookup(full_name)
+        if not served:
+            # Dentro de una conversación el agente repite la búsqueda del mismo nombre.
+            cached, contact = contact_cache.lookup("find", full_name, "find")
+            if not cached:
+                # Se escapa el nombre completo para usarlo de forma segura en la consulta.
+                safe_full_name = _escape_soql_str(full_name) # Revertimos a la consulta SOQL original, que es más rápida para este caso.
+                # Se modifica la consulta para usar el campo 'Name' en lugar de FirstName y LastName.
+                # Esto simplifica la lógica y puede mejorar el rendimiento al usar un único campo indexado.
+                # DOB__c y Phone permiten responder desde la caché una verificación posterior exitosa.
+                query = (
+                    f"SELECT Id, FirstName, LastName, Email, AccountId, DOB__c, Phone FROM Contact WHERE Name = {safe_full_name} LIMIT 1"
+                )
+                result = sf.query(query)
+                logging.info(f"Ejecutando SOQL query: {query}")
+                contact = result['records'][0] if result.get('totalSize', 0) > 0 else None
+                contact_cache.store_result(full_name, "find", contact)
+
+        if contact:
             # Se incluye el AccountId en el log para facilitar la depuración.
             logging.info(f"Contacto encontrado: {contact['Id']}, AccountId: {contact.get('AccountId')}")
             response_data = {"status": "found", "contact": contact}
@@ -150,6 +906,9 @@ def find_contact():
         else:
             logging.info(f"Contacto no encontrado para '{full_name}'.")
             response_data = {"status": "not_found", "message": f"Contacto con nombre '{full_name}' no encontrado."}
+            similar_names = similar_contact_names(full_name)
+            if similar_names:
+                response_data["similar_names"] = similar_names
             status_code = 404
             return jsonify(response_data), status_code
 
@@ -160,6 +919,503 @@ def find_contact():
         logging.error(f"Error inesperado durante la búsqueda: {e}")
         return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
 
+# --- Índice de Teléfonos
+PHONE_CONTACT_FIELDS = "Id, FirstName, LastName, Email, AccountId, DOB__c, Phone, MobilePhone"
+
+def phone_index_key(phone):
+    """
+    Devuelve la clave E.164 de un teléfono sin el '+' (p. ej. "15551234567"), o
+    None si no tiene entre 7 y 15 dígitos. "+" y el prefijo internacional "00"
+    indican que el número ya trae código de país.
+    """
+    if not phone:
+        return None
+    raw = str(phone).strip()
+    digits = re.sub(r'\D', '', raw)
+    if not raw.startswith('+'):
+        if digits.startswith('00'):
+            digits = digits[2:]
+        elif len(digits) == PHONE_NATIONAL_DIGITS:
+            digits = PHONE_DEFAULT_COUNTRY_CODE + digits
+    return digits if 7 <= len(digits) <= 15 else None
+
+def _phone_search_terms(key: str) -> str:
+    """Términos SOSL para la clave: con y sin código de país, según cómo esté guardado el número."""
+    terms = [key]
+    national = key[len(PHONE_DEFAULT_COUNTRY_CODE):]
+    if key.startswith(PHONE_DEFAULT_COUNTRY_CODE) and len(national) == PHONE_NATIONAL_DIGITS:
+        terms.append(national)
+    return " OR ".join(terms)
+
+def _phone_matches(contact: dict, key: str) -> bool:
+    return any(phone_index_key(contact.get(field)) == key for field in ('Phone', 'MobilePhone'))
+
+def find_contacts_by_phone_key(sf, key: str, where: str = "", limit: int = 5) -> list:
+    """
+    Busca contactos por clave de teléfono con una consulta indexada: igualdad
+    sobre PHONE_INDEX_FIELD si está configurado, o SOSL IN PHONE FIELDS. En el
+    segundo caso se descartan los resultados cuya clave no coincide exactamente;
+    el índice de SOSL tarda en reflejar los cambios, así que sin campo indexado
+    solo /contact/find/by-phone (búsqueda de mejor esfuerzo) lo usa.
+    `where` añade condiciones SOQL (p. ej. nombre y fecha de nacimiento).
+    """
+    if PHONE_INDEX_FIELD:
+        conditions = " AND ".join(filter(None, [f"{PHONE_INDEX_FIELD} = {_escape_soql_str(key)}", where]))
+        query = f"SELECT {PHONE_CONTACT_FIELDS} FROM Contact WHERE {conditions} LIMIT {limit}"
+        logging.info(f"Ejecutando SOQL por teléfono: {query}")
+        stats.incr("phone_index.field_queries")
+        return sf.query(query).get('records', [])
+
+    where_clause = f" WHERE {where}" if where else ""
+    search = (
+        f"FIND {{{_phone_search_terms(key)}}} IN PHONE FIELDS "
+        f"RETURNING Contact({PHONE_CONTACT_FIELDS}{where_clause}) LIMIT {limit}"
+    )
+    logging.info(f"Ejecutando SOSL search: {search}")
+    stats.incr("phone_index.search_queries")
+    return [contact for contact in sf.search(search).get('searchRecords', []) if _phone_matches(contact, key)]
+
+# --- Búsqueda aproximada de contactos por nombre
+def search_contacts_sosl(sf, full_name: str, dob: str = None, limit: int = 5) -> list:
+    """
+    Alternativa a `name_index` mientras el índice local no está listo: SOSL sobre
+    los campos de nombre con cualquiera de las palabras, ordenado con la misma
+    puntuación que el índice.
+    """
+    words = fold_name(full_name).split()
+    dob_filter = f" WHERE DOB__c = {dob}" if dob else ""
+    search = (
+        f"FIND {{{' OR '.join(words)}}} IN NAME FIELDS "
+        f"RETURNING Contact(Id, Name, DOB__c, AccountId, Phone{dob_filter}) LIMIT 200"
+    )
+    logging.info(f"Ejecutando SOSL search: {search}")
+    ranking = NameIndex(min_score=NAME_INDEX_MIN_SCORE)
+    ranking.replace_all(sf.search(search).get('searchRecords', []))
+    return ranking.search(full_name, limit=limit, dob=dob)
+
+@app.route('/contact/search', methods=['POST'])
+def search_contacts():
+    """
+    Busca contactos con un nombre parecido al indicado, sin distinguir acentos,
+    mayúsculas ni el orden de las palabras, y tolerando un apellido faltante o
+    una letra mal transcrita. Devuelve los candidatos ordenados por puntuación
+    (1.0 = mismas palabras) en una sola llamada.
+
+    Espera un JSON: {"full_name": "Jose Garcia", "dob": "YYYY-MM-DD" (opcional), "limit": 5 (opcional)}
+    """
+    data = request.get_json(silent=True) or {}
+    full_name = data.get('full_name')
+    dob = data.get('dob')
+
+    if not isinstance(full_name, str) or not fold_name(full_name):
+        return jsonify({"status": "error", "message": "El campo 'full_name' es requerido."}), 400
+    if dob:
+        try:
+            datetime.datetime.strptime(dob, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "El formato de 'dob' no es válido. Se esperaba YYYY-MM-DD."}), 400
+    try:
+        limit = max(1, min(int(data.get('limit', 5)), NAME_SEARCH_MAX_RESULTS))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "El campo 'limit' debe ser numérico."}), 400
+
+    started = time.monotonic()
+    try:
+        if NAME_INDEX_ENABLED:
+            name_index_loader.ensure_started()
+        if NAME_INDEX_ENABLED and name_index_loader.ready:
+            source, candidates = "index", name_index.search(full_name, limit=limit, dob=dob)
+        else:
+            source, candidates = "sosl", search_contacts_sosl(get_salesforce_connection(), full_name, dob=dob, limit=limit)
+        stats.incr(f"name_search.{source}")
+        stats.observe(f"name_search.{source}_seconds", time.monotonic() - started)
+
+        if candidates:
+            logging.info(f"{len(candidates)} candidato(s) para '{full_name}' ({source}).")
+            return jsonify({"status": "found", "source": source, "candidates": candidates}), 200
+        logging.info(f"Sin candidatos para '{full_name}' ({source}).")
+        return jsonify({"status": "not_found", "source": source, "candidates": [], "message": f"No se encontraron contactos parecidos a '{full_name}'."}), 404
+
+    except SalesforceGeneralError as e:
+        logging.error(f"Error de Salesforce durante la búsqueda aproximada: {e.code} - {e.content}")
+        return jsonify({"status": "error", "message": "Error de Salesforce.", "details": e.content}), 500
+    except Exception as e:
+        logging.error(f"Error inesperado durante la búsqueda aproximada: {e}")
+        return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
+
+# --- Funcion encontrar contactos por teléfono
+@app.route('/contact/find/by-phone', methods=['POST'])
+def find_contact_by_phone():
+    """
+    Busca los contactos cuyo teléfono coincide con el número indicado.
+    Espera un JSON: {"phone": "+15551234567"}
+
+    El número se normaliza a su clave E.164 y se busca con una sola consulta
+    indexada (ver `find_contacts_by_phone_key`), en lugar de recorrer contactos.
+    Se devuelven todos los candidatos (p. ej. familiares que comparten número),
+    hasta 5.
+    """
+    sf = get_salesforce_connection()
+    data = request.json
+    phone = data.get('phone')
+
+    if not phone:
+        return jsonify({"status": "error", "message": "El campo 'phone' es requerido."}), 400
+
+    # Solo dígitos: evita caracteres reservados de SOSL y diferencias de formato.
+    key = phone_index_key(phone)
+    if not key:
+        return jsonify({"status": "error", "message": "El campo 'phone' no es un número de teléfono válido."}), 400
+
+    try:
+        contacts = find_contacts_by_phone_key(sf, key)
+
+        if contacts:
+            logging.info(f"{len(contacts)} contacto(s) encontrado(s) para el teléfono {phone}.")
+            return jsonify({"status": "found", "contacts": contacts}), 200
+        logging.info(f"Ningún contacto encontrado para el teléfono {phone}.")
+        return jsonify({"status": "not_found", "message": f"No se encontraron contactos con el teléfono '{phone}'."}), 404
+
+    except SalesforceGeneralError as e:
+        logging.error(f"Error de Salesforce durante la búsqueda por teléfono: {e.code} - {e.content}")
+        return jsonify({"status": "error", "message": "Error de Salesforce.", "details": e.content}), 500
+    except Exception as e:
+        logging.error(f"Error inesperado durante la búsqueda por teléfono: {e}")
+        return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
+
+# --- Búsqueda de contactos por lotes
+BATCH_CONTACT_FIELDS = "Id, Name, FirstName, LastName, Email, AccountId, DOB__c, Phone"
+
+def chunk_names_for_soql(names: list, query_prefix: str, query_suffix: str, max_chars: int = SOQL_MAX_URL_CHARS) -> list:
+    """
+    Reparte los nombres en el menor número de listas `IN (...)` cuya consulta
+    completa, codificada para la URL, no supere `max_chars`.
+    """
+    base_length = len(quote_plus(query_prefix + query_suffix))
+    chunks, current, length = [], [], base_length
+    for name in names:
+        piece_length = len(quote_plus(_escape_soql_str(name) + ", "))
+        if current and length + piece_length > max_chars:
+            chunks.append(current)
+            current, length = [], base_length
+        current.append(name)
+        length += piece_length
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _parse_batch_items(data) -> list:
+    """
+    Normaliza el cuerpo de /contact/find/batch a una lista de dicts
+    {"full_name", "dob"}. Los elementos inválidos llevan "error".
+    """
+    raw_items = data.get('contacts') if isinstance(data, dict) else None
+    if raw_items is None and isinstance(data, dict):
+        raw_items = data.get('names')
+    if not isinstance(raw_items, list):
+        raise ValueError("Se esperaba 'contacts' (o 'names') como lista.")
+    if len(raw_items) > CONTACT_BATCH_MAX_ITEMS:
+        raise ValueError(f"El lote supera el máximo de {CONTACT_BATCH_MAX_ITEMS} elementos.")
+
+    items = []
+    for raw in raw_items:
+        item = {"full_name": raw, "dob": None} if isinstance(raw, str) else raw
+        if not isinstance(item, dict) or not isinstance(item.get('full_name'), str) or not item['full_name'].strip():
+            items.append({"input": raw, "error": "Se requiere 'full_name'."})
+            continue
+        dob = item.get('dob')
+        if dob:
+            try:
+                datetime.datetime.strptime(dob, '%Y-%m-%d')
+            except (TypeError, ValueError):
+                items.append({"input": raw, "error": "El formato de 'dob' no es válido. Se esperaba YYYY-MM-DD."})
+                continue
+        items.append({"input": raw, "full_name": item['full_name'].strip(), "dob": dob or None})
+    return items
+
+def _batch_slot(item: dict) -> str:
+    return f"dob:{item['dob']}" if item['dob'] else "find"
+
+def _batch_result(index: int, item: dict, contact) -> dict:
+    if contact:
+        return {"index": index, "input": item['input'], "status": "found", "contact": contact}
+    return {"index": index, "input": item['input'], "status": "not_found", "contact": None}
+
+def iter_batch_contact_results(sf, items: list):
+    """
+    Genera un resultado por elemento del lote. Los que ya están en la caché de
+    contactos se responden primero; el resto se resuelve con una consulta
+    `WHERE Name IN (...)` por bloque, emitiendo los resultados de cada bloque en
+    cuanto llega su respuesta.
+    """
+    pending = {}
+    for index, item in enumerate(items):
+        if "error" in item:
+            yield {"index": index, "input": item['input'], "status": "invalid", "message": item['error']}
+            continue
+        operation = "verify_dob" if item['dob'] else "find"
+        cached, contact = contact_cache.lookup(operation, item['full_name'], _batch_slot(item))
+        if cached:
+            yield _batch_result(index, item, contact)
+        else:
+            pending.setdefault(ContactCache.normalize_name(item['full_name']), []).append((index, item))
+
+    query_prefix = f"SELECT {BATCH_CONTACT_FIELDS} FROM Contact WHERE Name IN ("
+    query_suffix = ")"
+    names = [entries[0][1]['full_name'] for entries in pending.values()]
+    for chunk in chunk_names_for_soql(names, query_prefix, query_suffix):
+        query = query_prefix + ", ".join(_escape_soql_str(name) for name in chunk) + query_suffix
+        chunk_keys = [ContactCache.normalize_name(name) for name in chunk]
+        stats.incr("contact_batch.queries")
+        try:
+            logging.info(f"Ejecutando SOQL por lotes con {len(chunk)} nombre(s).")
+            records_by_name = {}
+            for record in sf.query_all_iter(query):
+                records_by_name.setdefault(ContactCache.normalize_name(record.get('Name') or ""), []).append(record)
+        except Exception as e:
+            logging.error(f"Error en la consulta por lotes: {e}")
+            stats.incr("contact_batch.failed_queries")
+            for key in chunk_keys:
+                for index, item in pending[key]:
+                    yield {"index": index, "input": item['input'], "status": "error", "message": "Error de Salesforce."}
+            continue
+
+        for key in chunk_keys:
+            records = records_by_name.get(key, [])
+            for index, item in pending[key]:
+                if item['dob']:
+                    contact = next((record for record in records if record.get('DOB__c') == item['dob']), None)
+                else:
+                    contact = records[0] if records else None
+                contact_cache.store_result(item['full_name'], _batch_slot(item), contact)
+                yield _batch_result(index, item, contact)
+
+@app.route('/contact/find/batch', methods=['POST'])
+def find_contacts_batch():
+    """
+    Busca varios contactos por nombre completo (y opcionalmente fecha de
+    nacimiento) con el menor número de consultas `WHERE Name IN (...)`.
+
+    Espera un JSON: {"contacts": [{"full_name": "Nombre Apellido", "dob": "YYYY-MM-DD"}, ...]}
+    o {"names": ["Nombre Apellido", ...]}.
+
+    Cada resultado lleva el índice y el elemento de entrada, con estado "found",
+    "not_found", "invalid" o "error". Con `?stream=1` (o `Accept: application/x-ndjson`)
+    se devuelve un resultado por línea a medida que se resuelven los bloques;
+    si no, un JSON con todos los resultados en el orden de entrada.
+    """
+    try:
+        items = _parse_batch_items(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    stats.incr("contact_batch.requests")
+    stats.incr("contact_batch.items", len(items))
+    sf = get_salesforce_connection()
+
+    stream = request.args.get('stream') in ('1', 'true') or request.accept_mimetypes.best == "application/x-ndjson"
+    if stream:
+        def generate():
+            for result in iter_batch_contact_results(sf, items):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    results = sorted(iter_batch_contact_results(sf, items), key=lambda result: result['index'])
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return jsonify({"status": "ok", "results": results, "summary": summary}), 200
+
+# --- Creación de Contactos y Asociación de la Cuenta del Flow ---
+def _flow_account_query(account_name: str) -> str:
+    return f"SELECT Id FROM Account WHERE Name = {_escape_soql_str(account_name)} LIMIT 1"
+
+def create_contact_composite(sf, contact_data: dict, account_name: str):
+    """
+    Crea el contacto, busca la cuenta creada por el Flow y la asocia en una sola
+    petición a la Composite API. Las subpeticiones se encadenan por referencia
+    (`@{newContact.id}`, `@{flowAccount.records[0].Id}`); con `allOrNone` en falso
+    el contacto queda creado aunque la cuenta todavía no exista.
+
+    Returns:
+        tuple: (contact_id, account_id, errores). `contact_id` es None si la creación
+        falló (con los errores de Salesforce); `account_id` es None si no se asoció.
+    """
+    base_path = f"/services/data/v{sf.sf_version}"
+    payload = {
+        "allOrNone": False,
+        "compositeRequest": [
+            {"method": "POST", "url": f"{base_path}/sobjects/Contact", "referenceId": "newContact", "body": contact_data},
+            {"method": "GET", "url": f"{base_path}/query?q={quote_plus(_flow_account_query(account_name))}", "referenceId": "flowAccount"},
+            {
+                "method": "PATCH",
+                "url": f"{base_path}/sobjects/Contact/@{{newContact.id}}",
+                "referenceId": "linkAccount",
+                "body": {"AccountId": "@{flowAccount.records[0].Id}"},
+            },
+        ],
+    }
+    result = sf.restful("composite", method="POST", json=payload)
+    responses = {item["referenceId"]: item for item in result.get("compositeResponse", [])}
+
+    created = responses.get("newContact", {})
+    if created.get("httpStatusCode") != 201:
+        return None, None, created.get("body")
+
+    account_id = None
+    if responses.get("linkAccount", {}).get("httpStatusCode") == 204:
+        account_id = responses["flowAccount"]["body"]["records"][0]["Id"]
+        stats.incr("contact_create.account_linked_inline")
+    return created["body"]["id"], account_id, None
+
+def wait_for_flow_account(sf, account_name: str, initial_wait: bool = False):
+    """
+    Busca la cuenta que el Flow crea para el contacto, reintentando con espera
+    exponencial acotada hasta ACCOUNT_POLL_TIMEOUT. Con `initial_wait` se espera
+    antes del primer intento (la cuenta ya se buscó en la petición compuesta).
+
+    Returns:
+        str | None: El Id de la cuenta, o None si no apareció a tiempo.
+    """
+    query = _flow_account_query(account_name)
+    deadline = time.monotonic() + ACCOUNT_POLL_TIMEOUT
+    delay = ACCOUNT_POLL_INITIAL_DELAY
+    if initial_wait:
+        time.sleep(delay)
+        delay = min(delay * 2, ACCOUNT_POLL_MAX_DELAY)
+    while True:
+        logging.info(f"Buscando cuenta con SOQL: {query}")
+        stats.incr("contact_create.account_polls")
+        account_result = sf.query(query)
+        if account_result.get('totalSize', 0) > 0:
+            return account_result['records'][0]['Id']
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, ACCOUNT_POLL_MAX_DELAY)
+
+def associate_flow_account(sf, contact_id: str, account_name: str, initial_wait: bool = False):
+    """
+    Espera la cuenta del Flow y la asocia al contacto.
+
+    Returns:
+        str | None: El Id de la cuenta asociada, o None si no apareció a tiempo.
+    """
+    account_id = wait_for_flow_account(sf, account_name, initial_wait=initial_wait)
+    if account_id:
+        logging.info(f"Cuenta encontrada con ID: {account_id}. Asociando con el contacto.")
+        # Se actualiza el campo 'AccountId' en el contacto para crear la relación.
+        sf.Contact.update(contact_id, {'AccountId': account_id})
+        logging.info(f"Contacto {contact_id} actualizado con AccountId {account_id}.")
+    else:
+        # Si no se encuentra la cuenta, se registra una advertencia.
+        # El contacto queda creado pero sin cuenta asociada.
+        logging.warning(f"No se encontró una cuenta con el nombre '{account_name}' después de {ACCOUNT_POLL_TIMEOUT} segundos.")
+        stats.incr("contact_create.account_not_found")
+    return account_id
+
+# --- Asociación de Cuentas en Segundo Plano ---
+class AccountAssociationJob:
+    """Estado de la asociación de la cuenta de un contacto recién creado."""
+
+    def __init__(self, contact_id: str, account_name: str, contact_names: tuple, initial_wait: bool):
+        self.contact_id = contact_id
+        self.account_name = account_name
+        self.contact_names = contact_names
+        self.initial_wait = initial_wait
+        self.status = "pending"
+        self.account_id = None
+        self.error = None
+        self.enqueued_at = time.monotonic()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def describe(self) -> dict:
+        return {"contact_id": self.contact_id, "status": self.status, "account_id": self.account_id, "error": self.error}
+
+class AccountAssociationQueue:
+    """
+    Cola acotada en memoria de asociaciones contacto-cuenta, atendida por un grupo
+    fijo de hilos daemon que se inician en el primer `submit` (después del fork de
+    gunicorn). Los trabajos se indexan por Id de contacto; los terminados se
+    conservan hasta `history` entradas para las consultas de estado.
+    """
+
+    def __init__(self, name: str, maxsize: int, workers: int, history: int):
+        self.name = name
+        self.history = history
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._jobs_lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._in_flight = 0
+        stats.register_gauge(f"{name}.depth", self.depth)
+        stats.register_gauge(f"{name}.in_flight", lambda: self._in_flight)
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self._workers):
+                threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True).start()
+            self._started = True
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            stats.observe(f"{self.name}.wait_seconds", time.monotonic() - job.enqueued_at)
+            with self._jobs_lock:
+                self._in_flight += 1
+            try:
+                job.account_id = associate_flow_account(get_salesforce_connection(), job.contact_id, job.account_name, job.initial_wait)
+                job.status = "associated" if job.account_id else "not_found"
+                stats.incr(f"{self.name}.{job.status}")
+            except Exception as e:
+                job.status, job.error = "failed", str(e)
+                stats.incr(f"{self.name}.failed")
+                logging.error(f"Error al asociar la cuenta del contacto {job.contact_id}: {e}")
+            finally:
+                # Las búsquedas cacheadas mientras la asociación estaba pendiente no traen el AccountId.
+                for name in job.contact_names:
+                    contact_cache.invalidate(name)
+                job.finished_at = time.monotonic()
+                stats.observe(f"{self.name}.completion_seconds", job.finished_at - job.enqueued_at)
+                with self._jobs_lock:
+                    self._in_flight -= 1
+                job.done.set()
+                self._queue.task_done()
+
+    def submit(self, job: AccountAssociationJob) -> bool:
+        """Encola el trabajo; devuelve False si la cola está llena."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            stats.incr(f"{self.name}.rejected")
+            return False
+        with self._jobs_lock:
+            self._jobs[job.contact_id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        stats.incr(f"{self.name}.submitted")
+        return True
+
+    def get(self, contact_id: str):
+        with self._jobs_lock:
+            return self._jobs.get(contact_id)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+account_association_queue = AccountAssociationQueue(
+    "account_association", ACCOUNT_ASSOCIATION_QUEUE_SIZE, ACCOUNT_ASSOCIATION_WORKERS, ACCOUNT_ASSOCIATION_HISTORY
+)
+
 @app.route('/contact/create', methods=['POST'])
 def create_contact():
     """
@@ -170,10 +1426,17 @@ def create_contact():
     2. Crea el registro del Contacto en Salesforce.
     3. Una automatización (Flow) en Salesforce se activa y crea una Cuenta
        asociada, nombrandola con el nombre y apellido del contacto en mayúsculas.
-    4. Esta función espera 5 segundos para dar tiempo a que el Flow se ejecute.
-    5. Busca la Cuenta recién creada por su nombre.
-    6. Si la encuentra, actualiza el Contacto para asociarle el ID de la Cuenta.
-    7. Devuelve los datos del contacto creado, incluyendo el ID de la cuenta si se asoció.
+    4. Busca la Cuenta recién creada por su nombre.
+    5. Si la encuentra, actualiza el Contacto para asociarle el ID de la Cuenta.
+    6. Devuelve los datos del contacto creado, incluyendo el ID de la cuenta si se asoció.
+
+    Con CONTACT_CREATE_MODE=composite los pasos 2, 4 y 5 viajan en una sola petición
+    a la Composite API. Si la cuenta aún no existe, se vuelve a buscar con espera
+    exponencial acotada (ACCOUNT_POLL_*) en lugar de una espera fija.
+
+    Con CONTACT_ACCOUNT_ASSOCIATION=async esa espera se hace en segundo plano: la
+    respuesta incluye "account_association" con el estado "pending" y la URL donde
+    consultarlo (GET /contact/<id>/account).
 
     Espera un JSON con 'LastName' o 'full_name'.
     Ej: {"full_name": "Carlos TEST API", "Email": "carlos.test@example.com"}
@@ -186,8 +1449,10 @@ def create_contact():
 
     # 1. PREPARACIÓN DE DATOS
     # Si se recibe 'full_name', se divide en FirstName y LastName para Salesforce.
+    requested_full_name = None
     if 'full_name' in contact_data:
         full_name = contact_data.pop('full_name')
+        requested_full_name = full_name
         parts = full_name.strip().split()
         contact_data.setdefault('FirstName', parts[0] if parts else "")
         contact_data.setdefault('LastName', " ".join(parts[1:]) if len(parts) > 1 else "")
@@ -199,59 +1464,75 @@ def create_contact():
     # Asegurar que el tipo de entidad está presente para la creación del contacto.
     contact_data.setdefault('Entity_Type__c', 'Individual')
 
+    # Mantener la clave de teléfono indexada para las búsquedas por número.
+    if PHONE_INDEX_FIELD and contact_data.get('Phone'):
+        contact_data.setdefault(PHONE_INDEX_FIELD, phone_index_key(contact_data['Phone']))
+
     logging.info(f"Petición para crear contacto con datos: {contact_data}")
+    started = time.monotonic()
+    # Por convención, el Flow nombra la cuenta usando el nombre completo en mayúsculas.
+    account_name = f"{contact_data.get('FirstName', '')} {contact_data.get('LastName', '')}".strip().upper()
     try:
         # 2. CREACIÓN DEL CONTACTO
-        # Se crea únicamente el contacto. El Flow en Salesforce se encargará de la cuenta.
-        create_result = sf.Contact.create(contact_data)
-
-        if create_result.get('success'):
-            new_contact_id = create_result['id']
-            logging.info(f"Contacto creado con ID: {new_contact_id}. Esperando para asociar cuenta vía Flow.")
+        # El Flow en Salesforce se encarga de la cuenta. En modo "composite" la misma
+        # petición busca esa cuenta y la asocia al contacto.
+        if CONTACT_CREATE_MODE == "composite":
+            new_contact_id, account_id, create_errors = create_contact_composite(sf, contact_data, account_name)
+        else:
+            create_result = sf.Contact.create(contact_data)
+            new_contact_id = create_result['id'] if create_result.get('success') else None
+            account_id, create_errors = None, create_result.get('errors')
 
-            
-            # 4. BÚSQUEDA DE LA CUENTA
-            # Se intenta encontrar la cuenta que el Flow debería haber creado.
-            # Por convención, el Flow nombra la cuenta usando el nombre completo en mayúsculas.
-            account_name = f"{contact_data.get('FirstName', '')} {contact_data.get('LastName', '')}".strip().upper()
-            safe_account_name = _escape_soql_str(account_name)
-            
-            account_id = None
+        if not new_contact_id:
+            # Este bloque se ejecuta si la creación inicial del contacto falla.
+            # Un error común aquí es 'CANNOT_EXECUTE_FLOW_TRIGGER' si el Flow tiene un problema.
+            logging.error(f"Error de Salesforce al crear contacto: {create_errors}")
+            return jsonify({"status": "error", "message": "Error de Salesforce al crear el contacto.", "details": create_errors}), 500
+
+        logging.info(f"Contacto creado con ID: {new_contact_id}.")
+
+        # Las búsquedas cacheadas de este nombre (p. ej. el "no encontrado" previo) ya no son válidas.
+        contact_cache.invalidate(f"{contact_data.get('FirstName', '')} {contact_data.get('LastName', '')}")
+        if requested_full_name:
+            contact_cache.invalidate(requested_full_name)
+        if CONTACT_MIRROR_ENABLED and contact_mirror.last_sync_at:
+            # La réplica avisa al índice de nombres.
+            contact_mirror.upsert({"Id": new_contact_id, "AccountId": account_id, **contact_data})
+        elif name_index_loader.ready:
+            name_index.upsert({"Id": new_contact_id, "AccountId": account_id, **contact_data})
+
+        # 4. BÚSQUEDA Y ASOCIACIÓN DE LA CUENTA
+        # Solo si la cuenta no quedó asociada en la petición compuesta. En modo asíncrono
+        # se encola; si la cola está llena se resuelve aquí mismo.
+        association_job = None
+        if not account_id and CONTACT_ACCOUNT_ASSOCIATION == "async":
+            contact_names = tuple(filter(None, [f"{contact_data.get('FirstName', '')} {contact_data.get('LastName', '')}", requested_full_name]))
+            association_job = AccountAssociationJob(new_contact_id, account_name, contact_names, CONTACT_CREATE_MODE == "composite")
+            if not account_association_queue.submit(association_job):
+                logging.warning(f"Cola de asociación llena; se asocia la cuenta de {new_contact_id} de forma síncrona.")
+                association_job = None
+
+        if not account_id and association_job is None:
             try:
-                # Se construye y ejecuta la consulta SOQL para encontrar la cuenta.
-                query = f"SELECT Id FROM Account WHERE Name = {safe_account_name} LIMIT 1"
-                logging.info(f"Buscando cuenta con SOQL: {query}")
-                account_result = sf.query(query)
-                
-                # 5. ASOCIACIÓN DE LA CUENTA
-                if account_result.get('totalSize', 0) > 0:
-                    account_id = account_result['records'][0]['Id']
-                    logging.info(f"Cuenta encontrada con ID: {account_id}. Asociando con el contacto.")
-                    # Se actualiza el campo 'AccountId' en el contacto para crear la relación.
-                    sf.Contact.update(new_contact_id, {'AccountId': account_id})
-                    logging.info(f"Contacto {new_contact_id} actualizado con AccountId {account_id}.")
-                else:
-                    # Si no se encuentra la cuenta, se registra una advertencia.
-                    # El flujo no se detiene, el contacto queda creado pero sin cuenta asociada.
-                    logging.warning(f"No se encontró una cuenta con el nombre '{account_name}' después de 5 segundos.")
-
+                account_id = associate_flow_account(sf, new_contact_id, account_name, initial_wait=(CONTACT_CREATE_MODE == "composite"))
             except Exception as e:
-                # 6. MANEJO DE ERRORES DE ASOCIACIÓN
+                # 5. MANEJO DE ERRORES DE ASOCIACIÓN
                 # Si la búsqueda o actualización de la cuenta falla, no se interrumpe la respuesta exitosa
                 # de la creación del contacto. Solo se registra el error para depuración.
                 logging.error(f"Ocurrió un error al intentar asociar la cuenta con el contacto: {e}")
+                account_id = None
 
-            # 7. RESPUESTA FINAL
-            # Se prepara la respuesta JSON, incluyendo el AccountId si la asociación fue exitosa.
-            new_contact_info = {"Id": new_contact_id, **contact_data}
-            if account_id:
-                new_contact_info['AccountId'] = account_id
-            return jsonify({"status": "created", "contact": new_contact_info}), 201
-        else:
-            # Este bloque se ejecuta si la creación inicial del contacto falla.
-            # Un error común aquí es 'CANNOT_EXECUTE_FLOW_TRIGGER' si el Flow tiene un problema.
-            logging.error(f"Error de Salesforce al crear contacto: {create_result.get('errors')}")
-            return jsonify({"status": "error", "message": "Error de Salesforce al crear el contacto.", "details": create_result.get('errors')}), 500
+        stats.observe(f"contact_create.{CONTACT_CREATE_MODE}_seconds", time.monotonic() - started)
+
+        # 6. RESPUESTA FINAL
+        # Se prepara la respuesta JSON, incluyendo el AccountId si la asociación fue exitosa.
+        new_contact_info = {"Id": new_contact_id, **contact_data}
+        if account_id:
+            new_contact_info['AccountId'] = account_id
+        response_data = {"status": "created", "contact": new_contact_info}
+        if association_job is not None:
+            response_data["account_association"] = {"status": "pending", "status_url": f"/contact/{new_contact_id}/account"}
+        return jsonify(response_data), 201
 
     except SalesforceGeneralError as e:
         logging.error(f"Error de Salesforce al crear: {e.code} - {e.content}")
@@ -260,6 +1541,411 @@ def create_contact():
         logging.error(f"Error inesperado al crear: {e}")
         return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
 
+@app.route('/contact/<contact_id>/account', methods=['GET'])
+def contact_account_status(contact_id):
+    """
+    Devuelve el estado de la asociación de la cuenta de un contacto.
+
+    Si la asociación se encoló en este proceso y sigue pendiente, espera hasta
+    `?wait=<segundos>` (máximo ACCOUNT_STATUS_MAX_WAIT) a que termine. En otro caso
+    se consulta el AccountId del contacto directamente en Salesforce, lo que cubre
+    trabajos encolados por otro worker.
+
+    Respuestas: 200 "associated" con "account_id"; 202 "pending"; 404 "not_associated".
+    """
+    if not re.fullmatch(r'[A-Za-z0-9]{15}|[A-Za-z0-9]{18}', contact_id):
+        return jsonify({"status": "error", "message": "El Id de contacto no es válido."}), 400
+
+    try:
+        wait = min(float(request.args.get('wait', 0)), ACCOUNT_STATUS_MAX_WAIT)
+    except ValueError:
+        return jsonify({"status": "error", "message": "El parámetro 'wait' debe ser numérico."}), 400
+
+    job = account_association_queue.get(contact_id)
+    if job is not None:
+        if wait > 0:
+            job.done.wait(wait)
+        if job.status == "pending":
+            return jsonify({"status": "pending", "contact_id": contact_id}), 202
+        if job.account_id:
+            return jsonify({"status": "associated", "contact_id": contact_id, "account_id": job.account_id}), 200
+
+    try:
+        sf = get_salesforce_connection()
+        result = sf.query(f"SELECT AccountId FROM Contact WHERE Id = {_escape_soql_str(contact_id)} LIMIT 1")
+        if result.get('totalSize', 0) == 0:
+            return jsonify({"status": "not_found", "message": "No se encontró el contacto."}), 404
+        account_id = result['records'][0].get('AccountId')
+        if account_id:
+            return jsonify({"status": "associated", "contact_id": contact_id, "account_id": account_id}), 200
+        return jsonify({"status": "not_associated", "contact_id": contact_id, "error": job.error if job else None}), 404
+    except SalesforceGeneralError as e:
+        logging.error(f"Error de Salesforce al consultar la cuenta del contacto: {e.code} - {e.content}")
+        return jsonify({"status": "error", "message": "Error de Salesforce.", "details": e.content}), 500
+    except Exception as e:
+        logging.error(f"Error inesperado al consultar la cuenta del contacto: {e}")
+        return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
+
+# --- Metadatos de sObjects ---
+CUSTOMER_SERVICE_REQUIRED_FIELDS = (
+    'AccountId',
+    'CallType__c',
+    'ParentezcoDelCliente__c',
+    'Fast_Note__c',
+    'UltimoAnioDeAyuda__c',
+    'Communication_channel__c',
+    'TipoCliente__c',
+    'TipoHumor_Cliente__c',
+)
+
+# Valores de respaldo mientras no se haya leído describe() de la organización.
+CUSTOMER_SERVICE_DEFAULT_PICKLISTS = {
+    'CallType__c': ['Inbone', 'Onbone'],
+    'ParentezcoDelCliente__c': ['Cliente', 'Familiar del Cliente', 'Amigo del Cliente', 'Agencia de Gobierno', 'Un tercero', 'eje realtor...'],
+    'UltimoAnioDeAyuda__c': ['2024', '2023', '2022', '2021', '2020', '2019', '2018', '2017 o antes'],
+    'Communication_channel__c': ['Text message', 'Phone', 'In person'],
+    'TipoCliente__c': ['Cliente Actual', 'Cliente Retorno', 'Cliente Nuevo'],
+    'TipoHumor_Cliente__c': [
+        'Enojado', 'Frustrado', 'Desesperado', 'Calmado', 'Feliz', 'Apático', 'Celoso', 'Nublado', 'Preocupado',
+        'Ansioso', 'Agradecido', 'Indeciso', 'Aliviado', 'Preparado', 'Impaciente', 'Inseguro', 'Interesado',
+        'Resuelto', 'Curioso', 'Avergonzado', 'Resentido', 'Resignado', 'Optimista', 'Motivado'
+    ],
+}
+
+class SObjectMetadataCache:
+    """
+    Validadores por sObject compilados desde describe(). Un hilo daemon (iniciado
+    al importar el módulo en cada worker de gunicorn) los carga y los refresca
+    cada `ttl` segundos; si describe falla se conserva el último validador y se
+    reintenta a los `retry_seconds`. `validator` nunca espera: mientras no haya
+    describe se usan los valores fijos.
+    """
+
+    def __init__(self, defaults: dict, ttl: float, retry_seconds: float):
+        self._validators = dict(defaults)
+        self.ttl = ttl
+        self.retry_seconds = retry_seconds
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        stats.register_gauge("sobject_metadata.age_seconds", self._age)
+
+    def _age(self) -> float:
+        loaded = [v.loaded_at for v in self._validators.values() if v.source == "describe"]
+        return round(time.time() - min(loaded), 1) if loaded else -1
+
+    def validator(self, sobject: str):
+        if SOBJECT_METADATA_ENABLED:
+            self.ensure_started()
+        validator = self._validators[sobject]
+        if validator.source != "describe":
+            stats.incr("sobject_metadata.default_rules_used")
+        return validator
+
+    def ensure_started(self):
+        # Se compara el pid para volver a iniciar el hilo si el módulo se importó
+        # antes del fork (gunicorn --preload): los hilos no sobreviven al fork.
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            threading.Thread(target=self._refresh_loop, name="sobject-metadata", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def refresh(self) -> bool:
+        """Vuelve a leer describe() de cada sObject; devuelve False si alguno falló."""
+        ok = True
+        sf = get_salesforce_connection()
+        for sobject in list(self._validators):
+            started = time.monotonic()
+            try:
+                self._validators[sobject] = compile_validator(getattr(sf, sobject).describe())
+                stats.observe("sobject_metadata.describe_seconds", time.monotonic() - started)
+            except Exception as e:
+                ok = False
+                stats.incr("sobject_metadata.refresh_failures")
+                logging.error(f"No se pudo leer describe() de {sobject}; se conservan las reglas anteriores: {e}")
+        return ok
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                ok = self.refresh()
+            except Exception as e:
+                ok = False
+                logging.error(f"Error al refrescar los metadatos de sObjects: {e}")
+            time.sleep(self.ttl if ok else self.retry_seconds)
+
+sobject_metadata = SObjectMetadataCache(
+    {
+        'Customer_Service__c': default_validator('Customer_Service__c', CUSTOMER_SERVICE_DEFAULT_PICKLISTS),
+        'Script_Case__c': default_validator('Script_Case__c'),
+    },
+    SOBJECT_METADATA_TTL,
+    SOBJECT_METADATA_RETRY_SECONDS,
+)
+
+# La carga inicial empieza con el worker, no con la primera petición.
+if SOBJECT_METADATA_ENABLED:
+    sobject_metadata.ensure_started()
+
+def validation_error_response(error: dict):
+    """Convierte el resultado de `SObjectValidator.check` en la respuesta 400 de la API."""
+    if "missing_fields" in error:
+        return jsonify({"status": "error", "message": f"Faltan los siguientes campos requeridos: {', '.join(error['missing_fields'])}"}), 400
+    return jsonify({
+        "status": "error",
+        "message": f"Valor invalido para el campo '{error['field']}' ",
+        "provided_value": error["provided_value"],
+        "allowed_values": error["allowed_values"]
+    }), 400
+
+# --- Escritura Diferida (Write-Behind) ---
+class WriteBehindBuffer:
+    """
+    Buffer durable de inserciones enviadas en lote con sObject Collections.
+
+    Diario en disco (WRITE_BEHIND_DIR):
+      pending/<dueño>-<clave>.json  registro aceptado y aún no creado
+      done/<clave>.json             creado (con su Id) o descartado tras fallar
+    `<dueño>` identifica al proceso, que mantiene bloqueado owners/<dueño>.lock
+    mientras vive. Al iniciar, un worker adopta los pendientes cuyo dueño ya no
+    tiene el bloqueo (proceso caído o reiniciado) renombrándolos a su nombre.
+
+    Los errores transitorios (o de transporte) se reintentan con espera
+    exponencial hasta `max_attempts`; los demás se registran como fallidos.
+    Con `max_buffered` registros en memoria, `submit` rechaza los nuevos.
+
+    El diario solo es tan durable como WRITE_BEHIND_DIR: sobre el /tmp de Cloud
+    Run los pendientes se pierden cuando la instancia se detiene.
+    """
+
+    TRANSIENT_ERRORS = {"UNABLE_TO_LOCK_ROW", "SERVER_UNAVAILABLE", "REQUEST_LIMIT_EXCEEDED", "API_CURRENTLY_DISABLED"}
+
+    def __init__(self, directory: str, batch_size: int, flush_seconds: float, max_attempts: int, retry_seconds: float, max_buffered: int):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.max_buffered = max_buffered
+        self.owner = uuid.uuid4().hex[:12]
+        self._entries = []
+        self._last_sweep = 0.0
+        self._cond = threading.Condition()
+        self._started = False
+        self._owner_lock = None
+        stats.register_gauge("write_behind.buffered", lambda: len(self._entries))
+        stats.register_gauge("write_behind.oldest_seconds", self._oldest_age)
+
+    # --- Diario ---
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.directory, kind, name)
+
+    def _write_json(self, path: str, payload: dict):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+
+    def _pending_path(self, entry: dict) -> str:
+        return self._path("pending", f"{self.owner}-{entry['key']}.json")
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._cond:
+            if self._started:
+                return
+            for kind in ("pending", "done", "owners"):
+                os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+            self._owner_lock = open(self._path("owners", f"{self.owner}.lock"), "w")
+            fcntl.flock(self._owner_lock, fcntl.LOCK_EX)
+            self._adopt_orphans()
+            threading.Thread(target=self._flush_loop, name="write-behind", daemon=True).start()
+            self._started = True
+
+    def _owner_alive(self, owner: str) -> bool:
+        try:
+            with open(self._path("owners", f"{owner}.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            os.remove(self._path("owners", f"{owner}.lock"))
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _adopt_orphans(self):
+        for name in sorted(os.listdir(os.path.join(self.directory, "pending"))):
+            owner, _, rest = name.partition("-")
+            if owner == self.owner or not name.endswith(".json") or self._owner_alive(owner):
+                continue
+            try:
+                os.rename(self._path("pending", name), self._path("pending", f"{self.owner}-{rest}"))
+                with open(self._path("pending", f"{self.owner}-{rest}"), encoding="utf-8") as f:
+                    self._entries.append(json.load(f))
+                stats.incr("write_behind.recovered")
+            except (OSError, ValueError):
+                continue  # Otro worker lo adoptó primero.
+        if self._entries:
+            logging.info(f"Write-behind: {len(self._entries)} registro(s) pendiente(s) recuperado(s) del diario.")
+
+    # --- API ---
+    def submit(self, sobject: str, payload: dict):
+        """
+        Guarda el registro en el diario y lo encola; devuelve la clave de
+        seguimiento, o None si el buffer está lleno (Salesforce no da abasto).
+        """
+        self._ensure_started()
+        if len(self._entries) >= self.max_buffered:
+            stats.incr("write_behind.rejected_full")
+            return None
+        entry = {
+            "key": uuid.uuid4().hex, "sobject": sobject, "payload": payload,
+            "accepted_at": time.time(), "attempts": 0, "next_attempt_at": 0, "last_error": None,
+        }
+        self._write_json(self._pending_path(entry), entry)
+        with self._cond:
+            self._entries.append(entry)
+            if len(self._entries) >= self.batch_size:
+                self._cond.notify()
+        stats.incr("write_behind.accepted")
+        return entry["key"]
+
+    def status(self, key: str) -> dict:
+        """Estado de un registro según el diario compartido (lo responde cualquier worker)."""
+        try:
+            with open(self._path("done", f"{key}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        pending_dir = os.path.join(self.directory, "pending")
+        if os.path.isdir(pending_dir) and any(name.endswith(f"-{key}.json") for name in os.listdir(pending_dir)):
+            return {"key": key, "status": "pending"}
+        return {"key": key, "status": "unknown"}
+
+    def _oldest_age(self) -> float:
+        entries = self._entries
+        return round(time.time() - min(entry["accepted_at"] for entry in entries), 1) if entries else 0.0
+
+    # --- Envío ---
+    def _take_due_batch(self) -> list:
+        now = time.time()
+        due = [entry for entry in self._entries if entry["next_attempt_at"] <= now]
+        if not due:
+            return []
+        oldest_wait = now - min(entry["accepted_at"] if not entry["attempts"] else entry["next_attempt_at"] for entry in due)
+        if len(due) < self.batch_size and oldest_wait < self.flush_seconds:
+            return []
+        batch = due[:self.batch_size]
+        taken = {entry["key"] for entry in batch}
+        self._entries = [entry for entry in self._entries if entry["key"] not in taken]
+        return batch
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                batch = self._take_due_batch()
+                if not batch:
+                    self._cond.wait(timeout=min(self.flush_seconds, 1.0))
+                    continue
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        started = time.monotonic()
+        payload = {
+            "allOrNone": False,
+            "records": [{"attributes": {"type": entry["sobject"]}, **entry["payload"]} for entry in batch],
+        }
+        try:
+            results = get_salesforce_connection().restful("composite/sobjects", method="POST", json=payload)
+            if not isinstance(results, list) or len(results) != len(batch):
+                raise ValueError(f"respuesta inesperada de sObject Collections: {results}")
+        except Exception as e:
+            logging.error(f"Write-behind: falló el envío de un lote de {len(batch)} registro(s): {e}")
+            stats.incr("write_behind.failed_batches")
+            results = [{"success": False, "errors": [{"statusCode": "TRANSPORT_ERROR", "message": str(e)}]}] * len(batch)
+
+        stats.observe("write_behind.flush_seconds", time.monotonic() - started)
+        stats.observe("write_behind.batch_records", len(batch))
+        for entry, result in zip(batch, results):
+            if result.get("success"):
+                self._finish(entry, {"key": entry["key"], "status": "created", "sobject": entry["sobject"], "id": result["id"]})
+                stats.incr("write_behind.created")
+                stats.observe("write_behind.lag_seconds", time.time() - entry["accepted_at"])
+                continue
+
+            errors = result.get("errors", [])
+            entry["attempts"] += 1
+            entry["last_error"] = errors
+            codes = {error.get("statusCode") for error in errors}
+            retryable = bool(codes & (self.TRANSIENT_ERRORS | {"TRANSPORT_ERROR"}))
+            if retryable and entry["attempts"] < self.max_attempts:
+                entry["next_attempt_at"] = time.time() + min(self.retry_seconds * 2 ** (entry["attempts"] - 1), 300)
+                self._write_json(self._pending_path(entry), entry)
+                with self._cond:
+                    self._entries.append(entry)
+                stats.incr("write_behind.retried")
+            else:
+                logging.error(f"Write-behind: {entry['sobject']} {entry['key']} descartado tras {entry['attempts']} intento(s): {errors}")
+                self._finish(entry, {"key": entry["key"], "status": "failed", "sobject": entry["sobject"], "errors": errors, "payload": entry["payload"]})
+                stats.incr("write_behind.failed")
+
+    def _finish(self, entry: dict, result: dict):
+        result["finished_at"] = time.time()
+        self._write_json(self._path("done", f"{entry['key']}.json"), result)
+        try:
+            os.remove(self._pending_path(entry))
+        except FileNotFoundError:
+            pass
+        self._sweep_results()
+
+    def _sweep_results(self):
+        now = time.time()
+        if now - self._last_sweep < 3600:
+            return
+        self._last_sweep = now
+        done_dir = os.path.join(self.directory, "done")
+        for name in os.listdir(done_dir):
+            path = os.path.join(done_dir, name)
+            try:
+                if now - os.path.getmtime(path) > WRITE_BEHIND_RESULT_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+write_behind = WriteBehindBuffer(
+    WRITE_BEHIND_DIR, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_MAX_ATTEMPTS, WRITE_BEHIND_RETRY_SECONDS,
+    WRITE_BEHIND_MAX_BUFFERED,
+)
+
+def submit_write_behind(sobject: str, payload: dict):
+    """
+    Encola el registro si la escritura diferida está activa; devuelve la clave o
+    None para crearlo en línea (desactivada, buffer lleno o error del diario).
+    """
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    try:
+        return write_behind.submit(sobject, payload)
+    except OSError as e:
+        logging.error(f"Write-behind: no se pudo guardar en el diario, se crea en línea: {e}")
+        stats.incr("write_behind.journal_errors")
+        return None
+
+@app.route('/write-behind/<key>', methods=['GET'])
+def write_behind_status(key):
+    """
+    Estado de un registro aceptado con escritura diferida: "pending", "created"
+    (con "id"), "failed" (con "errors") o "unknown".
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', key):
+        return jsonify({"status": "error", "message": "La clave de seguimiento no es válida."}), 400
+    result = write_behind.status(key)
+    return jsonify(result), 404 if result["status"] == "unknown" else 200
+
 @app.route('/customer_service/create', methods=['POST'])
 def create_customer_service_case():
     """
@@ -274,51 +1960,29 @@ def create_customer_service_case():
         return jsonify({"status": "error", "message": "El cuerpo de la petición no puede estar vacío."}), 400
     
     #1. Validacion de Campos requeridos
-    required_fields = [
-        'AccountId', 
-        'CallType__c',
-        'ParentezcoDelCliente__c',
-        'Fast_Note__c',
-        'UltimoAnioDeAyuda__c',
-        'Communication_channel__c',
-        'TipoCliente__c',
-        'TipoHumor_Cliente__c'
-    ]
-
-    missing_fields = [field for field in required_fields if field not in data]
+    missing_fields = [field for field in CUSTOMER_SERVICE_REQUIRED_FIELDS if field not in data]
     if missing_fields:
         return jsonify({"status": "error", "message": f"Faltan los siguientes campos requeridos: {', '.join(missing_fields)}"}), 400
 
-    #2. Validacion de valores picklists
-    picklists_validations = {
-        'CallType__c': ['Inbone', 'Onbone'],
-        'ParentezcoDelCliente__c': ['Cliente', 'Familiar del Cliente', 'Amigo del Cliente', 'Agencia de Gobierno', 'Un tercero', 'eje realtor...'],
-        'UltimoAnioDeAyuda__c': ['2024', '2023', '2022', '2021', '2020', '2019', '2018', '2017 o antes'],
-        'Communication_channel__c': ['Text message', 'Phone', 'In person'],
-        'TipoCliente__c': ['Cliente Actual', 'Cliente Retorno', 'Cliente Nuevo'],
-        'TipoHumor_Cliente__c':[
-            'Enojado', 'Frustrado', 'Desesperado', 'Calmado', 'Feliz', 'Apático', 'Celoso', 'Nublado', 'Preocupado',
-            'Ansioso', 'Agradecido', 'Indeciso', 'Aliviado', 'Preparado', 'Impaciente', 'Inseguro', 'Interesado',
-            'Resuelto', 'Curioso', 'Avergonzado', 'Resentido', 'Resignado', 'Optimista', 'Motivado'
-        ]
-    }
-
-    for field, valid_values in picklists_validations.items():
-        if data.get(field) not in valid_values:
-            return jsonify({
-                "status": "error", 
-                "message": f"Valor invalido para el campo '{field}' ",
-                "provided_value": data[field],
-                "allowed_values": valid_values    
-            }), 400
-
-    # 3. Prepara el payload para Salesforce
+    # 2. Prepara el payload para Salesforce
     salesforce_payload = data.copy()
     #Mapeamos AccountId a Account__c para la relacion
     salesforce_payload['Account__c'] = salesforce_payload.pop('AccountId')
 
+    # 3. Validacion de picklists y requeridos según describe() de la organización
+    error = sobject_metadata.validator('Customer_Service__c').check(salesforce_payload, aliases={'Account__c': 'AccountId'})
+    if error:
+        return validation_error_response(error)
+
     logging.info(f"Petición para crear Customer_Service__c con datos: {salesforce_payload}")
 
+    # La conversación no depende del Id: con escritura diferida se responde de inmediato.
+    tracking_key = submit_write_behind('Customer_Service__c', salesforce_payload)
+    if tracking_key:
+        return jsonify({
+            "status": "accepted", "tracking_key": tracking_key, "status_url": f"/write-behind/{tracking_key}", "customer_service": data
+        }), 202
+
     try: 
         # 4. Crear el registro en salesforce
         customer_service_object = getattr(sf, 'Customer_Service__c')
@@ -352,6 +2016,26 @@ def create_customer_service_case():
             "message": "Ocurrió un error inesperado."
         }), 500
 
+def query_contact_by_dob(sf, full_name: str, dob: str):
+    """
+    Busca un contacto por nombre completo y fecha de nacimiento (ya validada como
+    YYYY-MM-DD) y guarda el resultado en la caché. Devuelve el contacto o None.
+    """
+    safe_full_name = _escape_soql_str(full_name)
+    # El literal de fecha se usa directamente, ya que SOQL no requiere comillas para este tipo de dato.
+    safe_dob = dob
+
+    # Se usa el campo 'Name' que es un campo compuesto y generalmente indexado.
+    query = (
+        f"SELECT Id, FirstName, LastName, Email, DOB__c FROM Contact "
+        f"WHERE Name = {safe_full_name} AND DOB__c = {safe_dob} LIMIT 1"
+    )
+    logging.info(f"Ejecutando SOQL de verificación: {query}")
+    result = sf.query(query)
+    contact = result['records'][0] if result.get('totalSize', 0) > 0 else None
+    contact_cache.store_result(full_name, f"dob:{dob}", contact)
+    return contact
+
 @app.route('/contact/verify/dob', methods=['POST'])
 def verify_contact_by_dob():
     """
@@ -383,24 +2067,23 @@ def verify_contact_by_dob():
             # No se cachea un error de formato de entrada, ya que es un error del cliente.
             return jsonify({"status": "error", "message": "El formato de 'dob' no es válido. Se esperaba YYYY-MM-DD."}), 400
 
-        # Paso 5: Preparar los datos para la consulta SOQL, usando el campo 'Name'.
-        safe_full_name = _escape_soql_str(full_name)
-        # El literal de fecha se usa directamente, ya que SOQL no requiere comillas para este tipo de dato.
-        safe_dob = dob  # dob ya está validado como YYYY-MM-DD
-
-        # Paso 6: Construir y ejecutar la consulta SOQL.
-        # Se usa el campo 'Name' que es un campo compuesto y generalmente indexado.
-        query = (
-            f"SELECT Id, FirstName, LastName, Email, DOB__c FROM Contact "
-            f"WHERE Name = {safe_full_name} AND DOB__c = {safe_dob} LIMIT 1"
-        )
-        logging.info(f"Ejecutando SOQL de verificación: {query}")
-        result = sf.query(query)
-
-        # Paso 7: Procesar el resultado, guardarlo en caché y devolver la respuesta.
-        if result.get('totalSize', 0) > 0:
+        # Paso 5: Consultar la caché. Un contacto ya encontrado por nombre con la
+        # misma fecha de nacimiento verifica sin consultar a Salesforce.
+        cached, contact = mirror_lookup(full_name, dob=dob)
+        if not cached:
+            cached, contact = contact_cache.lookup("verify_dob", full_name, f"dob:{dob}")
+        found_contact = contact_cache.peek(full_name, "find")
+        if not cached and found_contact and found_contact.get('DOB__c') == dob:
+            cached, contact = True, found_contact
+            stats.incr("contact_cache.verify_dob.from_find")
+
+        if not cached:
+            # Paso 6: Consultar Salesforce por nombre y fecha de nacimiento.
+            contact = query_contact_by_dob(sf, full_name, dob)
+
+        # Paso 7: Procesar el resultado y devolver la respuesta.
+        if contact:
             # Si se encuentra un registro, la verificación es exitosa.
-            contact = result['records'][0]
             logging.info(f"Verificación exitosa para contacto: {contact['Id']}")
             response_data = {"status": "verified", "contact": contact}
             status_code = 200
@@ -423,8 +2106,9 @@ def verify_contact_by_dob():
 def verify_contact_by_phone():
     """
     Verifica un contacto por nombre completo, fecha de nacimiento (DOB) y teléfono.
-    Usa el campo 'Name' para una búsqueda más eficiente y compara el teléfono
-    ignorando caracteres de formato (espacios, guiones, etc.).
+    El teléfono se compara por su clave E.164, ignorando caracteres de formato:
+    en la consulta si hay PHONE_INDEX_FIELD o, si no, sobre los contactos que
+    coinciden en nombre y DOB.
     Espera un JSON: {"full_name": "Nombre Apellido", "dob": "YYYY-MM-DD", "phone": "1234567890"}
     """
     # Paso 1: Obtener la conexión a Salesforce y los datos de entrada.
@@ -448,35 +2132,50 @@ def verify_contact_by_phone():
         except ValueError:
             return jsonify({"status": "error", "message": "El formato de 'dob' no es válido. Se esperaba YYYY-MM-DD."}), 400
 
-        # Paso 4: Preparar los datos para la consulta SOQL.
-        safe_full_name = _escape_soql_str(full_name)
-        safe_dob = dob  # dob ya está validado como YYYY-MM-DD
-
-        # Paso 5: Buscar contactos que coincidan con nombre y fecha de nacimiento.
-        # Se usa el campo 'Name' que está indexado. El teléfono se recupera para ser
-        # verificado en Python, permitiendo ignorar diferencias de formato.
-        query = (
-            f"SELECT Id, FirstName, LastName, Email, DOB__c, Phone FROM Contact "
-            f"WHERE Name = {safe_full_name} AND DOB__c = {safe_dob}"
-        )
-        logging.info(f"Ejecutando SOQL de verificación (Nombre y DOB): {query}")
-        result = sf.query(query)
-
-        # Paso 6: Procesar el resultado y verificar el teléfono.
-        if result.get('totalSize', 0) > 0:
-            # Normalizar el número de teléfono de entrada (quitar caracteres no numéricos).
-            input_phone_normalized = re.sub(r'\D', '', phone)
-
-            # Iterar sobre los resultados y comparar los teléfonos normalizados.
-            for contact in result['records']:
-                sf_phone = contact.get('Phone')
-                if sf_phone:
-                    sf_phone_normalized = re.sub(r'\D', '', sf_phone)
-                    if sf_phone_normalized == input_phone_normalized:
-                        logging.info(f"Verificación exitosa para contacto: {contact['Id']}")
-                        return jsonify({"status": "verified", "contact": contact}), 200
-            
-            # Si el bucle termina, se encontraron contactos por nombre/DOB pero el teléfono no coincidió.
+        # Paso 4: Buscar el contacto por nombre, fecha de nacimiento y clave de teléfono,
+        # primero en la caché.
+        phone_key = phone_index_key(phone) or re.sub(r'\D', '', phone)
+        name_dob_contact = None
+        cached, contact = mirror_lookup(full_name, dob=dob, phone_key=phone_key)
+        if not cached:
+            cached, contact = contact_cache.lookup("verify_dob_phone", full_name, f"dob_phone:{dob}:{phone_key}")
+        if not cached:
+            safe_full_name = _escape_soql_str(full_name)
+            if PHONE_INDEX_FIELD:
+                # Paso 5a: Igualdad sobre la clave indexada en la misma consulta.
+                where = f"Name = {safe_full_name} AND DOB__c = {dob}"
+                contacts = find_contacts_by_phone_key(sf, phone_key, where=where) if phone_key else []
+            else:
+                # Paso 5b: Sin campo indexado se consulta por nombre y DOB (SOQL, siempre
+                # al día, a diferencia del índice de SOSL) y el teléfono se compara en
+                # Python por su clave E.164 en ambos lados.
+                query = (
+                    f"SELECT {PHONE_CONTACT_FIELDS} FROM Contact "
+                    f"WHERE Name = {safe_full_name} AND DOB__c = {dob}"
+                )
+                logging.info(f"Ejecutando SOQL de verificación (Nombre y DOB): {query}")
+                records = sf.query(query).get('records', [])
+                name_dob_contact = records[0] if records else None
+                contacts = [record for record in records if _phone_matches(record, phone_key)]
+            contact = contacts[0] if contacts else None
+            contact_cache.store_result(full_name, f"dob_phone:{dob}:{phone_key}", contact)
+
+        # Paso 6: Procesar el resultado.
+        if contact:
+            logging.info(f"Verificación exitosa para contacto: {contact['Id']}")
+            return jsonify({"status": "verified", "contact": contact}), 200
+
+        # Para distinguir un teléfono incorrecto de un nombre/DOB incorrecto se consulta
+        # nombre y DOB (normalmente ya en caché por la verificación previa por DOB).
+        if name_dob_contact is None:
+            cached, name_dob_contact = mirror_lookup(full_name, dob=dob)
+            if not cached:
+                cached, name_dob_contact = contact_cache.lookup("verify_dob", full_name, f"dob:{dob}")
+            if not cached:
+                name_dob_contact = query_contact_by_dob(sf, full_name, dob)
+
+        if name_dob_contact:
+            # Se encontraron contactos por nombre/DOB pero el teléfono no coincidió.
             logging.warning(f"Verificación fallida para '{full_name}'. Se encontraron contactos por nombre/DOB pero el teléfono no coincidió.")
             return jsonify({"status": "not_verified", "message": "Los datos de nombre y fecha de nacimiento son correctos, pero el número de teléfono no coincide."}), 404
         else:
@@ -519,7 +2218,19 @@ def create_script_case():
     if account_id:
         salesforce_payload['Account__c'] = account_id
 
+    error = sobject_metadata.validator('Script_Case__c').check(salesforce_payload, aliases={'Contact__c': 'ContactId', 'Account__c': 'AccountId'})
+    if error:
+        return validation_error_response(error)
+
     logging.info(f"Petición para crear Script_Case__c con datos: {salesforce_payload}")
+
+    tracking_key = submit_write_behind('Script_Case__c', salesforce_payload)
+    if tracking_key:
+        accepted_case = {**case_data}
+        if contact_id: accepted_case['ContactId'] = contact_id
+        if account_id: accepted_case['AccountId'] = account_id
+        return jsonify({"status": "accepted", "tracking_key": tracking_key, "status_url": f"/write-behind/{tracking_key}", "case": accepted_case}), 202
+
     try:
         # Usamos getattr para acceder al objeto dinámicamente por su nombre de API.
         script_case_object = getattr(sf, 'Script_Case__c')
@@ -546,6 +2257,10 @@ def create_script_case():
         logging.error(f"Error inesperado al crear Script_Case__c: {e}")
         return jsonify({"status": "error", "message": "Ocurrió un error inesperado."}), 500
 
+@app.route('/stats', methods=['GET'])
+def runtime_stats():
+    """Devuelve las estadísticas de ejecución del worker que atiende la petición."""
+    return jsonify(stats.snapshot()), 200
 
 if __name__ == "__main__":
    
@@ -0,0 +1,107 @@
+"""
+Benchmark del índice local de nombres (name_index.NameIndex).
+
+Genera contactos sintéticos con nombres hispanos (con y sin acentos, uno o
+dos apellidos), construye el índice y mide la memoria que ocupa y la latencia
+de búsqueda con consultas como las que llegan por voz: sin acentos, sin el
+segundo apellido, en otro orden o con una letra cambiada. No contacta a
+Salesforce.
+
+Uso:
+    python benchmark_name_index.py --contacts 100000 --queries 2000
+"""
+import argparse
+import random
+import statistics
+import time
+import tracemalloc
+
+from name_index import NameIndex, fold_name
+
+FIRST_NAMES = [
+    "José", "María", "Juan", "Ana", "Luis", "Sofía", "Carlos", "Lucía", "Jorge", "Valentina",
+    "Miguel", "Camila", "Andrés", "Daniela", "Fernando", "Mariana", "Ramón", "Verónica", "Raúl", "Inés",
+    "Héctor", "Mónica", "Óscar", "Gabriela", "Martín", "Julián", "Esteban", "Natalia", "Tomás", "Rocío",
+]
+LAST_NAMES = [
+    "García", "Hernández", "López", "Martínez", "González", "Pérez", "Rodríguez", "Sánchez", "Ramírez", "Cruz",
+    "Flores", "Gómez", "Morales", "Vázquez", "Jiménez", "Reyes", "Díaz", "Torres", "Gutiérrez", "Ruiz",
+    "Mendoza", "Aguilar", "Ortiz", "Castillo", "Moreno", "Chávez", "Rivera", "Juárez", "Domínguez", "Núñez",
+    "Ibáñez", "Salazar", "Herrera", "Medina", "Castro", "Vargas", "Ramos", "Romero", "Navarro", "Guzmán",
+]
+
+
+def synthetic_contacts(count: int, rng: random.Random) -> list:
+    contacts = []
+    for i in range(count):
+        surnames = rng.sample(LAST_NAMES, rng.choice((1, 2)))
+        contacts.append({
+            "Id": f"003{i:015d}",
+            "FirstName": rng.choice(FIRST_NAMES),
+            "LastName": " ".join(surnames),
+            "DOB__c": f"19{rng.randint(40, 99)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        })
+    return contacts
+
+
+def dictated_variant(contact: dict, rng: random.Random) -> str:
+    """Simula cómo llega el nombre transcrito por voz."""
+    words = f"{contact['FirstName']} {contact['LastName']}".split()
+    variant = rng.choice(("sin_acentos", "sin_segundo_apellido", "orden", "letra"))
+    if variant == "sin_segundo_apellido" and len(words) > 2:
+        words = words[:2]
+    elif variant == "orden":
+        words = words[1:] + words[:1]
+    elif variant == "letra":
+        word = rng.randrange(len(words))
+        pos = rng.randrange(len(words[word]))
+        words[word] = words[word][:pos] + rng.choice("sczbv") + words[word][pos + 1:]
+    return fold_name(" ".join(words))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contacts", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    contacts = synthetic_contacts(args.contacts, rng)
+
+    index = NameIndex()
+    tracemalloc.start()
+    started = time.perf_counter()
+    index.replace_all(contacts)
+    build_seconds = time.perf_counter() - started
+    index_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples = [rng.choice(contacts) for _ in range(args.queries)]
+    latencies, top1, top5 = [], 0, 0
+    for contact in samples:
+        query = dictated_variant(contact, rng)
+        started = time.perf_counter()
+        candidates = index.search(query, limit=5)
+        latencies.append((time.perf_counter() - started) * 1000)
+        # Hay muchos homónimos: se considera acierto un candidato con el mismo nombre.
+        expected = sorted(fold_name(f"{contact['FirstName']} {contact['LastName']}").split())
+        names = [sorted(fold_name(candidate["contact"]["Name"]).split()) for candidate in candidates]
+        top1 += bool(names) and names[0] == expected
+        top5 += expected in names
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    print(f"Contactos:            {len(index):,}")
+    print(f"Construcción:         {build_seconds:.2f} s")
+    print(f"Memoria del índice:   {index_bytes / 1024 / 1024:.1f} MiB ({index_bytes / len(index):.0f} B/contacto)")
+    print(f"Búsquedas:            {len(latencies):,}")
+    print(f"Latencia (ms):        p50={percentile(50):.2f} p95={percentile(95):.2f} p99={percentile(99):.2f} media={statistics.mean(latencies):.2f}")
+    print(f"Nombre correcto top 1: {top1 / len(samples):.1%}")
+    print(f"Nombre correcto top 5: {top5 / len(samples):.1%}")
+
+
+if __name__ == "__main__":
+    main()
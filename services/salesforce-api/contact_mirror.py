@@ -0,0 +1,241 @@
+"""
+Réplica local de los Contactos de Salesforce para lecturas sin llamadas a la API.
+
+`ContactMirror` guarda en memoria los campos que lee salesforce-api, indexados
+por Id y por nombre (sin distinguir mayúsculas, igual que `Name =` en SOQL).
+`ContactMirrorSync` la llena con una consulta completa y la mantiene al día con
+los recursos Get Updated / Get Deleted de la REST API. Con instantánea en disco,
+los procesos que la comparten hacen una sola carga completa: el que toma el
+bloqueo `<instantánea>.lock` consulta a Salesforce y los demás esperan y cargan
+el archivo que deja.
+
+El objeto `sf` que reciben las funciones de sincronización solo necesita
+`query_all_iter(soql)`, `Contact.updated(start, end)` y `Contact.deleted(start, end)`,
+de modo que puede sustituirse por un Salesforce falso (ver pruebas-contact-mirror.py).
+"""
+import datetime
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+MIRROR_FIELDS = ("Id", "FirstName", "LastName", "Name", "Email", "AccountId", "DOB__c", "Phone")
+MIRROR_QUERY = f"SELECT {', '.join(MIRROR_FIELDS)} FROM Contact"
+_NAME = MIRROR_FIELDS.index("Name")
+
+# Get Updated / Get Deleted solo cubren los últimos 30 días y trabajan por minutos.
+REPLICATION_MAX_AGE = datetime.timedelta(days=29)
+REPLICATION_MIN_WINDOW = datetime.timedelta(minutes=1)
+# Margen para cambios hechos mientras corre la carga completa.
+BOOTSTRAP_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def _name_key(name: str) -> str:
+    return (name or "").strip().casefold()
+
+
+def _parse_sf_datetime(value: str) -> datetime.datetime:
+    """'2026-10-18T15:40:00.000+0000' -> datetime con zona horaria."""
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+class ContactMirror:
+    """
+    Contactos en memoria como tuplas de MIRROR_FIELDS. Los `listeners` reciben
+    `upsert(contact)` y `remove(contact_id)` por cada cambio (p. ej. el índice de
+    nombres), y `replace_all(contacts)` tras una carga completa.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}   # Id -> tupla
+        self._by_name = {}   # nombre normalizado -> [Id, ...]
+        self.listeners = []
+        self.synced_through = None  # datetime cubierto por la última sincronización
+        self.last_sync_at = None    # time.time() de la última sincronización exitosa
+
+    def _index(self, record: tuple):
+        self._records[record[0]] = record
+        self._by_name.setdefault(_name_key(record[_NAME]), []).append(record[0])
+
+    def _unindex(self, contact_id: str):
+        record = self._records.pop(contact_id, None)
+        if record is not None:
+            key = _name_key(record[_NAME])
+            ids = self._by_name.get(key, [])
+            if contact_id in ids:
+                ids.remove(contact_id)
+            if not ids:
+                self._by_name.pop(key, None)
+
+    @staticmethod
+    def _to_record(contact: dict) -> tuple:
+        if not contact.get("Name"):
+            contact = dict(contact, Name=f"{contact.get('FirstName') or ''} {contact.get('LastName') or ''}".strip())
+        return tuple(contact.get(field) for field in MIRROR_FIELDS)
+
+    def replace_all(self, contacts, synced_through: datetime.datetime):
+        records = [self._to_record(contact) for contact in contacts]
+        with self._lock:
+            self._records, self._by_name = {}, {}
+            for record in records:
+                self._index(record)
+            self.synced_through, self.last_sync_at = synced_through, time.time()
+        for listener in self.listeners:
+            listener.replace_all(self.iter_contacts())
+
+    def apply_changes(self, updated: list, deleted_ids: list, synced_through: datetime.datetime):
+        with self._lock:
+            for contact_id in deleted_ids:
+                self._unindex(contact_id)
+            for contact in updated:
+                self._unindex(contact["Id"])
+                self._index(self._to_record(contact))
+            self.synced_through, self.last_sync_at = synced_through, time.time()
+        for listener in self.listeners:
+            for contact_id in deleted_ids:
+                listener.remove(contact_id)
+            for contact in updated:
+                listener.upsert(contact)
+
+    def upsert(self, contact: dict):
+        """Agrega un contacto escrito por esta API sin esperar a la siguiente sincronización."""
+        with self._lock:
+            self._unindex(contact["Id"])
+            self._index(self._to_record(contact))
+        for listener in self.listeners:
+            listener.upsert(contact)
+
+    def find_by_name(self, full_name: str) -> list:
+        with self._lock:
+            return [dict(zip(MIRROR_FIELDS, self._records[contact_id])) for contact_id in self._by_name.get(_name_key(full_name), ())]
+
+    def get(self, contact_id: str):
+        record = self._records.get(contact_id)
+        return dict(zip(MIRROR_FIELDS, record)) if record else None
+
+    def iter_contacts(self):
+        with self._lock:
+            records = list(self._records.values())
+        return (dict(zip(MIRROR_FIELDS, record)) for record in records)
+
+    def age_seconds(self):
+        return time.time() - self.last_sync_at if self.last_sync_at else None
+
+    def __len__(self):
+        return len(self._records)
+
+    # --- Instantánea en disco ---
+    def save_snapshot(self, path: str):
+        """Escribe los registros y el punto de sincronización de forma atómica (archivo temporal + os.replace)."""
+        with self._lock:
+            payload = {"synced_through": self.synced_through.isoformat(), "fields": MIRROR_FIELDS, "records": list(self._records.values())}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: str) -> bool:
+        """Carga una instantánea compatible; devuelve False si no existe o no sirve."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                payload = json.load(f)
+            if tuple(payload["fields"]) != MIRROR_FIELDS:
+                return False
+            contacts = [dict(zip(MIRROR_FIELDS, record)) for record in payload["records"]]
+            self.replace_all(contacts, datetime.datetime.fromisoformat(payload["synced_through"]))
+            # La frescura es la de la instantánea, no la del momento de cargarla.
+            self.last_sync_at = os.path.getmtime(path)
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"No se pudo cargar la instantánea de contactos '{path}': {e}")
+            return False
+
+
+class ContactMirrorSync:
+    """
+    Sincroniza una `ContactMirror` con Salesforce: carga completa la primera vez
+    (o si el punto de sincronización tiene más de 29 días) y después, en cada
+    `sync_once`, pide los Id modificados y eliminados desde `synced_through` y
+    vuelve a consultar solo los modificados.
+    """
+
+    def __init__(self, mirror: ContactMirror, id_chunk_size: int = 300, snapshot_path: str = "", clock=None):
+        self.mirror = mirror
+        self.id_chunk_size = id_chunk_size
+        self.snapshot_path = snapshot_path
+        # Reloj inyectable para pruebas con un Salesforce falso.
+        self.clock = clock or (lambda: datetime.datetime.now(datetime.timezone.utc))
+
+    def _now(self) -> datetime.datetime:
+        return self.clock().replace(microsecond=0)
+
+    def bootstrap(self, sf) -> int:
+        started = self._now() - BOOTSTRAP_OVERLAP
+        self.mirror.replace_all(sf.query_all_iter(MIRROR_QUERY), started)
+        self._save_snapshot()
+        return len(self.mirror)
+
+    def _fetch_by_ids(self, sf, ids: list) -> list:
+        contacts = []
+        for i in range(0, len(ids), self.id_chunk_size):
+            chunk = ids[i:i + self.id_chunk_size]
+            id_list = ", ".join(f"'{contact_id}'" for contact_id in chunk if contact_id.isalnum())
+            contacts.extend(sf.query_all_iter(f"{MIRROR_QUERY} WHERE Id IN ({id_list})"))
+        return contacts
+
+    def _needs_bootstrap(self) -> bool:
+        start = self.mirror.synced_through
+        return start is None or self._now() - start > REPLICATION_MAX_AGE
+
+    def _bootstrap_shared(self, sf) -> dict:
+        """
+        Carga completa coordinada entre procesos con flock sobre `<instantánea>.lock`.
+        Quien espera el bloqueo encuentra al obtenerlo la instantánea recién escrita
+        y la carga en lugar de repetir la consulta completa.
+        """
+        with open(f"{self.snapshot_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.snapshot_path) and self.mirror.load_snapshot(self.snapshot_path) and not self._needs_bootstrap():
+                    return {"mode": "snapshot", "contacts": len(self.mirror)}
+                return {"mode": "bootstrap", "contacts": self.bootstrap(sf)}
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sync_once(self, sf) -> dict:
+        """
+        Aplica los cambios desde la última sincronización. Devuelve un resumen con
+        el modo ("bootstrap", "snapshot", "incremental" o "skipped") y los conteos.
+        """
+        if self._needs_bootstrap():
+            if self.snapshot_path:
+                return self._bootstrap_shared(sf)
+            return {"mode": "bootstrap", "contacts": self.bootstrap(sf)}
+        start, end = self.mirror.synced_through, self._now()
+        if end - start < REPLICATION_MIN_WINDOW:
+            return {"mode": "skipped"}
+
+        updated = sf.Contact.updated(start, end)
+        deleted = sf.Contact.deleted(start, end)
+        updated_ids = updated.get("ids", [])
+        deleted_ids = [record["id"] for record in deleted.get("deletedRecords", [])]
+        # Se avanza solo hasta lo que ambos recursos confirman haber cubierto.
+        covered = min(
+            _parse_sf_datetime(updated["latestDateCovered"]) if updated.get("latestDateCovered") else end,
+            _parse_sf_datetime(deleted["latestDateCovered"]) if deleted.get("latestDateCovered") else end,
+        )
+        contacts = self._fetch_by_ids(sf, updated_ids) if updated_ids else []
+        self.mirror.apply_changes(contacts, deleted_ids, covered)
+        if contacts or deleted_ids:
+            self._save_snapshot()
+        return {"mode": "incremental", "updated": len(contacts), "deleted": len(deleted_ids)}
+
+    def _save_snapshot(self):
+        if self.snapshot_path:
+            try:
+                self.mirror.save_snapshot(self.snapshot_path)
+            except OSError as e:
+                logging.warning(f"No se pudo guardar la instantánea de contactos '{self.snapshot_path}': {e}")
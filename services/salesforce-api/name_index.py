@@ -0,0 +1,179 @@
+"""
+Índice local de nombres de contactos para búsquedas aproximadas.
+
+Los nombres se normalizan sin acentos ni mayúsculas y se indexan por palabra,
+de modo que el orden de las palabras no importa ("García López Ana" ==
+"ana garcia lopez"). Cada palabra de la consulta se compara por trigramas
+contra el vocabulario de palabras conocidas, así una palabra mal transcrita
+("Garsia") o un apellido faltante solo bajan la puntuación.
+
+No depende de Flask ni de Salesforce: `app.py` lo llena con los contactos y
+`benchmark_name_index.py` lo mide con datos sintéticos.
+"""
+import heapq
+import sys
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+
+# Campos del contacto que se guardan en el índice (como tupla, para ahorrar memoria).
+INDEX_FIELDS = ("Id", "Name", "DOB__c", "AccountId", "Phone")
+_DOB = INDEX_FIELDS.index("DOB__c")
+
+
+def fold_name(name: str) -> str:
+    """Quita acentos y signos, pasa a minúsculas y colapsa espacios: 'José  García-López' -> 'jose garcia lopez'."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    chars = [c if c.isalnum() else " " for c in decomposed if not unicodedata.combining(c)]
+    return " ".join("".join(chars).casefold().split())
+
+
+def word_trigrams(word: str) -> set:
+    """Trigramas con relleno (estilo pg_trgm): 'ana' -> {'  a', ' an', 'ana', 'na '}."""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Índice invertido palabra -> contactos, más un índice trigrama -> palabra
+    sobre el vocabulario para encontrar palabras parecidas.
+
+    La puntuación de un contacto combina:
+    - cobertura: suma de la similitud de la mejor palabra del contacto para
+      cada palabra de la consulta, dividida entre las palabras de la consulta
+      (tolera que a la consulta le falte un apellido);
+    - Jaccard por palabras: penaliza contactos con muchas palabras de más.
+    Un nombre con exactamente las mismas palabras puntúa 1.0.
+
+    Las actualizaciones de un contacto existente dejan el documento anterior
+    marcado como eliminado; el índice se compacta cuando esos huecos superan
+    `compact_ratio` del total.
+    """
+
+    def __init__(self, min_score: float = 0.5, word_similarity: float = 0.25, compact_ratio: float = 0.25):
+        self.min_score = min_score
+        self.word_similarity = word_similarity
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._docs = []                  # doc -> tupla INDEX_FIELDS, o None si se eliminó
+        self._word_counts = array("B")   # doc -> número de palabras distintas del nombre
+        self._postings = {}              # palabra -> array('I') de docs
+        self._word_grams = {}            # trigrama -> lista de palabras del vocabulario
+        self._doc_by_id = {}             # Id de Salesforce -> doc
+        self._deleted = 0
+
+    # --- Escritura ---
+    def _add(self, contact: dict):
+        full_name = contact.get("Name") or f"{contact.get('FirstName') or ''} {contact.get('LastName') or ''}".strip()
+        words = set(fold_name(full_name).split())
+        if not words:
+            return
+        doc = len(self._docs)
+        self._docs.append(tuple(
+            full_name if field == "Name" else (sys.intern(contact[field]) if field == "DOB__c" and contact.get(field) else contact.get(field))
+            for field in INDEX_FIELDS
+        ))
+        self._word_counts.append(min(len(words), 255))
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array("I")
+                for gram in word_trigrams(word):
+                    self._word_grams.setdefault(gram, []).append(word)
+            postings.append(doc)
+        self._doc_by_id[contact["Id"]] = doc
+
+    def _remove(self, contact_id: str):
+        doc = self._doc_by_id.pop(contact_id, None)
+        if doc is not None:
+            self._docs[doc] = None
+            self._deleted += 1
+
+    def _compact_if_needed(self):
+        if self._deleted and self._deleted > self.compact_ratio * len(self._docs):
+            live = [dict(zip(INDEX_FIELDS, doc)) for doc in self._docs if doc]
+            self._reset()
+            for contact in live:
+                self._add(contact)
+
+    def replace_all(self, contacts):
+        """Reconstruye el índice con `contacts` y lo publica de una vez."""
+        fresh = NameIndex(self.min_score, self.word_similarity, self.compact_ratio)
+        for contact in contacts:
+            fresh._add(contact)
+        with self._lock:
+            self._docs, self._word_counts, self._postings = fresh._docs, fresh._word_counts, fresh._postings
+            self._word_grams, self._doc_by_id, self._deleted = fresh._word_grams, fresh._doc_by_id, 0
+
+    def upsert(self, contact: dict):
+        """Agrega o actualiza un contacto (requiere 'Id' y 'Name' o 'FirstName'/'LastName')."""
+        with self._lock:
+            self._remove(contact["Id"])
+            self._add(contact)
+            self._compact_if_needed()
+
+    def remove(self, contact_id: str):
+        with self._lock:
+            self._remove(contact_id)
+            self._compact_if_needed()
+
+    # --- Lectura ---
+    def _similar_words(self, word: str) -> list:
+        """Palabras del vocabulario parecidas a `word`, como (similitud, palabra), de mayor a menor."""
+        if word in self._postings and len(word) < 3:
+            return [(1.0, word)]
+        grams = word_trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._word_grams.get(gram, ()))
+        matches = []
+        for candidate, common in shared.items():
+            similarity = common / (len(grams) + len(candidate) + 1 - common)  # una palabra de n letras tiene n + 1 trigramas
+            if similarity >= self.word_similarity:
+                matches.append((similarity, candidate))
+        matches.sort(reverse=True)
+        return matches
+
+    def search(self, full_name: str, limit: int = 5, dob: str = None) -> list:
+        """
+        Devuelve hasta `limit` candidatos `{"score", "contact"}` ordenados por
+        puntuación. Con `dob` solo se consideran contactos con esa fecha de nacimiento.
+        """
+        query_words = set(fold_name(full_name).split())
+        if not query_words:
+            return []
+
+        with self._lock:
+            scores = {}
+            for word in query_words:
+                best = {}
+                for similarity, candidate in self._similar_words(word):
+                    for doc in self._postings[candidate]:
+                        if doc not in best:
+                            best[doc] = similarity
+                for doc, similarity in best.items():
+                    scores[doc] = scores.get(doc, 0.0) + similarity
+
+            ranked = []
+            for doc, matched in scores.items():
+                contact = self._docs[doc]
+                if contact is None or (dob and contact[_DOB] != dob):
+                    continue
+                coverage = matched / len(query_words)
+                jaccard = matched / (len(query_words) + self._word_counts[doc] - matched)
+                score = 0.7 * coverage + 0.3 * jaccard
+                if score >= self.min_score:
+                    ranked.append((score, doc))
+
+            return [
+                {"score": round(score, 3), "contact": dict(zip(INDEX_FIELDS, self._docs[doc]))}
+                for score, doc in heapq.nlargest(limit, ranked)
+            ]
+
+    def __len__(self):
+        return len(self._doc_by_id)
@@ -0,0 +1,146 @@
+"""
+Pruebas de la réplica local de contactos (contact_mirror) contra un Salesforce falso.
+
+`FakeSalesforce` guarda contactos en memoria, registra cuándo se modificó o
+eliminó cada uno y responde como la REST API a `query_all_iter`,
+`Contact.updated` y `Contact.deleted`. El guion carga la réplica, aplica altas,
+cambios y bajas avanzando un reloj simulado, sincroniza de forma incremental y
+comprueba que la réplica coincide con el origen. Al final mide la carga y la
+latencia de lectura con N contactos sintéticos.
+
+Uso:
+    python pruebas-contact-mirror.py --contacts 100000
+"""
+import argparse
+import datetime
+import os
+import re
+import tempfile
+import time
+
+from contact_mirror import MIRROR_FIELDS, ContactMirror, ContactMirrorSync
+
+
+class FakeSObject:
+    def __init__(self, org):
+        self.org = org
+
+    @staticmethod
+    def _covered(end):
+        # Salesforce redondea al minuto y devuelve el instante cubierto en este formato.
+        return end.replace(second=0).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+
+    def updated(self, start, end):
+        self.org.calls["updated"] += 1
+        ids = [contact_id for contact_id, changed in self.org.modified.items() if start <= changed < end]
+        return {"ids": ids, "latestDateCovered": self._covered(end)}
+
+    def deleted(self, start, end):
+        self.org.calls["deleted"] += 1
+        records = [{"id": contact_id, "deletedDate": when.isoformat()} for contact_id, when in self.org.deleted.items() if start <= when < end]
+        return {"deletedRecords": records, "earliestDateAvailable": None, "latestDateCovered": self._covered(end)}
+
+
+class FakeSalesforce:
+    """Organización falsa con un reloj simulado (`now`) que avanza a mano."""
+
+    def __init__(self, now):
+        self.now = now
+        self.contacts, self.modified, self.deleted = {}, {}, {}
+        self.calls = {"query": 0, "updated": 0, "deleted": 0}
+        self.Contact = FakeSObject(self)
+
+    def upsert(self, contact):
+        self.contacts[contact["Id"]] = {field: contact.get(field) for field in MIRROR_FIELDS}
+        self.modified[contact["Id"]] = self.now
+
+    def delete(self, contact_id):
+        self.contacts.pop(contact_id, None)
+        self.deleted[contact_id] = self.now
+
+    def query_all_iter(self, soql):
+        self.calls["query"] += 1
+        ids = re.findall(r"'(\w+)'", soql.split("WHERE Id IN", 1)[1]) if "WHERE Id IN" in soql else None
+        for contact_id, contact in list(self.contacts.items()):
+            if ids is None or contact_id in ids:
+                yield {"attributes": {"type": "Contact"}, **contact}
+
+
+def contact(i, first="Ana", last="Pérez", dob="1990-01-02"):
+    return {"Id": f"003{i:015d}", "FirstName": first, "LastName": last, "Name": f"{first} {last}", "DOB__c": dob, "Phone": f"555{i:07d}"}
+
+
+def check(label, condition):
+    print(f"{'OK ' if condition else 'FALLA'} {label}")
+    if not condition:
+        raise SystemExit(1)
+
+
+def scenario():
+    clock = [datetime.datetime(2026, 10, 1, 12, 0, tzinfo=datetime.timezone.utc)]
+    # Contactos creados antes del margen que la carga completa vuelve a revisar.
+    org = FakeSalesforce(clock[0] - datetime.timedelta(hours=1))
+    for i in range(5):
+        org.upsert(contact(i, last=f"Pérez {i}"))
+    org.now = clock[0]
+
+    snapshot = os.path.join(tempfile.mkdtemp(), "contactos.json")
+    mirror = ContactMirror()
+    sync = ContactMirrorSync(mirror, snapshot_path=snapshot, clock=lambda: clock[0])
+    check("carga completa", sync.sync_once(org)["mode"] == "bootstrap" and len(mirror) == 5)
+    check("búsqueda sin distinguir mayúsculas", mirror.find_by_name("ANA PÉREZ 3")[0]["Id"] == contact(3)["Id"])
+    calls = dict(org.calls)
+    other_worker = ContactMirrorSync(ContactMirror(), snapshot_path=snapshot, clock=lambda: clock[0])
+    check("otro worker parte de la instantánea", other_worker.sync_once(org)["mode"] == "snapshot" and org.calls == calls)
+
+    def advance(minutes):
+        clock[0] += datetime.timedelta(minutes=minutes)
+        org.now = clock[0]
+
+    advance(1)
+    org.upsert(contact(10, first="Luis", last="Gómez"))
+    org.upsert(dict(contact(2, last="Pérez 2"), DOB__c="1985-05-05"))
+    org.delete(contact(4)["Id"])
+    advance(2)
+    result = sync.sync_once(org)
+    check(f"sincronización incremental {result}", result == {"mode": "incremental", "updated": 2, "deleted": 1})
+    check("alta aplicada", mirror.find_by_name("luis gómez")[0]["Id"] == contact(10)["Id"])
+    check("cambio aplicado", mirror.find_by_name("Ana Pérez 2")[0]["DOB__c"] == "1985-05-05")
+    check("baja aplicada", not mirror.find_by_name("Ana Pérez 4"))
+
+    advance(1)
+    org.upsert(dict(contact(10, first="Luis", last="Gómez Ruiz")))
+    advance(1)
+    sync.sync_once(org)
+    check("cambio de nombre reindexado", not mirror.find_by_name("Luis Gómez") and mirror.find_by_name("luis gómez ruiz"))
+    check("sin cambios no consulta registros", sync.sync_once(org)["mode"] == "skipped")
+
+    restored = ContactMirror()
+    check("instantánea en disco", restored.load_snapshot(snapshot) and len(restored) == len(mirror))
+    check("réplica igual al origen", {c["Id"]: c for c in mirror.iter_contacts()} == org.contacts)
+    print(f"Llamadas al Salesforce falso: {org.calls}")
+
+
+def benchmark(count):
+    org = FakeSalesforce(datetime.datetime.now(datetime.timezone.utc))
+    for i in range(count):
+        org.upsert(contact(i, first=f"Nombre{i % 997}", last=f"Apellido{i}"))
+    mirror = ContactMirror()
+    started = time.perf_counter()
+    ContactMirrorSync(mirror).bootstrap(org)
+    load_seconds = time.perf_counter() - started
+
+    names = [f"nombre{i % 997} apellido{i}" for i in range(0, count, max(1, count // 10000))]
+    started = time.perf_counter()
+    for name in names:
+        mirror.find_by_name(name)
+    per_lookup_us = (time.perf_counter() - started) / len(names) * 1e6
+    print(f"Carga de {count:,} contactos: {load_seconds:.2f}s; lectura por nombre: {per_lookup_us:.1f} µs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contacts", type=int, default=100_000, help="Contactos sintéticos para medir la carga y la lectura.")
+    args = parser.parse_args()
+    scenario()
+    benchmark(args.contacts)
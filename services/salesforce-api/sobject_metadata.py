@@ -0,0 +1,73 @@
+"""
+Validadores de registros compilados a partir de `describe()` de Salesforce.
+
+`compile_validator` toma el resultado de describe de un sObject y deja los
+valores activos de cada picklist restringida (`restrictedPicklist`) y los campos
+requeridos en `frozenset`, de modo que validar un payload cuesta una búsqueda
+por campo en lugar de recorrer listas. `app.py` los refresca en segundo plano; sin describe disponible se usa
+un validador armado con `default_validator` a partir de valores fijos.
+
+No depende de Flask ni de simple_salesforce.
+"""
+import time
+
+PICKLIST_TYPES = ("picklist", "multipicklist")
+
+
+class SObjectValidator:
+    """
+    Reglas de un sObject: `picklists` (campo -> frozenset de valores activos),
+    `required` (campos que Salesforce exige al crear) y `source` ("describe" o
+    "default"). `allowed_values` conserva el orden de Salesforce para los mensajes.
+    """
+
+    def __init__(self, sobject: str, picklists: dict, required=(), multi_select=(), source: str = "default"):
+        self.sobject = sobject
+        self.allowed_values = {field: tuple(values) for field, values in picklists.items()}
+        self.picklists = {field: frozenset(values) for field, values in picklists.items()}
+        self.required = frozenset(required)
+        self.multi_select = frozenset(multi_select)
+        self.source = source
+        self.loaded_at = time.time()
+
+    def check(self, payload: dict, aliases: dict = None):
+        """
+        Valida `payload` (con nombres de campo de Salesforce). Devuelve None si es
+        válido o un dict con "missing_fields" o con "field", "provided_value" y
+        "allowed_values". `aliases` traduce los campos al nombre que usó el cliente.
+        """
+        aliases = aliases or {}
+        missing = [field for field in self.required if payload.get(field) in (None, "")]
+        if missing:
+            return {"missing_fields": sorted(aliases.get(field, field) for field in missing)}
+
+        for field, value in payload.items():
+            allowed = self.picklists.get(field)
+            if allowed is None or value in (None, ""):
+                continue
+            values = value.split(";") if field in self.multi_select and isinstance(value, str) else (value,)
+            if not all(item in allowed for item in values):
+                return {"field": aliases.get(field, field), "provided_value": value, "allowed_values": list(self.allowed_values[field])}
+        return None
+
+
+def compile_validator(describe_result: dict) -> SObjectValidator:
+    """Construye el validador a partir del resultado de `sf.<sObject>.describe()`."""
+    picklists, required, multi_select = {}, [], []
+    for field in describe_result.get("fields", []):
+        name = field["name"]
+        # Solo se exigen los valores de las picklists restringidas; en las demás
+        # Salesforce acepta valores fuera de la lista.
+        if field.get("type") in PICKLIST_TYPES and field.get("restrictedPicklist"):
+            picklists[name] = [entry["value"] for entry in field.get("picklistValues", []) if entry.get("active")]
+            if field["type"] == "multipicklist":
+                multi_select.append(name)
+        # Requerido al crear: no admite nulo y Salesforce no le pone un valor por defecto.
+        if field.get("createable") and not field.get("nillable") and not field.get("defaultedOnCreate") and field.get("type") != "boolean":
+            required.append(name)
+    return SObjectValidator(describe_result["name"], picklists, required, multi_select, source="describe")
+
+
+def default_validator(sobject: str, picklists: dict = None) -> SObjectValidator:
+    """Validador con valores fijos para usar mientras no haya describe."""
+    return SObjectValidator(sobject, picklists or {})
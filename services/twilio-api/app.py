@@ -1,13 +1,29 @@
 import os
 import sys
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
 from twilio.twiml.voice_response import VoiceResponse, Gather
 from twilio.twiml.messaging_response import MessagingResponse
+import json
 import logging
+import queue
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import fcntl
+import zlib
+import google.auth.exceptions
+import google.auth.transport.requests
+import google.oauth2.id_token
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
 
 
 # Configurar logging
@@ -20,6 +36,133 @@ AGENT_API_URL = os.environ.get("AGENT_API_URL") # URL para comunicarse con el ag
 AGENT_APP_NAME = os.environ.get("AGENT_APP_NAME", "sofia_agent") # Nombre de la app del agente
 TWILIO_PHONE_NUMBER = os.environ.get("TWILIO_PHONE_NUMBER")
 
+# Modo de procesamiento de SMS:
+#   "sync":  el webhook procesa el turno completo antes de responder a Twilio (comportamiento original).
+#   "async": el webhook responde de inmediato y el turno se procesa en una cola de trabajo en segundo plano.
+SMS_PROCESSING_MODE = os.environ.get("SMS_PROCESSING_MODE", "sync").lower()
+SMS_QUEUE_MAXSIZE = int(os.environ.get("SMS_QUEUE_MAXSIZE", 100))
+SMS_QUEUE_WORKERS = int(os.environ.get("SMS_QUEUE_WORKERS", 4))
+
+# Empaquetado de respuestas SMS:
+#   "lines":  un mensaje por cada línea de la respuesta del agente (comportamiento original).
+#   "packed": las líneas se agrupan en el menor número de mensajes posible, sin que
+#             ninguno supere SMS_MAX_SEGMENTS_PER_MESSAGE segmentos.
+SMS_PACKING_MODE = os.environ.get("SMS_PACKING_MODE", "lines").lower()
+SMS_MAX_SEGMENTS_PER_MESSAGE = int(os.environ.get("SMS_MAX_SEGMENTS_PER_MESSAGE", 3))
+# Máximo de mensajes por respuesta en modo "packed" (0 = sin límite, por defecto).
+# Si se define y la respuesta no cabe, el último mensaje se recorta y termina con
+# SMS_TRUNCATION_SUFFIX: se pierde el final de la respuesta del agente.
+SMS_MAX_MESSAGES_PER_REPLY = int(os.environ.get("SMS_MAX_MESSAGES_PER_REPLY", 0))
+SMS_TRUNCATION_SUFFIX = os.environ.get("SMS_TRUNCATION_SUFFIX", "...")
+
+# Entrega de respuestas SMS:
+#   "rest":   cada respuesta se envía con la API REST de Twilio (comportamiento original).
+#   "inline": si el agente responde dentro de SMS_INLINE_BUDGET segundos, las respuestas
+#             se devuelven como <Message> en el TwiML del webhook; si no, se usa REST.
+# En modo de procesamiento "async" las respuestas siempre se envían por REST.
+SMS_DELIVERY_MODE = os.environ.get("SMS_DELIVERY_MODE", "rest").lower()
+SMS_INLINE_BUDGET = float(os.environ.get("SMS_INLINE_BUDGET", 12))
+
+# Ventana de agrupación de SMS entrantes por remitente (0 = desactivada). Los mensajes
+# de un mismo número que llegan dentro de la ventana se unen en un único turno del
+# agente. Cada mensaje nuevo extiende la ventana, hasta SMS_COALESCE_MAX_WAIT_MS.
+# El turno agrupado se procesa en la cola de fondo y se responde por REST, también en
+# modo "sync". La agrupación es por proceso: solo une los mensajes que llegan al mismo
+# worker de gunicorn y a la misma instancia (p. ej. WORKERS=1 y afinidad de sesión en
+# Cloud Run); los que llegan a otro worker se procesan como turnos aparte.
+SMS_COALESCE_WINDOW_MS = int(os.environ.get("SMS_COALESCE_WINDOW_MS", 0))
+SMS_COALESCE_MAX_WAIT_MS = int(os.environ.get("SMS_COALESCE_MAX_WAIT_MS", 3 * SMS_COALESCE_WINDOW_MS))
+
+# Deduplicación de reintentos de webhooks de Twilio ("off", "memory" o "file"). Las
+# respuestas ya procesadas se recuerdan durante WEBHOOK_DEDUPE_TTL segundos. "file"
+# comparte el registro entre los workers de una instancia, no entre instancias.
+WEBHOOK_DEDUPE_STORE = os.environ.get("WEBHOOK_DEDUPE_STORE", "off").lower()
+WEBHOOK_DEDUPE_DIR = os.environ.get("WEBHOOK_DEDUPE_DIR", "/tmp/sofia-webhook-dedupe")
+WEBHOOK_DEDUPE_TTL = float(os.environ.get("WEBHOOK_DEDUPE_TTL", 3600))
+WEBHOOK_DEDUPE_WAIT = float(os.environ.get("WEBHOOK_DEDUPE_WAIT", 10))
+
+# Serialización de turnos por sesión. "memory" ordena los turnos dentro de cada worker;
+# "file" usa bloqueos de archivo (flock) compartidos por todos los workers de la instancia.
+SESSION_LOCK_BACKEND = os.environ.get("SESSION_LOCK_BACKEND", "memory").lower()
+SESSION_LOCK_TIMEOUT = float(os.environ.get("SESSION_LOCK_TIMEOUT", 60))
+SESSION_LOCK_TABLE_SIZE = int(os.environ.get("SESSION_LOCK_TABLE_SIZE", 1024))
+SESSION_LOCK_DIR = os.environ.get("SESSION_LOCK_DIR", "/tmp/sofia-session-locks")
+
+# Caché de sesiones conocidas del agente: evita el POST de creación en cada turno.
+AGENT_SESSION_CACHE_SIZE = int(os.environ.get("AGENT_SESSION_CACHE_SIZE", 10000))
+AGENT_SESSION_CACHE_TTL = float(os.environ.get("AGENT_SESSION_CACHE_TTL", 3600))
+
+# Cliente HTTP hacia el agente. El pool se dimensiona para los hilos de gunicorn
+# (THREADS) más los hilos de la cola de SMS, que comparten el mismo proceso.
+# Los hilos en segundo plano (turnos de voz retenidos o en streaming, agrupador
+# de SMS) usan el mismo pool, así que un hilo puede quedarse sin conexión libre:
+# espera como mucho AGENT_HTTP_POOL_TIMEOUT segundos y luego falla como un error
+# de red (contado en agent_http.pool_exhausted).
+GUNICORN_THREADS = int(os.environ.get("THREADS", 8))
+AGENT_HTTP_POOL_SIZE = int(os.environ.get("AGENT_HTTP_POOL_SIZE", GUNICORN_THREADS + SMS_QUEUE_WORKERS))
+AGENT_HTTP_POOL_TIMEOUT = float(os.environ.get("AGENT_HTTP_POOL_TIMEOUT", 5))
+AGENT_CONNECT_TIMEOUT = float(os.environ.get("AGENT_CONNECT_TIMEOUT", 3.05))
+
+# Cortocircuito hacia el agente: tras AGENT_CIRCUIT_FAILURE_THRESHOLD fallos
+# consecutivos (errores de red, 5xx o respuestas más lentas que
+# AGENT_CIRCUIT_SLOW_CALL_SECONDS) las llamadas fallan de inmediato durante
+# AGENT_CIRCUIT_OPEN_SECONDS; después se dejan pasar AGENT_CIRCUIT_HALF_OPEN_CALLS
+# llamadas de prueba. Con un umbral de 0 el cortocircuito queda desactivado.
+AGENT_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("AGENT_CIRCUIT_FAILURE_THRESHOLD", 5))
+AGENT_CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get("AGENT_CIRCUIT_SLOW_CALL_SECONDS", 20))
+AGENT_CIRCUIT_OPEN_SECONDS = float(os.environ.get("AGENT_CIRCUIT_OPEN_SECONDS", 30))
+AGENT_CIRCUIT_HALF_OPEN_CALLS = int(os.environ.get("AGENT_CIRCUIT_HALF_OPEN_CALLS", 1))
+
+# Modo de respuesta de voz:
+#   "sync":   se espera la respuesta completa de `/run` antes de responder a Twilio.
+#   "stream": se consume `/run_sse` y se dice la primera oración en cuanto está lista.
+#   "hold":   el turno corre en segundo plano y, si tarda, se dice una frase de espera
+#             mientras Twilio consulta el resultado en `/voice/poll`.
+VOICE_RESPONSE_MODE = os.environ.get("VOICE_RESPONSE_MODE", "sync").lower()
+# Twilio corta el webhook a los 15 segundos: la espera de la primera oración (y de
+# cada continuación) debe quedar por debajo para alcanzar a responder con un Redirect.
+VOICE_FIRST_SENTENCE_TIMEOUT = float(os.environ.get("VOICE_FIRST_SENTENCE_TIMEOUT", 10))
+VOICE_CONTINUE_TIMEOUT = float(os.environ.get("VOICE_CONTINUE_TIMEOUT", 10))
+# Tiempo máximo de lectura del stream del agente sin recibir datos.
+VOICE_STREAM_READ_TIMEOUT = float(os.environ.get("VOICE_STREAM_READ_TIMEOUT", 25))
+# Si el productor del stream no actualiza el turno en este tiempo (el hilo o el
+# worker murió), `/voice/continue` deja de redirigir y termina con el mensaje de respaldo.
+VOICE_STREAM_STALE_SECONDS = float(os.environ.get("VOICE_STREAM_STALE_SECONDS", VOICE_STREAM_READ_TIMEOUT + 5))
+VOICE_STREAM_POLL_INTERVAL = float(os.environ.get("VOICE_STREAM_POLL_INTERVAL", 0.1))
+VOICE_HOLD_GRACE = float(os.environ.get("VOICE_HOLD_GRACE", 1.5))
+VOICE_HOLD_POLL_WAIT = float(os.environ.get("VOICE_HOLD_POLL_WAIT", 5))
+VOICE_MAX_HOLD_CYCLES = int(os.environ.get("VOICE_MAX_HOLD_CYCLES", 6))
+# Duración máxima de un turno en segundo plano; al vencer (o si la llamada termina,
+# según el callback de estado `/voice/status`) se libera el bloqueo de la sesión.
+# Por defecto es el tiempo que el llamante espera en total (gracia + ciclos de
+# consulta): más allá de eso nadie recogería la respuesta.
+VOICE_HOLD_AGENT_TIMEOUT = float(os.environ.get("VOICE_HOLD_AGENT_TIMEOUT", VOICE_HOLD_GRACE + VOICE_MAX_HOLD_CYCLES * VOICE_HOLD_POLL_WAIT))
+VOICE_HOLD_PHRASES = [
+    "Un momento, por favor.",
+    "Sigo revisando su información, gracias por esperar.",
+]
+# Los turnos de voz en curso deben ser visibles para todos los workers de gunicorn,
+# ya que el Redirect de Twilio puede llegar a otro worker. "file" los comparte en
+# un directorio local de la instancia; "memory" solo sirve con un único worker.
+VOICE_TURN_STORE = os.environ.get("VOICE_TURN_STORE", "file").lower()
+VOICE_TURN_STORE_DIR = os.environ.get("VOICE_TURN_STORE_DIR", "/tmp/sofia-voice-turns")
+VOICE_TURN_STORE_TTL = float(os.environ.get("VOICE_TURN_STORE_TTL", 600))
+
+# Precarga del contacto por identificador de llamada (opcional): en el primer
+# webhook de una llamada se busca el número del llamante en salesforce-api en
+# paralelo con el saludo, y el resultado se siembra en el estado de la sesión del
+# agente en el siguiente turno.
+VOICE_CALLER_PREFETCH = os.environ.get("VOICE_CALLER_PREFETCH", "false").lower() == "true"
+SALESFORCE_API_URL = os.environ.get("SALESFORCE_API_URL")
+# Autenticación con token de identidad de Google (servicio privado en Cloud Run).
+SALESFORCE_API_AUTH = os.environ.get("SALESFORCE_API_AUTH", "true").lower() == "true"
+CALLER_PREFETCH_TIMEOUT = float(os.environ.get("CALLER_PREFETCH_TIMEOUT", 10))
+SALESFORCE_HTTP_POOL_SIZE = int(os.environ.get("SALESFORCE_HTTP_POOL_SIZE", GUNICORN_THREADS))
+# Normalización de teléfonos (mismas variables y regla que salesforce-api): un número
+# de PHONE_NATIONAL_DIGITS dígitos sin "+" se toma como nacional del país por defecto.
+PHONE_DEFAULT_COUNTRY_CODE = os.environ.get("PHONE_DEFAULT_COUNTRY_CODE", "1")
+PHONE_NATIONAL_DIGITS = int(os.environ.get("PHONE_NATIONAL_DIGITS", 10))
+
 required_secrets = {
     "TWILIO_ACCOUNT_SID": ACCOUNT_SID,
     "TWILIO_AUTH_TOKEN": AUTH_TOKEN,
@@ -33,6 +176,941 @@ if missing_secrets:
     logging.critical(error_message)
     sys.exit(1)
 
+if VOICE_CALLER_PREFETCH and not SALESFORCE_API_URL:
+    logging.critical("Error crítico: VOICE_CALLER_PREFETCH requiere la variable de entorno SALESFORCE_API_URL.")
+    sys.exit(1)
+
+# --- Mensajes al Usuario ---
+SMS_SESSION_ERROR_MESSAGE = "Lo siento, estamos teniendo problemas para iniciar la conversación. Por favor, intenta de nuevo en unos minutos."
+SMS_AGENT_ERROR_MESSAGE = "Lo siento, no pude procesar tu solicitud en este momento."
+VOICE_MISSING_PARAMS_MESSAGE = "Lo siento, ha ocurrido un error de sistema. Por favor, intente llamar de nuevo más tarde."
+VOICE_SESSION_ERROR_MESSAGE = "Lo siento, estamos teniendo problemas para iniciar la conversación. Por favor, intente llamar de nuevo en unos minutos."
+VOICE_NO_TEXT_MESSAGE = "No he entendido lo que ha dicho. ¿Podría repetirlo, por favor?"
+VOICE_FALLBACK_MESSAGE = "Lo siento, no pude procesar su solicitud en este momento. ¿Podría repetirlo, por favor?"
+
+# --- Estadísticas de Ejecución ---
+class RuntimeStats:
+    """
+    Contadores y tiempos acumulados en memoria del proceso.
+
+    Cada worker de gunicorn mantiene sus propias estadísticas. Los gauges se
+    registran como funciones que se evalúan al momento de tomar la instantánea,
+    de modo que siempre reflejan el estado actual (ej. profundidad de una cola).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def incr(self, name: str, amount: float = 1):
+        """Incrementa el contador `name` en `amount`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        """Registra una duración en segundos (cantidad, suma y máximo)."""
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def snapshot_counters(self) -> dict:
+        """Devuelve una copia de los contadores del proceso."""
+        with self._lock:
+            return dict(self._counters)
+
+    def register_gauge(self, name: str, func):
+        """Registra una función sin argumentos cuyo valor se reporta como gauge."""
+        with self._lock:
+            self._gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """Devuelve una copia de todas las estadísticas del proceso."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {
+                name: {**values, "avg": values["sum"] / values["count"] if values["count"] else 0.0}
+                for name, values in self._timings.items()
+            }
+            gauges = dict(self._gauges)
+        return {
+            "pid": os.getpid(),
+            "counters": counters,
+            "timings": timings,
+            "gauges": {name: func() for name, func in gauges.items()},
+        }
+
+stats = RuntimeStats()
+
+# --- Métricas de Latencia por Etapa (Prometheus) ---
+# Con PROMETHEUS_MULTIPROC_DIR definido (ver Dockerfile y gunicorn.conf.py), cada
+# worker escribe sus muestras en ese directorio y `/metrics` las agrega, de modo
+# que cualquier worker que atienda el scrape reporta el total de la instancia.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+STAGE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 1.5, 2.5, 5, 10, 15, 20, 30, 60)
+
+stage_latency = Histogram(
+    "twilio_api_stage_seconds",
+    "Duración de cada etapa de un turno de SMS o voz.",
+    ["channel", "stage", "outcome"],
+    buckets=STAGE_LATENCY_BUCKETS,
+)
+
+def _stage_outcome(error: Exception) -> str:
+    """Clasifica la excepción que interrumpió una etapa en una etiqueta de resultado."""
+    if isinstance(error, AgentUnavailableError):
+        return "circuit_open"
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    return "error"
+
+@contextmanager
+def observe_stage(channel: str, stage: str):
+    """
+    Mide la duración del bloque y la registra en `twilio_api_stage_seconds`
+    con resultado "ok", o según la excepción que lo interrumpa (que se propaga).
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        stage_latency.labels(channel, stage, _stage_outcome(e)).observe(time.perf_counter() - started_at)
+        raise
+    stage_latency.labels(channel, stage, "ok").observe(time.perf_counter() - started_at)
+
+def observe_webhook(channel: str, stage: str = "webhook"):
+    """Decorador que registra la duración total del webhook como etapa `stage` ("webhook" por defecto)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with observe_stage(channel, stage):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- Caché LRU con Expiración ---
+class TTLCache:
+    """
+    Caché LRU acotada y segura entre hilos, con expiración por entrada.
+
+    Al superar `maxsize` se descarta la entrada usada menos recientemente.
+    Los aciertos y fallos se reportan en `stats` como `<name>.hits` y `<name>.misses`.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        stats.register_gauge(f"{name}.size", self.__len__)
+
+    def get(self, key, default=None):
+        """Devuelve el valor de `key` si existe y no ha expirado."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                stats.incr(f"{self.name}.hits")
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+        stats.incr(f"{self.name}.misses")
+        return default
+
+    def set(self, key, value=True):
+        """Guarda `value` en `key`, renovando su expiración."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value=True) -> bool:
+        """Guarda `value` solo si `key` no existe o expiró. Devuelve True si lo guardó."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """Elimina `key` de la caché si existe."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+# --- Almacenes de Registros Compartidos ---
+class MemoryRecordStore:
+    """Almacén de registros en memoria del proceso, con expiración por TTL."""
+
+    def __init__(self, name: str, ttl: float):
+        self._cache = TTLCache(name, maxsize=10000, ttl=ttl)
+
+    def put(self, key: str, record: dict):
+        self._cache.set(key, record)
+
+    def add(self, key: str, record: dict) -> bool:
+        """Guarda `record` solo si `key` no existe. Devuelve True si lo guardó."""
+        return self._cache.add(key, record)
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    def delete(self, key: str):
+        self._cache.discard(key)
+
+class FileRecordStore:
+    """
+    Almacén de registros JSON en un directorio local, compartido por todos los
+    workers de gunicorn de la instancia. Las escrituras son atómicas
+    (archivo temporal + `os.replace`) para que un lector nunca vea un registro
+    a medio escribir.
+    """
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_sweep = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _sweep_expired(self):
+        """Elimina los registros que superaron el TTL (ej. turnos abandonados)."""
+        self._last_sweep = time.monotonic()
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key: str) -> str:
+        safe_key = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        return os.path.join(self.directory, f"{safe_key}.json")
+
+    def put(self, key: str, record: dict):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        if time.monotonic() - self._last_sweep > self.ttl:
+            self._sweep_expired()
+
+    def add(self, key: str, record: dict) -> bool:
+        """
+        Guarda `record` solo si `key` no existe (o expiró). Devuelve True si lo
+        guardó. `os.link` falla si el destino existe, lo que hace la operación
+        atómica entre workers.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, path)
+                    return True
+                except FileExistsError:
+                    # Un registro expirado no cuenta como existente.
+                    if self.get(key) is not None:
+                        return False
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.delete(key)
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+RECORD_STORE_BACKENDS = {
+    "memory": lambda name, directory, ttl: MemoryRecordStore(name, ttl),
+    "file": lambda name, directory, ttl: FileRecordStore(directory, ttl),
+}
+
+if VOICE_TURN_STORE not in RECORD_STORE_BACKENDS:
+    logging.critical(f"Error crítico: VOICE_TURN_STORE '{VOICE_TURN_STORE}' no es válido. Opciones: {', '.join(RECORD_STORE_BACKENDS)}")
+    sys.exit(1)
+
+if WEBHOOK_DEDUPE_STORE != "off" and WEBHOOK_DEDUPE_STORE not in RECORD_STORE_BACKENDS:
+    logging.critical(f"Error crítico: WEBHOOK_DEDUPE_STORE '{WEBHOOK_DEDUPE_STORE}' no es válido. Opciones: off, {', '.join(RECORD_STORE_BACKENDS)}")
+    sys.exit(1)
+
+voice_turn_store = RECORD_STORE_BACKENDS[VOICE_TURN_STORE]("voice_turn_store", VOICE_TURN_STORE_DIR, VOICE_TURN_STORE_TTL)
+webhook_dedupe_store = None
+if WEBHOOK_DEDUPE_STORE != "off":
+    webhook_dedupe_store = RECORD_STORE_BACKENDS[WEBHOOK_DEDUPE_STORE]("webhook_dedupe_store", WEBHOOK_DEDUPE_DIR, WEBHOOK_DEDUPE_TTL)
+
+# Fin de oración: puntuación de cierre (opcionalmente seguida de comillas o
+# paréntesis) y un espacio, o un salto de línea.
+SENTENCE_BOUNDARY = re.compile(r'[.!?…]["\')\]]*\s+|\n+')
+
+# --- Serialización de Turnos por Sesión ---
+class InProcessSessionLocks:
+    """
+    Tabla acotada de bloqueos por sesión dentro del proceso.
+
+    Cada sesión usa un esquema de turnos (ticket) para que los turnos se
+    atiendan en orden de llegada, mientras que sesiones distintas corren en
+    paralelo. Las entradas se eliminan cuando nadie las usa, así que la tabla
+    solo contiene sesiones con turnos en curso; si se llena, el turno se
+    procesa sin serializar y se cuenta en `session_lock.overflow`.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        stats.register_gauge("session_lock.active_sessions", lambda: len(self._entries))
+
+    @contextmanager
+    def hold(self, key: str, timeout: float = None):
+        timeout = SESSION_LOCK_TIMEOUT if timeout is None else timeout
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    entry = None
+                else:
+                    entry = {"cond": threading.Condition(self._lock), "next": 0, "serving": 0, "users": 0}
+                    self._entries[key] = entry
+            if entry is not None:
+                ticket = entry["next"]
+                entry["next"] += 1
+                entry["users"] += 1
+
+        if entry is None:
+            stats.incr("session_lock.overflow")
+            app.logger.warning(f"Tabla de bloqueos de sesión llena. El turno de '{key}' no se serializa.")
+            yield
+            return
+
+        waited_at = time.monotonic()
+        with self._lock:
+            acquired = entry["cond"].wait_for(lambda: entry["serving"] == ticket, timeout=timeout)
+        stats.observe("session_lock.wait_seconds", time.monotonic() - waited_at)
+        if not acquired:
+            stats.incr("session_lock.timeouts")
+            app.logger.warning(f"Tiempo de espera agotado para el turno de la sesión '{key}'. Se procesa sin serializar.")
+        try:
+            yield
+        finally:
+            with self._lock:
+                if acquired:
+                    entry["serving"] += 1
+                else:
+                    # El ticket expirado se descarta cuando llega su turno para no bloquear a los siguientes.
+                    entry.setdefault("expired", set()).add(ticket)
+                while entry["serving"] in entry.get("expired", ()):
+                    entry["expired"].discard(entry["serving"])
+                    entry["serving"] += 1
+                entry["users"] -= 1
+                if entry["users"] == 0:
+                    del self._entries[key]
+                entry["cond"].notify_all()
+
+class FileSessionLocks:
+    """
+    Bloqueos por sesión compartidos entre los workers de gunicorn de una
+    instancia mediante `flock` sobre un número fijo de archivos. Las sesiones
+    se reparten entre los archivos por hash, por lo que la tabla está acotada
+    a `stripes` entradas y no necesita desalojo.
+    """
+
+    def __init__(self, directory: str, stripes: int):
+        self.directory = directory
+        self.stripes = stripes
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def hold(self, key: str, timeout: float = None):
+        timeout = SESSION_LOCK_TIMEOUT if timeout is None else timeout
+        stripe = zlib.crc32(key.encode("utf-8")) % self.stripes
+        waited_at = time.monotonic()
+        with open(os.path.join(self.directory, f"{stripe}.lock"), "a") as lock_file:
+            acquired = False
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() - waited_at >= timeout:
+                        break
+                    time.sleep(0.05)
+            stats.observe("session_lock.wait_seconds", time.monotonic() - waited_at)
+            if not acquired:
+                stats.incr("session_lock.timeouts")
+                app.logger.warning(f"Tiempo de espera agotado para el turno de la sesión '{key}'. Se procesa sin serializar.")
+            try:
+                yield
+            finally:
+                if acquired:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+SESSION_LOCK_BACKENDS = {
+    "memory": lambda: InProcessSessionLocks(SESSION_LOCK_TABLE_SIZE),
+    "file": lambda: FileSessionLocks(SESSION_LOCK_DIR, SESSION_LOCK_TABLE_SIZE),
+}
+
+if SESSION_LOCK_BACKEND not in SESSION_LOCK_BACKENDS:
+    logging.critical(f"Error crítico: SESSION_LOCK_BACKEND '{SESSION_LOCK_BACKEND}' no es válido. Opciones: {', '.join(SESSION_LOCK_BACKENDS)}")
+    sys.exit(1)
+
+session_turn_locks = SESSION_LOCK_BACKENDS[SESSION_LOCK_BACKEND]()
+
+# --- Cola de Trabajo para Turnos en Segundo Plano ---
+class TurnQueue:
+    """
+    Cola acotada en memoria atendida por un grupo fijo de hilos daemon.
+
+    Los hilos se inician de forma perezosa en el primer `submit` para que cada
+    worker de gunicorn cree los suyos después del fork.
+    """
+
+    def __init__(self, name: str, maxsize: int, workers: int):
+        self.name = name
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._started = False
+        self._start_lock = threading.Lock()
+        stats.register_gauge(f"{name}.depth", self.depth)
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self._workers):
+                threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True).start()
+            self._started = True
+
+    def _worker_loop(self):
+        while True:
+            enqueued_at, func, args = self._queue.get()
+            stats.observe(f"{self.name}.wait_seconds", time.monotonic() - enqueued_at)
+            started_at = time.monotonic()
+            try:
+                func(*args)
+                stats.incr(f"{self.name}.completed")
+            except Exception as e:
+                stats.incr(f"{self.name}.failed")
+                app.logger.error(f"Error no controlado en la cola '{self.name}': {e}")
+            finally:
+                stats.observe(f"{self.name}.processing_seconds", time.monotonic() - started_at)
+                self._queue.task_done()
+
+    def submit(self, func, *args) -> bool:
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.monotonic(), func, args))
+        except queue.Full:
+            stats.incr(f"{self.name}.rejected")
+            return False
+        stats.incr(f"{self.name}.submitted")
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+sms_turn_queue = TurnQueue("sms_queue", SMS_QUEUE_MAXSIZE, SMS_QUEUE_WORKERS)
+
+# --- Cortocircuito (Circuit Breaker) hacia el Agente ---
+class AgentUnavailableError(requests.exceptions.ConnectionError):
+    """El cortocircuito está abierto y la llamada al agente no se intentó."""
+
+class CircuitBreaker:
+    """
+    Cortocircuito de tres estados para una dependencia remota.
+
+    - "closed": las llamadas pasan; cada fallo (o llamada lenta) suma al
+      contador de fallos consecutivos y un éxito lo reinicia. Al llegar a
+      `failure_threshold` el circuito se abre.
+    - "open": las llamadas se rechazan sin intentarse hasta que pasan
+      `open_seconds`.
+    - "half_open": se permiten hasta `half_open_calls` llamadas de prueba
+      simultáneas. Si una tiene éxito el circuito se cierra; si falla, se
+      vuelve a abrir.
+
+    El estado es por proceso: cada worker de gunicorn abre su propio circuito.
+    """
+
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, name: str, failure_threshold: int, slow_call_seconds: float, open_seconds: float, half_open_calls: int):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trials_in_flight = 0
+        stats.register_gauge(f"{name}.state", lambda: self.STATES.index(self.state()))
+        stats.register_gauge(f"{name}.consecutive_failures", lambda: self._consecutive_failures)
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def state(self) -> str:
+        """Devuelve el estado actual ("closed", "half_open" u "open")."""
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+                return "half_open"
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        Indica si se puede intentar una llamada. Si devuelve True, el llamador
+        debe reportar el resultado con `record_success` o `record_failure`.
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    stats.incr(f"{self.name}.rejected")
+                    return False
+                self._state = "half_open"
+                self._trials_in_flight = 0
+                app.logger.info(f"Cortocircuito '{self.name}' medio abierto: enviando llamadas de prueba.")
+
+            if self._state == "half_open":
+                if self._trials_in_flight >= self.half_open_calls:
+                    stats.incr(f"{self.name}.rejected")
+                    return False
+                self._trials_in_flight += 1
+                stats.incr(f"{self.name}.trial_calls")
+            return True
+
+    def record_success(self, elapsed: float):
+        """Reporta una llamada completada; si superó `slow_call_seconds` cuenta como fallo."""
+        if not self.enabled:
+            return
+        if elapsed > self.slow_call_seconds:
+            stats.incr(f"{self.name}.slow_calls")
+            self.record_failure()
+            return
+        with self._lock:
+            if self._state == "half_open":
+                self._trials_in_flight = max(0, self._trials_in_flight - 1)
+                self._state = "closed"
+                stats.incr(f"{self.name}.closed")
+                app.logger.info(f"Cortocircuito '{self.name}' cerrado: la dependencia respondió de nuevo.")
+            self._consecutive_failures = 0
+
+    def record_failure(self):
+        """Reporta una llamada fallida y abre el circuito si corresponde."""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats.incr(f"{self.name}.failures")
+            self._consecutive_failures += 1
+            if self._state == "half_open":
+                self._trials_in_flight = max(0, self._trials_in_flight - 1)
+                self._open()
+            elif self._state == "closed" and self._consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def release(self):
+        """
+        Libera un permiso concedido por `allow` sin reportar resultado, para
+        llamadas que no llegaron a la dependencia (ej. pool local agotado).
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._state == "half_open":
+                self._trials_in_flight = max(0, self._trials_in_flight - 1)
+
+    def _open(self):
+        self._state = "open"
+        self._opened_at = time.monotonic()
+        stats.incr(f"{self.name}.opened")
+        app.logger.error(
+            f"Cortocircuito '{self.name}' abierto tras {self._consecutive_failures} fallo(s) consecutivo(s). "
+            f"Las llamadas fallarán de inmediato durante {self.open_seconds:g}s."
+        )
+
+    def describe(self) -> dict:
+        """Devuelve el estado y la configuración del circuito para diagnóstico."""
+        state = self.state()
+        with self._lock:
+            retry_in = max(0.0, self._opened_at + self.open_seconds - time.monotonic()) if state == "open" else 0.0
+            return {
+                "enabled": self.enabled,
+                "state": state,
+                "consecutive_failures": self._consecutive_failures,
+                "retry_in_seconds": round(retry_in, 3),
+                "failure_threshold": self.failure_threshold,
+                "slow_call_seconds": self.slow_call_seconds,
+                "open_seconds": self.open_seconds,
+                "half_open_calls": self.half_open_calls,
+            }
+
+agent_circuit = CircuitBreaker(
+    "agent_circuit",
+    AGENT_CIRCUIT_FAILURE_THRESHOLD,
+    AGENT_CIRCUIT_SLOW_CALL_SECONDS,
+    AGENT_CIRCUIT_OPEN_SECONDS,
+    AGENT_CIRCUIT_HALF_OPEN_CALLS,
+)
+
+# --- Cliente HTTP con Pool de Conexiones hacia el Agente ---
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.incr("agent_http.connections_opened")
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout=AGENT_HTTP_POOL_TIMEOUT if timeout is None else timeout)
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.incr("agent_http.connections_opened")
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout=AGENT_HTTP_POOL_TIMEOUT if timeout is None else timeout)
+
+class AgentHTTPAdapter(HTTPAdapter):
+    """
+    Adaptador de `requests` que cuenta las peticiones enviadas y las conexiones
+    TCP/TLS abiertas, para medir cuántas peticiones reutilizan una conexión viva.
+
+    Todas las peticiones pasan por `agent_circuit`: con el circuito abierto se
+    lanza `AgentUnavailableError` sin tocar la red, y cada respuesta (o error)
+    se reporta al circuito. Los errores de red y las respuestas 5xx cuentan
+    como fallos; los 4xx (sesión existente o no encontrada) son respuestas
+    válidas del agente.
+
+    Con `stream=True` el resultado no se conoce al llegar las cabeceras: la
+    respuesta queda marcada con `agent_circuit_started_at` y quien consume el
+    cuerpo la reporta con `record_agent_stream` al terminar.
+
+    Si no queda conexión libre en el pool tras AGENT_HTTP_POOL_TIMEOUT, la
+    petición no llegó al agente: no cuenta como fallo del circuito y se lanza
+    `requests.exceptions.ConnectionError` para que los llamadores la traten
+    como cualquier otro error de red.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        if not agent_circuit.allow():
+            raise AgentUnavailableError("Cortocircuito abierto: el agente no está disponible.", request=request)
+
+        stats.incr("agent_http.requests")
+        started_at = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except EmptyPoolError as e:
+            agent_circuit.release()
+            stats.incr("agent_http.pool_exhausted")
+            app.logger.warning(f"Pool de conexiones al agente agotado tras {AGENT_HTTP_POOL_TIMEOUT:g}s de espera.")
+            raise requests.exceptions.ConnectionError(e, request=request)
+        except Exception:
+            agent_circuit.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            agent_circuit.record_failure()
+        elif kwargs.get("stream"):
+            response.agent_circuit_started_at = started_at
+        else:
+            agent_circuit.record_success(time.monotonic() - started_at)
+        return response
+
+def record_agent_stream(response, error: Exception = None):
+    """
+    Reporta al circuito una respuesta en streaming una vez consumida (o
+    abandonada), con la duración total del stream. Solo la primera llamada cuenta.
+    """
+    started_at = getattr(response, "agent_circuit_started_at", None)
+    if started_at is None:
+        return
+    response.agent_circuit_started_at = None
+    if error is None:
+        agent_circuit.record_success(time.monotonic() - started_at)
+    else:
+        agent_circuit.record_failure()
+
+def _agent_connection_reuse_ratio() -> float:
+    counters = stats.snapshot_counters()
+    sent = counters.get("agent_http.requests", 0)
+    if not sent:
+        return 0.0
+    return 1 - counters.get("agent_http.connections_opened", 0) / sent
+
+def build_agent_http_session() -> requests.Session:
+    """
+    Crea la sesión HTTP compartida para todas las llamadas al agente.
+
+    La sesión mantiene conexiones keep-alive en un pool acotado a
+    AGENT_HTTP_POOL_SIZE; con `pool_block=True` los hilos esperan una conexión
+    libre (como mucho AGENT_HTTP_POOL_TIMEOUT) en lugar de abrir conexiones
+    extra que luego se descartan.
+    """
+    session = requests.Session()
+    adapter = AgentHTTPAdapter(pool_connections=1, pool_maxsize=AGENT_HTTP_POOL_SIZE, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+agent_http = build_agent_http_session()
+stats.register_gauge("agent_http.connection_reuse_ratio", _agent_connection_reuse_ratio)
+
+# --- Empaquetado de Respuestas SMS ---
+# Alfabeto GSM-7 (GSM 03.38). Los caracteres de la tabla de extensión ocupan dos
+# septetos. Cualquier carácter fuera de ambos conjuntos obliga a codificar todo
+# el mensaje en UCS-2 (ej. 'á', 'í', 'ó', 'ú'; 'é', 'ñ' y '¿' sí son GSM-7).
+GSM7_BASIC_CHARS = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENSION_CHARS = frozenset("\f^{}\\[~]|€")
+
+def sms_segment_count(text: str) -> int:
+    """
+    Calcula cuántos segmentos facturables ocupa `text`.
+
+    GSM-7 admite 160 septetos en un mensaje simple y 153 por segmento en uno
+    concatenado; UCS-2 admite 70 y 67 unidades de 16 bits respectivamente.
+    """
+    if all(c in GSM7_BASIC_CHARS or c in GSM7_EXTENSION_CHARS for c in text):
+        length = sum(2 if c in GSM7_EXTENSION_CHARS else 1 for c in text)
+        single, multi = 160, 153
+    else:
+        # Los caracteres fuera del plano básico (ej. emojis) ocupan dos unidades UTF-16.
+        length = sum(2 if ord(c) > 0xFFFF else 1 for c in text)
+        single, multi = 70, 67
+    if length <= single:
+        return 1
+    return -(-length // multi)
+
+def pack_sms_messages(lines: list, max_segments: int, max_messages: int = 0) -> list:
+    """
+    Agrupa las líneas en el menor número de mensajes posible, respetando el
+    orden y uniendo con saltos de línea, sin que un mensaje supere
+    `max_segments` segmentos. Una línea que por sí sola excede el límite se
+    envía como un mensaje propio.
+
+    Con `max_messages` la respuesta se limita a ese número de mensajes: el
+    último se recorta hasta `max_segments` y termina con SMS_TRUNCATION_SUFFIX.
+    """
+    messages = []
+    for line in lines:
+        if messages:
+            candidate = f"{messages[-1]}\n{line}"
+            if sms_segment_count(candidate) <= max_segments:
+                messages[-1] = candidate
+                continue
+        messages.append(line)
+
+    if max_messages and len(messages) > max_messages:
+        messages = messages[:max_messages]
+        last = messages[-1].rstrip()
+        while last and sms_segment_count(f"{last}{SMS_TRUNCATION_SUFFIX}") > max_segments:
+            # Se recorta por palabras para no cortar una a la mitad.
+            cut = last.rfind(" ", 0, len(last) - 1)
+            last = last[:cut].rstrip() if cut > 0 else last[:-1]
+        messages[-1] = f"{last.rstrip('.')}{SMS_TRUNCATION_SUFFIX}"
+        stats.incr("sms_packing.truncated_replies")
+    return messages
+
+# --- Agrupación de SMS Entrantes por Remitente ---
+class InboundCoalescer:
+    """
+    Acumula los mensajes entrantes de cada remitente durante una ventana
+    deslizante para procesarlos como un único turno.
+
+    El primer mensaje de un lote convierte a quien lo agrega en "líder": es el
+    responsable de recoger el lote con `take_if_ready` cuando la ventana cierra.
+    Los mensajes posteriores solo se agregan al lote y extienden la ventana.
+    """
+
+    def __init__(self, window: float, max_wait: float):
+        self.window = window
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._batches = {}
+        stats.register_gauge("sms_coalesce.open_batches", lambda: len(self._batches))
+
+    def add(self, key: str, text: str) -> bool:
+        """Agrega `text` al lote de `key`. Devuelve True si abrió un lote nuevo."""
+        now = time.monotonic()
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                self._batches[key] = {"texts": [text], "opened_at": now, "deadline": now + self.window}
+                return True
+            batch["texts"].append(text)
+            batch["deadline"] = min(now + self.window, batch["opened_at"] + self.max_wait)
+            return False
+
+    def take_if_ready(self, key: str) -> tuple:
+        """
+        Devuelve `(textos, 0)` y cierra el lote si su ventana ya terminó, o
+        `(None, segundos_restantes)` si todavía está abierta.
+        """
+        with self._lock:
+            batch = self._batches[key]
+            remaining = batch["deadline"] - time.monotonic()
+            if remaining > 0:
+                return None, remaining
+            del self._batches[key]
+        stats.incr("sms_coalesce.turns_saved", len(batch["texts"]) - 1)
+        return batch["texts"], 0
+
+sms_coalescer = InboundCoalescer(SMS_COALESCE_WINDOW_MS / 1000, SMS_COALESCE_MAX_WAIT_MS / 1000)
+
+def _schedule_coalesced_sms_flush(from_number: str, delay: float):
+    timer = threading.Timer(delay, _flush_coalesced_sms, args=(from_number,))
+    timer.daemon = True
+    timer.start()
+
+def _flush_coalesced_sms(from_number: str):
+    """
+    Temporizador de la agrupación: encola el turno agrupado cuando cierra la
+    ventana, o se reprograma si un mensaje nuevo la extendió.
+    """
+    texts, remaining = sms_coalescer.take_if_ready(from_number)
+    if texts is None:
+        _schedule_coalesced_sms_flush(from_number, remaining)
+        return
+    message_body = "\n".join(texts)
+    if not sms_turn_queue.submit(process_sms_turn, from_number, message_body):
+        app.logger.warning(f"Cola de SMS llena. Procesando el turno agrupado de {from_number} de forma síncrona.")
+        process_sms_turn(from_number, message_body)
+
+# --- Deduplicación de Reintentos de Webhooks ---
+def _webhook_dedupe_key(kind: str):
+    """
+    Identifica una entrega de webhook de forma estable entre reintentos de
+    Twilio: por MessageSid en SMS, y por CallSid más el encabezado
+    `I-Twilio-Idempotency-Token` (igual en cada reintento) en voz.
+    """
+    if kind == "sms":
+        message_sid = request.values.get('MessageSid')
+        return f"sms-{message_sid}" if message_sid else None
+    call_sid = request.values.get('CallSid')
+    token = request.headers.get('I-Twilio-Idempotency-Token')
+    if call_sid and token:
+        return f"{request.endpoint}-{call_sid}-{token}"
+    return None
+
+def idempotent_webhook(kind: str, fallback):
+    """
+    Decorador que evita procesar dos veces el mismo webhook.
+
+    La primera entrega reserva la clave y, al terminar, guarda la respuesta.
+    Un reintento de una entrega ya terminada recibe la respuesta guardada. Si
+    la original sigue en curso, se esperan hasta `wait` segundos a que termine
+    (WEBHOOK_DEDUPE_WAIT en voz y en SMS con entrega "inline"; en SMS por REST
+    la original envía las respuestas y no hace falta esperar) y, si no, se
+    responde con `fallback(key)`. Así no se vuelve a gastar un turno del LLM ni se
+    repiten escrituras en Salesforce.
+    """
+    wait = 0 if kind == "sms" and not _sms_replies_inline() else WEBHOOK_DEDUPE_WAIT
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = _webhook_dedupe_key(kind) if webhook_dedupe_store else None
+            if key is None:
+                return view(*args, **kwargs)
+
+            if not webhook_dedupe_store.add(key, {"done": False}):
+                stats.incr(f"webhook_dedupe.{kind}_absorbed")
+                deadline = time.monotonic() + wait
+                while True:
+                    record = webhook_dedupe_store.get(key) or {}
+                    if record.get("done"):
+                        app.logger.info(f"Reintento de webhook '{key}' respondido con la respuesta guardada.")
+                        return record["body"], record["status"], record["headers"]
+                    if time.monotonic() >= deadline:
+                        app.logger.info(f"Reintento de webhook '{key}' descartado: la entrega original sigue en curso.")
+                        return fallback(key)
+                    time.sleep(0.1)
+
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                # Si la entrega falla, se libera la clave para que un reintento pueda procesarla.
+                webhook_dedupe_store.delete(key)
+                raise
+            body, status, headers = (tuple(response) + ({},))[:3]
+            webhook_dedupe_store.put(key, {"done": True, "body": body, "status": status, "headers": dict(headers)})
+            return response
+        return wrapper
+    return decorator
+
+def _sms_replies_inline() -> bool:
+    return SMS_DELIVERY_MODE == "inline" and SMS_PROCESSING_MODE != "async"
+
+def _sms_rest_requested_key(key: str) -> str:
+    return f"{key}-rest"
+
+def _sms_dedupe_fallback(key: str):
+    if _sms_replies_inline():
+        # Las respuestas iban a viajar en el TwiML de la entrega original, que Twilio
+        # ya descartó (y no reintenta un 4xx ni respeta Retry-After): se pide a la
+        # entrega original que las envíe por REST al terminar.
+        webhook_dedupe_store.add(_sms_rest_requested_key(key), {"done": True})
+        record = webhook_dedupe_store.get(key) or {}
+        if record.get("done"):
+            # La original terminó mientras tanto: este reintento lleva la respuesta.
+            return record["body"], record["status"], record["headers"]
+        stats.incr("webhook_dedupe.sms_rest_requested")
+    # La entrega original envía las respuestas por REST.
+    return str(MessagingResponse()), 200
+
+def sms_rest_requested(dedupe_key: str) -> bool:
+    """True si un reintento del webhook pidió que las respuestas se envíen por REST."""
+    return bool(dedupe_key and webhook_dedupe_store and webhook_dedupe_store.get(_sms_rest_requested_key(dedupe_key)))
+
+def _voice_dedupe_fallback(key: str):
+    twiml_response = build_voice_twiml(*VOICE_AGENT_ERROR_MESSAGES["timeout"])
+    return str(twiml_response), 200, {'Content-Type': 'text/xml'}
+
 # --- Inicialización Singleton del Cliente de Twilio ---
 twilio_client = None
 
@@ -51,6 +1129,8 @@ def get_twilio_client():
             raise
     return twilio_client
 
+known_agent_sessions = TTLCache("agent_session_cache", AGENT_SESSION_CACHE_SIZE, AGENT_SESSION_CACHE_TTL)
+
 def ensure_agent_session_exists(user_id: str, session_id: str):
     """
     Asegura que una sesión exista para un usuario en el agente.
@@ -60,27 +1140,137 @@ def ensure_agent_session_exists(user_id: str, session_id: str):
     que se maneja como un caso de éxito, evitando una llamada de red adicional
     (como GET o HEAD) solo para verificar la existencia.
 
+    Las sesiones confirmadas se guardan en `known_agent_sessions`, de modo que
+    solo el primer turno de una conversación paga la llamada de creación.
+
     Lanza una excepción `requests.exceptions.RequestException` si la API
     devuelve un error inesperado.
     """
+    if known_agent_sessions.get((user_id, session_id)):
+        return
+
     create_session_url = f"{AGENT_API_URL}/apps/{AGENT_APP_NAME}/users/{user_id}/sessions/{session_id}"
     app.logger.info(f"Asegurando que la sesión '{session_id}' exista para el usuario '{user_id}'.")
     
-    response = requests.post(create_session_url, timeout=15)
+    response = agent_http.post(create_session_url, timeout=(AGENT_CONNECT_TIMEOUT, 15))
 
     # Si la sesión ya existe, la API puede devolver 409 Conflict. Esto se considera un éxito.
     if response.status_code == 400:
         app.logger.info(f"La sesión '{session_id}' ya existía.")
+        known_agent_sessions.set((user_id, session_id))
         return
 
     # Para cualquier otro código de error (4xx, 5xx), se lanza una excepción.
     response.raise_for_status()
+    known_agent_sessions.set((user_id, session_id))
     app.logger.info(f"Sesión '{session_id}' creada exitosamente.")
 
+def post_agent_run(user_id: str, session_id: str, payload: dict, read_timeout: float = 25) -> requests.Response:
+    """
+    Envía un turno al endpoint `/run` del agente.
+
+    Si el agente responde 404 (la sesión ya no existe, p. ej. tras reiniciarse
+    el servicio con sesiones en memoria), se invalida la sesión en la caché,
+    se vuelve a crear y se reintenta el turno una sola vez.
+    """
+    response = agent_http.post(f"{AGENT_API_URL}/run", json=payload, timeout=(AGENT_CONNECT_TIMEOUT, read_timeout))
+    if response.status_code == 404:
+        app.logger.warning(f"El agente no encontró la sesión '{session_id}'. Recreándola y reintentando el turno.")
+        known_agent_sessions.discard((user_id, session_id))
+        ensure_agent_session_exists(user_id, session_id)
+        response = agent_http.post(f"{AGENT_API_URL}/run", json=payload, timeout=(AGENT_CONNECT_TIMEOUT, read_timeout))
+    return response
+
+def stream_agent_text(user_id: str, session_id: str, payload: dict, read_timeout: float = 25):
+    """
+    Envía un turno al endpoint `/run_sse` del agente y produce los fragmentos de
+    texto a medida que llegan los eventos.
+
+    Con `streaming` activado, ADK emite eventos parciales (`partial: true`) con
+    el texto incremental y después un evento final con el texto completo de ese
+    mensaje; ese evento agregado se omite para no repetir el texto.
+
+    Lanza `requests.exceptions.RequestException` ante errores HTTP o de red y
+    `ValueError` si un evento no es JSON válido o reporta un error.
+    """
+    sse_payload = {**payload, "streaming": True}
+    timeout = (AGENT_CONNECT_TIMEOUT, read_timeout)
+    response = agent_http.post(f"{AGENT_API_URL}/run_sse", json=sse_payload, stream=True, timeout=timeout)
+    if response.status_code == 404:
+        record_agent_stream(response)
+        response.close()
+        app.logger.warning(f"El agente no encontró la sesión '{session_id}'. Recreándola y reintentando el turno.")
+        known_agent_sessions.discard((user_id, session_id))
+        ensure_agent_session_exists(user_id, session_id)
+        response = agent_http.post(f"{AGENT_API_URL}/run_sse", json=sse_payload, stream=True, timeout=timeout)
+
+    with response:
+        if not response.ok:
+            # Un 4xx es una respuesta válida del agente para el circuito.
+            record_agent_stream(response)
+        response.raise_for_status()
+        pending_partial = False
+        error = None
+        try:
+            # chunk_size=None entrega los datos según llegan, sin esperar a llenar un búfer.
+            for line in response.iter_lines(chunk_size=None):
+                if not line.startswith(b"data:"):
+                    continue
+                event = json.loads(line[len(b"data:"):].decode("utf-8"))
+                if "error" in event:
+                    raise ValueError(f"El agente reportó un error en el stream: {event['error']}")
+
+                text = "".join(extract_agent_messages([event]))
+                if event.get("partial"):
+                    pending_partial = True
+                    if text:
+                        yield text
+                elif pending_partial:
+                    pending_partial = False
+                elif text:
+                    yield text
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # El circuito mide el stream completo: un stream lento o cortado cuenta como fallo.
+            record_agent_stream(response, error)
+
+def extract_agent_messages(response_data) -> list:
+    """
+    Extrae las partes de texto de la respuesta de `/run` del agente,
+    ignorando las llamadas a funciones y las partes vacías.
+    """
+    agent_messages = []
+    if isinstance(response_data, list):
+        for turn in response_data:
+            if 'content' in turn and 'parts' in turn['content']:
+                for part in turn['content']['parts']:
+                    if 'text' in part and part.get('text'):
+                        agent_messages.append(part['text'])
+    return agent_messages
+
+def split_sms_reply(agent_messages: list) -> list:
+    """
+    Une las partes de texto del agente y las separa por saltos de línea,
+    descartando las líneas vacías (lógica del script de pruebas).
+    """
+    full_response = "".join(agent_messages).strip()
+    return [msg.strip() for msg in full_response.split('\n') if msg.strip()]
+
 @app.route('/sms/receive', methods=['POST'])
+@observe_webhook("sms")
+@idempotent_webhook("sms", fallback=_sms_dedupe_fallback)
 def receive_sms():
     """
     Recibe un SMS de Twilio, lo procesa con el agente y envía una o más respuestas.
+
+    En modo "async" (SMS_PROCESSING_MODE) el turno se encola y el webhook responde
+    de inmediato con un MessagingResponse vacío, sin esperar al agente.
+
+    Con SMS_COALESCE_WINDOW_MS, los mensajes del mismo remitente que llegan
+    dentro de la ventana (al mismo worker) se unen en un solo turno del agente,
+    que se procesa en segundo plano: el webhook no espera a que cierre la ventana.
     """
     # Extraer datos del webhook de Twilio
     from_number = request.values.get('From', None)
@@ -90,26 +1280,83 @@ def receive_sms():
     if not from_number or not message_body:
         app.logger.warning("Webhook de Twilio recibido sin 'From' o 'Body'.")
         return str(MessagingResponse()), 200
- 
+
+    received_at = time.monotonic()
+
+    if SMS_COALESCE_WINDOW_MS > 0:
+        if sms_coalescer.add(from_number, message_body):
+            # El temporizador procesa el lote al cerrar la ventana; ningún hilo del webhook queda esperando.
+            _schedule_coalesced_sms_flush(from_number, sms_coalescer.window)
+        else:
+            # Otro webhook ya abrió un lote para este remitente y lo procesará.
+            app.logger.info(f"SMS de {from_number} agregado al turno en espera.")
+        return str(MessagingResponse()), 200
+
+    if SMS_PROCESSING_MODE == "async":
+        if sms_turn_queue.submit(process_sms_turn, from_number, message_body):
+            return str(MessagingResponse()), 200
+        # Si la cola está llena, se procesa en este mismo hilo para no perder el mensaje.
+        app.logger.warning(f"Cola de SMS llena. Procesando el turno de {from_number} de forma síncrona.")
+
+    inline_deadline = received_at + SMS_INLINE_BUDGET if SMS_DELIVERY_MODE == "inline" else None
+    dedupe_key = _webhook_dedupe_key("sms") if webhook_dedupe_store else None
+    twiml_response = MessagingResponse()
+    for text_body in process_sms_turn(from_number, message_body, inline_deadline, dedupe_key):
+        twiml_response.message(text_body)
+    return str(twiml_response), 200
+
+def process_sms_turn(from_number: str, message_body: str, inline_deadline: float = None, dedupe_key: str = None) -> list:
+    """
+    Ejecuta un turno completo de SMS: asegura la sesión, consulta al agente y
+    entrega las respuestas.
+
+    Si se indica `inline_deadline` (en `time.monotonic()`) y las respuestas
+    están listas antes de ese momento, se devuelven para que el webhook las
+    incluya como `<Message>` en su TwiML, salvo que un reintento del webhook
+    (`dedupe_key`) haya pedido el envío por REST. En cualquier otro caso se
+    envían por la API REST de Twilio y se devuelve una lista vacía.
+    """
+    # Los turnos de un mismo remitente se serializan para que no corran en
+    # paralelo contra la misma sesión del agente y las respuestas salgan en orden.
+    with session_turn_locks.hold(from_number):
+        responses_to_send = build_sms_replies(from_number, message_body)
+
+        if inline_deadline is not None:
+            if sms_rest_requested(dedupe_key):
+                # Twilio reintentó el webhook: el TwiML de esta entrega ya no le llegaría.
+                stats.incr("sms_delivery.rest_after_retry")
+                app.logger.warning(f"Twilio reintentó el webhook de {from_number}. Las respuestas se envían por REST.")
+            elif time.monotonic() < inline_deadline:
+                stats.incr("sms_delivery.inline_turns")
+                app.logger.info(f"Entregando {len(responses_to_send)} respuesta(s) a {from_number} en el TwiML.")
+                return responses_to_send
+            else:
+                # El webhook ya no llegaría a tiempo: Twilio descartaría el TwiML.
+                stats.incr("sms_delivery.late_turns")
+                app.logger.warning(f"La respuesta para {from_number} superó el tiempo para TwiML. Se envía por REST.")
+
+        stats.incr("sms_delivery.rest_turns")
+        send_sms_replies(from_number, responses_to_send)
+        return []
+
+def build_sms_replies(from_number: str, message_body: str) -> list:
+    """
+    Asegura la sesión, consulta al agente y devuelve la lista de mensajes de
+    respuesta, ya empaquetados según SMS_PACKING_MODE. Ante errores devuelve
+    el mensaje de disculpa correspondiente.
+    """
     # Usar el número de teléfono como ID de sesión y de usuario para mantener el contexto
     session_id = from_number
     user_id = from_number
  
     try:
         # --- Creación/Verificación de Sesión ---
-        ensure_agent_session_exists(user_id, session_id)
+        with observe_stage("sms", "agent_session"):
+            ensure_agent_session_exists(user_id, session_id)
     except requests.exceptions.RequestException as e:
         app.logger.error(f"Error crítico al crear/verificar la sesión '{session_id}': {e}")
         # Informar al usuario que hay un problema de sistema
-        error_message = "Lo siento, estamos teniendo problemas para iniciar la conversación. Por favor, intenta de nuevo en unos minutos."
-        try:
-            client = get_twilio_client()
-            client.messages.create(to=from_number, from_=TWILIO_PHONE_NUMBER, body=error_message)
-        except TwilioRestException as twilio_e:
-            app.logger.error(f"Fallo al enviar SMS de error de sesión a {from_number}: {twilio_e.msg}")
-
-        # Devolvemos 200 a Twilio para que no reintente el webhook.
-        return str(MessagingResponse()), 200
+        return [SMS_SESSION_ERROR_MESSAGE]
 
     # 1. Construir el payload para el agente
     payload = {
@@ -126,50 +1373,124 @@ def receive_sms():
  
     try:
         # 2. Enviar el mensaje al agente y procesar la respuesta
-        agent_response = requests.post(f"{AGENT_API_URL}/run", json=payload, timeout=25)
-        agent_response.raise_for_status()
+        with observe_stage("sms", "agent_run"):
+            agent_response = post_agent_run(user_id, session_id, payload, read_timeout=25)
+            agent_response.raise_for_status()
         response_data = agent_response.json()
 
         # 3. Extraer la respuesta de texto del agente
-        agent_messages = []
-        if isinstance(response_data, list):
-            for turn in response_data:
-                if 'content' in turn and 'parts' in turn['content']:
-                    for part in turn['content']['parts']:
-                        if 'text' in part and part.get('text'):
-                            agent_messages.append(part['text'])
+        agent_messages = extract_agent_messages(response_data)
         
-        if agent_messages:
-            full_response = "".join(agent_messages).strip()
-            # Aplicamos la lógica del script de pruebas: separamos por saltos de línea
-            individual_responses = [msg.strip() for msg in full_response.split('\n') if msg.strip()]
-            if individual_responses:
-                responses_to_send.extend(individual_responses)
+        responses_to_send.extend(split_sms_reply(agent_messages))
  
     except (requests.exceptions.RequestException, ValueError, KeyError) as e:
         app.logger.error(f"Error procesando la respuesta del agente para {session_id}: {e}")
         # Dejamos la lista responses_to_send vacía para que se envíe el mensaje de error por defecto.
         pass
  
+    return finalize_sms_replies(from_number, responses_to_send)
+
+def finalize_sms_replies(from_number: str, responses_to_send: list) -> list:
+    """
+    Aplica el mensaje por defecto si el agente no respondió y empaqueta las
+    respuestas según SMS_PACKING_MODE.
+    """
     # 4. Si no se pudo obtener una respuesta del agente, usar un mensaje por defecto.
     if not responses_to_send:
-        responses_to_send.append("Lo siento, no pude procesar tu solicitud en este momento.")
- 
-    # 5. Enviar todas las respuestas preparadas como mensajes SMS separados.
+        responses_to_send = [SMS_AGENT_ERROR_MESSAGE]
+
+    if SMS_PACKING_MODE == "packed":
+        packed_responses = pack_sms_messages(responses_to_send, SMS_MAX_SEGMENTS_PER_MESSAGE, SMS_MAX_MESSAGES_PER_REPLY)
+        segments_before = sum(sms_segment_count(text) for text in responses_to_send)
+        segments_after = sum(sms_segment_count(text) for text in packed_responses)
+        stats.incr("sms_packing.api_calls_unpacked", len(responses_to_send))
+        stats.incr("sms_packing.api_calls_sent", len(packed_responses))
+        stats.incr("sms_packing.segments_unpacked", segments_before)
+        stats.incr("sms_packing.segments_sent", segments_after)
+        app.logger.info(
+            f"Respuesta para {from_number} empaquetada: {len(responses_to_send)} -> {len(packed_responses)} mensajes, "
+            f"{segments_before} -> {segments_after} segmentos."
+        )
+        responses_to_send = packed_responses
+
+    return responses_to_send
+
+def send_sms_replies(from_number: str, responses_to_send: list):
+    """Envía las respuestas como mensajes SMS separados por la API REST de Twilio."""
     try:
         client = get_twilio_client()
         for i, text_body in enumerate(responses_to_send):
-            client.messages.create(to=from_number, from_=TWILIO_PHONE_NUMBER, body=text_body)
+            with observe_stage("sms", "twilio_send"):
+                client.messages.create(to=from_number, from_=TWILIO_PHONE_NUMBER, body=text_body)
             app.logger.info(f"Respuesta ({i+1}/{len(responses_to_send)}) enviada a {from_number}: '{text_body}'")
             # Simulamos una pausa entre mensajes para una experiencia más natural, como en el script de prueba.
             if len(responses_to_send) > 1 and i < len(responses_to_send) - 1:
-                time.sleep(1.5)
+                with observe_stage("sms", "reply_pause"):
+                    time.sleep(1.5)
     except TwilioRestException as e:
         app.logger.error(f"Error de Twilio al enviar respuesta a {from_number}: {e.msg}")
- 
-    return str(MessagingResponse()), 200
+
+# Mensajes de voz por tipo de error del agente: (texto a decir, colgar la llamada).
+VOICE_AGENT_ERROR_MESSAGES = {
+    "connection": ("No es posible conectarnos con el agente en este momento. El servicio parece no estar en ejecución. Por favor, intente de nuevo en unos minutos.", True),
+    "timeout": ("Nuestro sistema está tardando más de lo normal en responder. ¿Podría repetir su consulta, por favor?", False),
+    "http": ("Hemos encontrado un error interno en nuestro sistema. Nuestro equipo técnico ya ha sido notificado. Por favor, intente llamar de nuevo más tarde.", True),
+    "format": ("Hemos recibido una respuesta con un formato inesperado. ¿Podría intentar su consulta de nuevo?", False),
+    "network": ("Se ha producido un error de comunicación de red. Por favor, intente de nuevo.", True),
+}
+
+def voice_agent_error_message(error: Exception, session_id: str) -> tuple:
+    """
+    Traduce un error al consultar al agente en el mensaje que se le dice al
+    llamante y en si la llamada debe terminarse.
+
+    Returns:
+        tuple: (texto a decir, True si se debe colgar).
+    """
+    if isinstance(error, requests.exceptions.ConnectionError):
+        app.logger.error(f"Error de conexión con el agente para la llamada {session_id}: {error}")
+        return VOICE_AGENT_ERROR_MESSAGES["connection"]
+
+    if isinstance(error, requests.exceptions.Timeout):
+        app.logger.error(f"Timeout al conectar con el agente para la llamada {session_id}: {error}")
+        return VOICE_AGENT_ERROR_MESSAGES["timeout"]
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        app.logger.error(f"Error HTTP del agente para la llamada {session_id}: {error}")
+        return VOICE_AGENT_ERROR_MESSAGES["http"]
+
+    if isinstance(error, (ValueError, KeyError)):
+        # Error al decodificar JSON o al acceder a una clave esperada.
+        app.logger.error(f"Error de formato en la respuesta del agente para la llamada {session_id}: {error}")
+        return VOICE_AGENT_ERROR_MESSAGES["format"]
+
+    # Cualquier otra excepción de la librería requests.
+    app.logger.error(f"Error de red inesperado con el agente para la llamada {session_id}: {error}")
+    return VOICE_AGENT_ERROR_MESSAGES["network"]
+
+def build_voice_twiml(agent_text_response: str, should_hangup: bool) -> VoiceResponse:
+    """
+    Construye la respuesta TwiML final de un turno de voz: decir el texto y
+    colgar, o decirlo dentro de un Gather para escuchar el siguiente turno.
+    """
+    twiml_response = VoiceResponse()
+    # Si debemos colgar, solo decimos el mensaje y colgamos.
+    if should_hangup:
+        twiml_response.say(agent_text_response, language='es-MX', voice='Polly.Mia-Neural')
+        twiml_response.hangup()
+    else:
+        # Si no, continuamos la conversación con Gather.
+        gather = Gather(input='speech', speechTimeout='auto', language='es-US', action='/voice')
+        if agent_text_response:
+            gather.say(agent_text_response, language='es-MX', voice='Polly.Mia-Neural')
+        twiml_response.append(gather)
+
+        twiml_response.redirect('/voice')
+    return twiml_response
 
 @app.route("/voice", methods=['POST'])
+@observe_webhook("voice")
+@idempotent_webhook("voice", fallback=_voice_dedupe_fallback)
 def voice_webhook():
     """Maneja las llamadas de voz entrantes y las respuestas del agente."""
     twiml_response = VoiceResponse()
@@ -182,10 +1503,7 @@ def voice_webhook():
     # Validar que tengamos los identificadores necesarios para la sesión.
     if not call_sid or not from_number:
         app.logger.error("Webhook de voz recibido sin CallSid o From.")
-        twiml_response.say(
-            "Lo siento, ha ocurrido un error de sistema. Por favor, intente llamar de nuevo más tarde.",
-            language='es-MX', voice='Polly.Mia-Neural'
-        )
+        twiml_response.say(VOICE_MISSING_PARAMS_MESSAGE, language='es-MX', voice='Polly.Mia-Neural')
         twiml_response.hangup()
         return str(twiml_response), 200, {'Content-Type': 'text/xml'}
 
@@ -196,13 +1514,11 @@ def voice_webhook():
 
     # --- Creación/Verificación de Sesión con el Agente ---
     try:
-        ensure_agent_session_exists(user_id, session_id)
+        with observe_stage("voice", "agent_session"):
+            ensure_agent_session_exists(user_id, session_id)
     except requests.exceptions.RequestException as e:
         app.logger.error(f"Error crítico al crear/verificar la sesión de voz '{session_id}': {e}")
-        twiml_response.say(
-            "Lo siento, estamos teniendo problemas para iniciar la conversación. Por favor, intente llamar de nuevo en unos minutos.",
-            language='es-MX', voice='Polly.Mia-Neural'
-        )
+        twiml_response.say(VOICE_SESSION_ERROR_MESSAGE, language='es-MX', voice='Polly.Mia-Neural')
         twiml_response.hangup()
         return str(twiml_response), 200, {'Content-Type': 'text/xml'}
 
@@ -218,78 +1534,497 @@ def voice_webhook():
         }
     }
 
+    if VOICE_CALLER_PREFETCH:
+        # El primer turno (sin voz) dispara la búsqueda; el siguiente turno la siembra.
+        state_delta = caller_prefetch_state_delta(call_sid)
+        if state_delta:
+            payload["state_delta"] = state_delta
+        elif not user_speech:
+            start_caller_prefetch(call_sid, from_number)
+
+    if VOICE_RESPONSE_MODE == "stream":
+        return start_streamed_voice_turn(call_sid, user_id, session_id, payload)
+    if VOICE_RESPONSE_MODE == "hold":
+        return start_held_voice_turn(call_sid, user_id, session_id, payload)
+
+    agent_text_response, should_hangup = run_voice_agent_turn(user_id, session_id, payload, read_timeout=25)
+
+    # --- Generación de TwiML para la Respuesta ---
+    twiml_response = build_voice_twiml(agent_text_response, should_hangup)
+    return str(twiml_response), 200, {'Content-Type': 'text/xml'}
+
+def run_voice_agent_turn(user_id: str, session_id: str, payload: dict, read_timeout: float) -> tuple:
+    """
+    Ejecuta un turno de voz completo contra `/run` del agente.
+
+    Returns:
+        tuple: (texto a decir al llamante, True si se debe colgar).
+    """
+    with session_turn_locks.hold(session_id):
+        return _call_voice_agent(user_id, session_id, payload, read_timeout)
+
+def _call_voice_agent(user_id: str, session_id: str, payload: dict, read_timeout: float) -> tuple:
+    """Cuerpo de `run_voice_agent_turn`, sin el bloqueo de la sesión."""
     agent_text_response = ""
     should_hangup = False # Flag para determinar si la llamada debe terminarse.
 
     try:
         # 2. Enviar el mensaje al agente y procesar la respuesta.
-        agent_api_response = requests.post(f"{AGENT_API_URL}/run", json=payload, timeout=25)
-        agent_api_response.raise_for_status() # Lanza HTTPError para 4xx/5xx
+        with observe_stage("voice", "agent_run"):
+            agent_api_response = post_agent_run(user_id, session_id, payload, read_timeout=read_timeout)
+            agent_api_response.raise_for_status() # Lanza HTTPError para 4xx/5xx
         response_data = agent_api_response.json()
 
         # 3. Extraer la respuesta de texto del agente.
-        agent_messages = []
-        if isinstance(response_data, list):
-            for turn in response_data:
-                if 'content' in turn and 'parts' in turn['content']:
-                    for part in turn['content']['parts']:
-                        if 'text' in part and part.get('text'):
-                            agent_messages.append(part['text'])
-        
+        agent_messages = extract_agent_messages(response_data)
+    
         if agent_messages:
             # Para voz, unimos todas las partes en una sola respuesta.
             agent_text_response = "".join(agent_messages).strip()
         else:
             # El agente respondió, pero sin texto.
             app.logger.warning(f"El agente respondió sin contenido de texto para la llamada {session_id}.")
-            agent_text_response = "No he entendido lo que ha dicho. ¿Podría repetirlo, por favor?"
+            agent_text_response = VOICE_NO_TEXT_MESSAGE
 
-    except requests.exceptions.ConnectionError as e:
-        app.logger.error(f"Error de conexión con el agente para la llamada {session_id}: {e}")
-        agent_text_response = "No es posible conectarnos con el agente en este momento. El servicio parece no estar en ejecución. Por favor, intente de nuevo en unos minutos."
-        should_hangup = True
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        agent_text_response, should_hangup = voice_agent_error_message(e, session_id)
 
-    except requests.exceptions.Timeout as e:
-        app.logger.error(f"Timeout al conectar con el agente para la llamada {session_id}: {e}")
-        agent_text_response = "Nuestro sistema está tardando más de lo normal en responder. ¿Podría repetir su consulta, por favor?"
+    # Fallback final si, por alguna razón, la respuesta sigue vacía.
+    if not agent_text_response:
+        agent_text_response = VOICE_FALLBACK_MESSAGE
 
-    except requests.exceptions.HTTPError as e:
-        app.logger.error(f"Error HTTP del agente para la llamada {session_id}: {e}")
-        agent_text_response = "Hemos encontrado un error interno en nuestro sistema. Nuestro equipo técnico ya ha sido notificado. Por favor, intente llamar de nuevo más tarde."
-        should_hangup = True
+    app.logger.info(f"Respuesta del agente para la llamada {session_id}: '{agent_text_response}'")
+    return agent_text_response, should_hangup
 
-    except (ValueError, KeyError) as e:
-        # Error al decodificar JSON o al acceder a una clave esperada.
-        app.logger.error(f"Error de formato en la respuesta del agente para la llamada {session_id}: {e}")
-        agent_text_response = "Hemos recibido una respuesta con un formato inesperado. ¿Podría intentar su consulta de nuevo?"
+# --- Precarga del Contacto por Identificador de Llamada ---
+# Claves del estado de la sesión del agente (ver agent-sofia/sofia_agent/tools/states.py).
+CALLER_ID_STATE_PHONE = "phone"                        # State.Customer.PHONE
+CALLER_ID_STATE_CONTACTS = "case_caller_id_contacts"   # State.Case.CALLER_ID_CONTACTS
+CALLER_ID_CONTACT_FIELDS = ("Id", "FirstName", "LastName", "AccountId", "DOB__c", "Phone", "MobilePhone")
 
-    except requests.exceptions.RequestException as e:
-        # Captura cualquier otra excepción de la librería requests.
-        app.logger.error(f"Error de red inesperado con el agente para la llamada {session_id}: {e}")
-        agent_text_response = "Se ha producido un error de comunicación de red. Por favor, intente de nuevo."
-        should_hangup = True
+def build_salesforce_http_session() -> requests.Session:
+    """Sesión keep-alive con pool acotado hacia salesforce-api (misma configuración que `agent_http`)."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SALESFORCE_HTTP_POOL_SIZE, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    # Fallback final si, por alguna razón, la respuesta sigue vacía.
-    if not agent_text_response:
-        agent_text_response = "Lo siento, no pude procesar su solicitud en este momento. ¿Podría repetirlo, por favor?"
+def national_phone_digits(phone: str) -> str:
+    """
+    Dígitos del teléfono en el formato en que el cliente lo dicta (y que guarda
+    `extract_phone_number` del agente): sin el código de país por defecto cuando
+    el resto es un número nacional. '+15551234567' -> '5551234567'.
+    """
+    digits = re.sub(r'\D', '', phone or "")
+    national = digits[len(PHONE_DEFAULT_COUNTRY_CODE):]
+    if digits.startswith(PHONE_DEFAULT_COUNTRY_CODE) and len(national) == PHONE_NATIONAL_DIGITS:
+        return national
+    return digits
 
-    app.logger.info(f"Respuesta del agente para la llamada {session_id}: '{agent_text_response}'")
+salesforce_http = build_salesforce_http_session()
+salesforce_id_token = TTLCache("salesforce_id_token", 1, 45 * 60)
 
-    # --- Generación de TwiML para la Respuesta ---
-    # Si debemos colgar, solo decimos el mensaje y colgamos.
-    if should_hangup:
-        twiml_response.say(agent_text_response, language='es-MX', voice='Polly.Mia-Neural')
-        twiml_response.hangup()
-    else:
-        # Si no, continuamos la conversación con Gather.
-        gather = Gather(input='speech', speechTimeout='auto', language='es-US', action='/voice')
-        gather.say(agent_text_response, language='es-MX', voice='Polly.Mia-Neural')
-        twiml_response.append(gather)
+def _salesforce_api_headers() -> dict:
+    """Cabeceras para salesforce-api, con un token de identidad reutilizado mientras es válido."""
+    if not SALESFORCE_API_AUTH:
+        return {}
+    token = salesforce_id_token.get(SALESFORCE_API_URL)
+    if token is None:
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), SALESFORCE_API_URL)
+        salesforce_id_token.set(SALESFORCE_API_URL, token)
+    return {"Authorization": f"Bearer {token}"}
 
-        twiml_response.redirect('/voice')
+def _caller_prefetch_hit_rate() -> float:
+    counters = stats.snapshot_counters()
+    lookups = sum(counters.get(f"caller_prefetch.{outcome}", 0) for outcome in ("hits", "misses", "errors"))
+    return counters.get("caller_prefetch.hits", 0) / lookups if lookups else 0.0
+
+stats.register_gauge("caller_prefetch.hit_rate", _caller_prefetch_hit_rate)
 
+def start_caller_prefetch(call_sid: str, from_number: str):
+    """
+    Inicia en un hilo de fondo la búsqueda del número del llamante en
+    salesforce-api. El registro en `voice_turn_store` se crea con `add`, de modo
+    que los reintentos del webhook (o los Redirect sin voz) no repiten la búsqueda.
+    """
+    if not voice_turn_store.add(f"{call_sid}-prefetch", {"done": False}):
+        return
+    stats.incr("caller_prefetch.started")
+    threading.Thread(
+        target=_run_caller_prefetch,
+        args=(call_sid, from_number),
+        name=f"caller-prefetch-{call_sid}",
+        daemon=True,
+    ).start()
+
+def _run_caller_prefetch(call_sid: str, from_number: str):
+    """
+    Busca los contactos del número del llamante y guarda el `state_delta` a
+    sembrar en la sesión: siempre el teléfono y, si hubo coincidencias, los
+    contactos candidatos. El AccountId no se siembra: el número no identifica a
+    quien llama, y el agente lo toma del candidato solo cuando coinciden el nombre
+    (y la fecha de nacimiento o el teléfono al verificar).
+    """
+    started_at = time.monotonic()
+    state_delta = {CALLER_ID_STATE_PHONE: national_phone_digits(from_number)}
+    outcome = "misses"
+    try:
+        response = salesforce_http.post(
+            f"{SALESFORCE_API_URL}/contact/find/by-phone",
+            json={"phone": from_number},
+            headers=_salesforce_api_headers(),
+            timeout=(AGENT_CONNECT_TIMEOUT, CALLER_PREFETCH_TIMEOUT),
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+            contacts = response.json().get("contacts", [])
+            if contacts:
+                outcome = "hits"
+                state_delta[CALLER_ID_STATE_CONTACTS] = [
+                    {field: contact.get(field) for field in CALLER_ID_CONTACT_FIELDS} for contact in contacts
+                ]
+    except (requests.exceptions.RequestException, ValueError, google.auth.exceptions.GoogleAuthError) as e:
+        outcome = "errors"
+        app.logger.error(f"Error al precargar el contacto de la llamada {call_sid}: {e}")
+
+    elapsed = time.monotonic() - started_at
+    stats.incr(f"caller_prefetch.{outcome}")
+    stats.observe("caller_prefetch.lookup_seconds", elapsed)
+    stage_latency.labels("voice", "caller_prefetch", outcome).observe(elapsed)
+    app.logger.info(f"Precarga del contacto de la llamada {call_sid}: {outcome} en {elapsed:.3f}s.")
+    voice_turn_store.put(f"{call_sid}-prefetch", {"done": True, "applied": False, "outcome": outcome, "state_delta": state_delta, "lookup_seconds": elapsed})
+
+def caller_prefetch_state_delta(call_sid: str):
+    """
+    Devuelve el `state_delta` de la precarga de la llamada si ya terminó y aún
+    no se ha aplicado, o None. Cada precarga se aplica en un solo turno.
+
+    Con una coincidencia, el agente puede encontrar y verificar al cliente sin
+    volver a consultar Salesforce; la duración de la búsqueda, que quedó oculta
+    tras el saludo, se acumula como estimación del tiempo ahorrado.
+    """
+    key = f"{call_sid}-prefetch"
+    record = voice_turn_store.get(key)
+    if record is None or record.get("applied"):
+        return None
+    if not record["done"]:
+        stats.incr("caller_prefetch.late")
+        return None
+
+    voice_turn_store.put(key, {**record, "applied": True})
+    stats.incr("caller_prefetch.seeded")
+    if record["outcome"] == "hits":
+        stats.observe("caller_prefetch.saved_seconds", record["lookup_seconds"])
+    return record["state_delta"]
+
+# --- Turno de Voz en Segundo Plano con Frases de Espera ---
+def _next_voice_turn_number(call_sid: str) -> int:
+    """Devuelve el número del siguiente turno de la llamada (1, 2, 3...)."""
+    counter = voice_turn_store.get(f"{call_sid}-turns") or {"n": 0}
+    counter["n"] += 1
+    voice_turn_store.put(f"{call_sid}-turns", counter)
+    return counter["n"]
+
+def start_held_voice_turn(call_sid: str, user_id: str, session_id: str, payload: dict):
+    """
+    Inicia el turno de voz en un hilo de fondo, identificado por CallSid y
+    número de turno. Si el agente no responde dentro de VOICE_HOLD_GRACE, se
+    dice una frase de espera y se redirige a `/voice/poll`, que devuelve el
+    Gather real cuando el resultado está listo.
+    """
+    turn = _next_voice_turn_number(call_sid)
+    turn_key = f"{call_sid}-{turn}"
+    voice_turn_store.put(turn_key, {"text": "", "done": False, "hangup": False})
+    threading.Thread(
+        target=_produce_held_voice_turn,
+        args=(turn_key, call_sid, user_id, session_id, payload),
+        name=f"voice-hold-{turn_key}",
+        daemon=True,
+    ).start()
+
+    twiml_response = _held_voice_twiml(call_sid, turn, cycle=0, wait=VOICE_HOLD_GRACE)
+    return str(twiml_response), 200, {'Content-Type': 'text/xml'}
+
+@app.route("/voice/poll", methods=['POST'])
+@observe_webhook("voice", "poll_webhook")
+@idempotent_webhook("voice", fallback=_voice_dedupe_fallback)
+def voice_poll():
+    """
+    Consulta el resultado de un turno de voz en segundo plano. Devuelve el
+    Gather con la respuesta del agente si ya está lista, o una nueva frase de
+    espera y otro Redirect mientras no se agoten los ciclos permitidos.
+    """
+    call_sid = request.values.get('CallSid')
+    turn = request.args.get('turn', type=int)
+    cycle = request.args.get('cycle', 1, type=int)
+    if not call_sid or turn is None:
+        app.logger.error("Consulta de turno de voz recibida sin CallSid o número de turno.")
+        return str(build_voice_twiml("", False)), 200, {'Content-Type': 'text/xml'}
+
+    started_at = time.monotonic()
+    twiml_response = _held_voice_twiml(call_sid, turn, cycle, wait=VOICE_HOLD_POLL_WAIT)
+    stats.observe("voice_hold.poll_seconds", time.monotonic() - started_at)
     return str(twiml_response), 200, {'Content-Type': 'text/xml'}
 
+# Estados finales de una llamada según el callback de estado de Twilio.
+VOICE_CALL_ENDED_STATUSES = {"completed", "busy", "failed", "no-answer", "canceled"}
+
+@app.route("/voice/status", methods=['POST'])
+def voice_status():
+    """
+    Callback de estado de la llamada (configurar como "Call status changes" del
+    número en Twilio). Cuando la llamada termina se marca en `voice_turn_store`
+    para que un turno en segundo plano deje de esperar al agente y libere la sesión.
+    """
+    call_sid = request.values.get('CallSid')
+    call_status = request.values.get('CallStatus', '')
+    if call_sid and call_status in VOICE_CALL_ENDED_STATUSES:
+        voice_turn_store.put(f"{call_sid}-ended", {"status": call_status})
+        stats.incr("voice_status.ended")
+    return "", 204
+
+def voice_call_ended(call_sid: str) -> bool:
+    return voice_turn_store.get(f"{call_sid}-ended") is not None
+
+def _held_voice_twiml(call_sid: str, turn: int, cycle: int, wait: float) -> VoiceResponse:
+    """
+    Espera hasta `wait` segundos el resultado del turno y construye el TwiML:
+    la respuesta final, una frase de espera con Redirect, o una disculpa si se
+    agotaron los VOICE_MAX_HOLD_CYCLES.
+    """
+    turn_key = f"{call_sid}-{turn}"
+    deadline = time.monotonic() + wait
+    while True:
+        record = voice_turn_store.get(turn_key)
+        if record is None:
+            app.logger.error(f"No se encontró el turno de voz {turn_key}.")
+            return build_voice_twiml(VOICE_FALLBACK_MESSAGE, False)
+        if record["done"]:
+            voice_turn_store.delete(turn_key)
+            stats.observe("voice_hold.cycles", cycle)
+            return build_voice_twiml(record["text"], record["hangup"])
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(VOICE_STREAM_POLL_INTERVAL)
+
+    if cycle >= VOICE_MAX_HOLD_CYCLES:
+        app.logger.error(f"El turno de voz {turn_key} superó {VOICE_MAX_HOLD_CYCLES} ciclos de espera.")
+        stats.incr("voice_hold.abandoned")
+        # Se marca como cancelado (no se borra) para que el productor suelte la
+        # sesión de inmediato y descarte la respuesta en lugar de publicarla.
+        voice_turn_store.put(turn_key, {**record, "cancelled": True})
+        return build_voice_twiml(*VOICE_AGENT_ERROR_MESSAGES["timeout"])
+
+    twiml_response = VoiceResponse()
+    twiml_response.say(VOICE_HOLD_PHRASES[cycle % len(VOICE_HOLD_PHRASES)], language='es-MX', voice='Polly.Mia-Neural')
+    twiml_response.redirect(f'/voice/poll?turn={turn}&cycle={cycle + 1}')
+    return twiml_response
+
+def _produce_held_voice_turn(turn_key: str, call_sid: str, user_id: str, session_id: str, payload: dict):
+    """
+    Ejecuta el turno del agente y publica el resultado en `voice_turn_store`.
+
+    La llamada al agente corre en un hilo aparte mientras este hilo conserva el
+    bloqueo de la sesión; si el llamante cuelga, `/voice/poll` abandona el turno
+    o se agota VOICE_HOLD_AGENT_TIMEOUT, se deja de esperar y el bloqueo se libera
+    (la respuesta tardía se descarta).
+    """
+    result = {}
+    with session_turn_locks.hold(session_id):
+        if _held_voice_turn_cancelled(turn_key):
+            # El turno se abandonó mientras esperaba la sesión: no se llama al agente.
+            stats.incr("voice_hold.dropped")
+            voice_turn_store.delete(turn_key)
+            return
+        agent_call = threading.Thread(
+            target=lambda: result.update(value=_call_voice_agent(user_id, session_id, payload, VOICE_HOLD_AGENT_TIMEOUT)),
+            name=f"voice-hold-agent-{turn_key}",
+            daemon=True,
+        )
+        agent_call.start()
+        deadline = time.monotonic() + VOICE_HOLD_AGENT_TIMEOUT
+        while agent_call.is_alive():
+            agent_call.join(timeout=0.5)
+            if agent_call.is_alive() and voice_call_ended(call_sid):
+                app.logger.info(f"La llamada {call_sid} terminó durante el turno {turn_key}; se libera la sesión.")
+                stats.incr("voice_hold.cancelled")
+                voice_turn_store.delete(turn_key)
+                return
+            if agent_call.is_alive() and _held_voice_turn_cancelled(turn_key):
+                app.logger.info(f"El turno {turn_key} fue abandonado por /voice/poll; se libera la sesión.")
+                stats.incr("voice_hold.dropped")
+                voice_turn_store.delete(turn_key)
+                return
+            if agent_call.is_alive() and time.monotonic() >= deadline:
+                app.logger.error(f"El turno de voz {turn_key} superó {VOICE_HOLD_AGENT_TIMEOUT}s; se libera la sesión.")
+                stats.incr("voice_hold.expired")
+                result["value"] = VOICE_AGENT_ERROR_MESSAGES["timeout"]
+                break
+
+    if _held_voice_turn_cancelled(turn_key):
+        # Nadie recogerá la respuesta: no se deja un registro huérfano.
+        stats.incr("voice_hold.dropped")
+        voice_turn_store.delete(turn_key)
+        return
+    text, should_hangup = result.get("value") or (VOICE_FALLBACK_MESSAGE, False)
+    voice_turn_store.put(turn_key, {"text": text, "done": True, "hangup": should_hangup})
+
+def _held_voice_turn_cancelled(turn_key: str) -> bool:
+    """True si `/voice/poll` abandonó el turno (o su registro ya no existe)."""
+    record = voice_turn_store.get(turn_key)
+    return record is None or record.get("cancelled", False)
+
+# --- Respuesta de Voz en Streaming (SSE) ---
+def split_complete_sentences(text: str, offset: int = 0) -> int:
+    """
+    Devuelve la posición en `text` donde termina la última oración completa
+    posterior a `offset`, o `offset` si aún no hay ninguna oración completa.
+    """
+    end = offset
+    for match in SENTENCE_BOUNDARY.finditer(text, offset):
+        end = match.end()
+    return end
+
+def start_streamed_voice_turn(call_sid: str, user_id: str, session_id: str, payload: dict):
+    """
+    Inicia el turno de voz consumiendo `/run_sse` en un hilo de fondo y responde
+    con la primera oración completa en cuanto está disponible, seguida de un
+    Redirect a `/voice/continue` que sirve el resto del texto.
+    """
+    started_at = time.monotonic()
+    voice_turn_store.put(call_sid, {"text": "", "done": False, "hangup": False, "updated_at": time.time()})
+    threading.Thread(
+        target=_produce_streamed_voice_turn,
+        args=(call_sid, user_id, session_id, payload),
+        name=f"voice-stream-{call_sid}",
+        daemon=True,
+    ).start()
+
+    twiml_response = _next_streamed_voice_twiml(call_sid, 0, VOICE_FIRST_SENTENCE_TIMEOUT)
+    stats.observe("voice_stream.first_response_seconds", time.monotonic() - started_at)
+    return str(twiml_response), 200, {'Content-Type': 'text/xml'}
+
+@app.route("/voice/continue", methods=['POST'])
+@idempotent_webhook("voice", fallback=_voice_dedupe_fallback)
+def voice_continue():
+    """
+    Sirve el texto restante de un turno de voz en streaming a partir de la
+    posición `offset` ya dicha al llamante.
+    """
+    call_sid = request.values.get('CallSid')
+    offset = request.args.get('offset', 0, type=int)
+    if not call_sid:
+        app.logger.error("Continuación de voz recibida sin CallSid.")
+        return str(build_voice_twiml("", False)), 200, {'Content-Type': 'text/xml'}
+
+    twiml_response = _next_streamed_voice_twiml(call_sid, offset, VOICE_CONTINUE_TIMEOUT)
+    return str(twiml_response), 200, {'Content-Type': 'text/xml'}
+
+def _next_streamed_voice_twiml(call_sid: str, offset: int, timeout: float) -> VoiceResponse:
+    """
+    Espera hasta `timeout` segundos a que haya nuevas oraciones completas o a
+    que termine el turno, y construye el TwiML correspondiente.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        record = voice_turn_store.get(call_sid)
+        if record is None:
+            # El turno expiró o se generó en otra instancia.
+            app.logger.error(f"No se encontró el turno de voz en curso para la llamada {call_sid}.")
+            return build_voice_twiml(VOICE_FALLBACK_MESSAGE, False)
+
+        text = record["text"]
+        if record["done"]:
+            voice_turn_store.delete(call_sid)
+            return build_voice_twiml(text[offset:].strip(), record["hangup"])
+
+        end = split_complete_sentences(text, offset)
+        if time.time() - record.get("updated_at", time.time()) > VOICE_STREAM_STALE_SECONDS:
+            # El productor dejó de dar señales: se dice lo que quedó completo y el mensaje de respaldo.
+            app.logger.error(f"El turno de voz en streaming de la llamada {call_sid} dejó de avanzar; se termina con el mensaje de respaldo.")
+            stats.incr("voice_stream.producer_lost")
+            voice_turn_store.delete(call_sid)
+            return build_voice_twiml(f"{text[offset:end].strip()} {VOICE_FALLBACK_MESSAGE}".strip(), False)
+
+        if end > offset or time.monotonic() >= deadline:
+            twiml_response = VoiceResponse()
+            sentence = text[offset:end].strip()
+            if sentence:
+                twiml_response.say(sentence, language='es-MX', voice='Polly.Mia-Neural')
+            twiml_response.redirect(f'/voice/continue?offset={end}')
+            return twiml_response
+
+        time.sleep(VOICE_STREAM_POLL_INTERVAL)
+
+def _produce_streamed_voice_turn(call_sid: str, user_id: str, session_id: str, payload: dict):
+    """
+    Consume el stream del agente y publica el texto acumulado en
+    `voice_turn_store` cada vez que se completa una oración. Mientras llegan
+    fragmentos, refresca `updated_at` al menos una vez por segundo para que
+    `/voice/continue` distinga un turno lento de un productor muerto.
+    """
+    with session_turn_locks.hold(session_id):
+        text = ""
+        published = 0
+        finished = False
+        try:
+            with observe_stage("voice", "agent_stream"):
+                last_put = time.monotonic()
+                for chunk in stream_agent_text(user_id, session_id, payload, read_timeout=VOICE_STREAM_READ_TIMEOUT):
+                    text += chunk
+                    end = split_complete_sentences(text, published)
+                    if end > published or time.monotonic() - last_put >= 1:
+                        published = end
+                        last_put = time.monotonic()
+                        voice_turn_store.put(call_sid, {"text": text[:published], "done": False, "hangup": False, "updated_at": time.time()})
+            if not text.strip():
+                app.logger.warning(f"El agente respondió sin contenido de texto para la llamada {session_id}.")
+                text = VOICE_NO_TEXT_MESSAGE
+            app.logger.info(f"Respuesta del agente para la llamada {session_id}: '{text}'")
+            voice_turn_store.put(call_sid, {"text": text, "done": True, "hangup": False})
+            finished = True
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            error_text, should_hangup = voice_agent_error_message(e, session_id)
+            # Lo ya publicado se conserva; el mensaje de error se dice a continuación.
+            voice_turn_store.put(call_sid, {"text": f"{text[:published]} {error_text}", "done": True, "hangup": should_hangup})
+            finished = True
+        finally:
+            if not finished:
+                # Error no previsto: se cierra el turno para que la llamada no quede redirigiendo.
+                app.logger.error(f"El turno de voz en streaming de la llamada {session_id} terminó sin respuesta.")
+                voice_turn_store.put(call_sid, {"text": f"{text[:published]} {VOICE_FALLBACK_MESSAGE}", "done": True, "hangup": False})
+
+@app.route("/stats", methods=['GET'])
+def runtime_stats():
+    """Devuelve las estadísticas de ejecución del worker que atiende la petición."""
+    return jsonify(stats.snapshot()), 200
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    """
+    Expone las métricas en formato de texto de Prometheus. En modo multiproceso
+    se agregan las muestras de todos los workers de gunicorn de la instancia.
+    """
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+def metrics_registry():
+    """Registro a exportar: el agregado de los workers en modo multiproceso o el del proceso."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+@app.route("/health/agent", methods=['GET'])
+def agent_health():
+    """
+    Devuelve el estado del cortocircuito hacia el agente en el worker que
+    atiende la petición. Responde 503 mientras el circuito está abierto.
+    """
+    circuit = agent_circuit.describe()
+    return jsonify(circuit), 503 if circuit["state"] == "open" else 200
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,434 @@
+"""
+Variante ASGI de twilio-api.
+
+Expone las mismas rutas (`/sms/receive`, `/voice`) y genera el mismo TwiML que
+`app.py`, pero atiende cada turno como una corrutina: las llamadas al agente
+usan `httpx.AsyncClient` y los envíos de SMS usan el cliente asíncrono de
+Twilio. Mientras un turno espera al agente no ocupa un hilo, así que una sola
+instancia puede mantener cientos de conversaciones en curso en lugar del límite
+de `--workers x --threads` de gunicorn.
+
+La configuración, los mensajes y las utilidades sin E/S (extracción de texto,
+empaquetado de SMS, construcción del TwiML) se reutilizan de `app.py`. Esta
+variante cubre la ruta principal de SMS y voz (modo "sync" de voz, entrega
+"rest" o "inline" y modo "async" de SMS), más `/stats`, `/metrics` y
+`/health/agent`. No implementa VOICE_RESPONSE_MODE=stream/hold (ni sus rutas
+`/voice/poll`, `/voice/continue` y `/voice/status`), SMS_COALESCE_WINDOW_MS,
+WEBHOOK_DEDUPE_STORE ni VOICE_CALLER_PREFETCH: si alguno está configurado, el
+worker no arranca (ver `UNSUPPORTED_SETTINGS`).
+
+En modo "async" los turnos de SMS pasan por una cola acotada
+(SMS_QUEUE_MAXSIZE) atendida por SMS_QUEUE_WORKERS tareas, igual que la cola
+de hilos de la versión Flask. Los turnos de una misma sesión se serializan con
+un `asyncio.Lock` por sesión; como en el backend "memory" de la versión Flask,
+la serialización es por proceso, así que conviene un solo worker por instancia.
+
+Ejecución:
+    gunicorn -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.rest import Client
+from twilio.twiml.messaging_response import MessagingResponse
+from twilio.twiml.voice_response import VoiceResponse
+
+import app as wsgi_app
+
+logger = logging.getLogger("twilio-api.asgi")
+
+# Conexiones simultáneas hacia el agente por proceso. A diferencia del pool de la
+# versión Flask, no está atado al número de hilos.
+ASGI_AGENT_MAX_CONNECTIONS = int(os.environ.get("ASGI_AGENT_MAX_CONNECTIONS", 200))
+# HTTP/2 multiplexa los turnos sobre pocas conexiones TLS hacia Cloud Run.
+AGENT_HTTP2 = os.environ.get("AGENT_HTTP2", "false").lower() == "true"
+
+agent_client: httpx.AsyncClient = None
+twilio_async_client = None
+
+# Opciones de `app.py` que esta variante no implementa. Se rechazan al arrancar en
+# lugar de ignorarlas: el TwiML de esos modos redirige a rutas que aquí no existen.
+UNSUPPORTED_SETTINGS = {
+    "VOICE_RESPONSE_MODE": wsgi_app.VOICE_RESPONSE_MODE != "sync",
+    "SMS_COALESCE_WINDOW_MS": wsgi_app.SMS_COALESCE_WINDOW_MS > 0,
+    "WEBHOOK_DEDUPE_STORE": wsgi_app.WEBHOOK_DEDUPE_STORE != "off",
+    "VOICE_CALLER_PREFETCH": wsgi_app.VOICE_CALLER_PREFETCH,
+}
+unsupported = [name for name, configured in UNSUPPORTED_SETTINGS.items() if configured]
+if unsupported:
+    logging.critical(f"Error crítico: la variante ASGI no soporta {', '.join(unsupported)}. Quite esas variables o use la aplicación Flask (ASGI=false).")
+    sys.exit(1)
+
+def observe_webhook(channel: str, stage: str = "webhook"):
+    """Equivalente asíncrono de `app.observe_webhook`: registra la duración total del webhook."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            with wsgi_app.observe_stage(channel, stage):
+                return await view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- Serialización de Turnos por Sesión ---
+class AsyncSessionLocks:
+    """
+    Un `asyncio.Lock` por sesión con turnos en curso. Las entradas se eliminan
+    cuando nadie las usa; si la tabla se llena o la espera supera `timeout`, el
+    turno se procesa sin serializar, igual que `app.InProcessSessionLocks`.
+    """
+
+    def __init__(self, max_entries: int, timeout: float):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = {}  # sesión -> [lock, usuarios]
+        wsgi_app.stats.register_gauge("session_lock.active_sessions", lambda: len(self._entries))
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._entries) >= self.max_entries:
+                wsgi_app.stats.incr("session_lock.overflow")
+                logger.warning(f"Tabla de bloqueos de sesión llena. El turno de '{key}' no se serializa.")
+                yield
+                return
+            entry = self._entries[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        waited_at = time.monotonic()
+        try:
+            await asyncio.wait_for(entry[0].acquire(), timeout=self.timeout)
+            acquired = True
+        except asyncio.TimeoutError:
+            acquired = False
+            wsgi_app.stats.incr("session_lock.timeouts")
+            logger.warning(f"Tiempo de espera agotado para el turno de la sesión '{key}'. Se procesa sin serializar.")
+        wsgi_app.stats.observe("session_lock.wait_seconds", time.monotonic() - waited_at)
+        try:
+            yield
+        finally:
+            if acquired:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._entries[key]
+
+session_turn_locks = AsyncSessionLocks(wsgi_app.SESSION_LOCK_TABLE_SIZE, wsgi_app.SESSION_LOCK_TIMEOUT)
+
+# --- Cola de Trabajo para Turnos en Segundo Plano ---
+class AsyncTurnQueue:
+    """
+    Cola acotada de turnos atendida por un número fijo de tareas, equivalente a
+    `app.TurnQueue`. Las tareas se crean en `start` (desde el lifespan) y viven
+    mientras viva el event loop.
+    """
+
+    def __init__(self, name: str, maxsize: int, workers: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        wsgi_app.stats.register_gauge(f"{name}.depth", lambda: self._queue.qsize() if self._queue else 0)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker_loop(), name=f"{self.name}-{i}") for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _worker_loop(self):
+        while True:
+            enqueued_at, func, args = await self._queue.get()
+            wsgi_app.stats.observe(f"{self.name}.wait_seconds", time.monotonic() - enqueued_at)
+            started_at = time.monotonic()
+            try:
+                await func(*args)
+                wsgi_app.stats.incr(f"{self.name}.completed")
+            except Exception as e:
+                wsgi_app.stats.incr(f"{self.name}.failed")
+                logger.error(f"Error no controlado en la cola '{self.name}': {e}")
+            finally:
+                wsgi_app.stats.observe(f"{self.name}.processing_seconds", time.monotonic() - started_at)
+                self._queue.task_done()
+
+    def submit(self, func, *args) -> bool:
+        """Encola `func(*args)` sin esperar; devuelve False si la cola está llena."""
+        try:
+            self._queue.put_nowait((time.monotonic(), func, args))
+        except asyncio.QueueFull:
+            wsgi_app.stats.incr(f"{self.name}.rejected")
+            return False
+        wsgi_app.stats.incr(f"{self.name}.submitted")
+        return True
+
+sms_turn_queue = AsyncTurnQueue("sms_queue", wsgi_app.SMS_QUEUE_MAXSIZE, wsgi_app.SMS_QUEUE_WORKERS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Crea el cliente HTTP compartido hacia el agente y la cola de SMS, y los cierra al apagar."""
+    global agent_client
+    agent_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(25, connect=wsgi_app.AGENT_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=ASGI_AGENT_MAX_CONNECTIONS, max_keepalive_connections=ASGI_AGENT_MAX_CONNECTIONS),
+        http2=AGENT_HTTP2,
+    )
+    sms_turn_queue.start()
+    yield
+    await sms_turn_queue.stop()
+    await agent_client.aclose()
+    if twilio_async_client is not None:
+        await twilio_async_client.http_client.close()
+
+app = FastAPI(title="twilio-api", lifespan=lifespan)
+
+def get_twilio_async_client() -> Client:
+    """Cliente singleton de Twilio con transporte asíncrono (aiohttp)."""
+    global twilio_async_client
+    if twilio_async_client is None:
+        logger.info("Estableciendo nueva conexión asíncrona con Twilio...")
+        twilio_async_client = Client(wsgi_app.ACCOUNT_SID, wsgi_app.AUTH_TOKEN, http_client=AsyncTwilioHttpClient())
+    return twilio_async_client
+
+class AgentUnavailableError(httpx.ConnectError):
+    """El cortocircuito hacia el agente está abierto y la llamada no se intentó."""
+
+async def agent_post(url: str, **kwargs) -> httpx.Response:
+    """
+    POST al agente a través del mismo cortocircuito (`app.agent_circuit`) que
+    usa la versión Flask: con el circuito abierto falla de inmediato y cada
+    resultado se reporta al circuito (errores de red y 5xx cuentan como fallos).
+    """
+    circuit = wsgi_app.agent_circuit
+    if not circuit.allow():
+        raise AgentUnavailableError("Cortocircuito abierto: el agente no está disponible.")
+
+    started_at = time.monotonic()
+    try:
+        response = await agent_client.post(url, **kwargs)
+    except Exception:
+        circuit.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        circuit.record_failure()
+    else:
+        circuit.record_success(time.monotonic() - started_at)
+    return response
+
+async def ensure_agent_session_exists(user_id: str, session_id: str):
+    """
+    Versión asíncrona de `app.ensure_agent_session_exists`: comparte la caché
+    de sesiones conocidas y trata el 400 del agente como sesión existente.
+
+    Lanza `httpx.HTTPError` si la API devuelve un error inesperado.
+    """
+    if wsgi_app.known_agent_sessions.get((user_id, session_id)):
+        return
+
+    create_session_url = f"{wsgi_app.AGENT_API_URL}/apps/{wsgi_app.AGENT_APP_NAME}/users/{user_id}/sessions/{session_id}"
+    logger.info(f"Asegurando que la sesión '{session_id}' exista para el usuario '{user_id}'.")
+    response = await agent_post(create_session_url, timeout=httpx.Timeout(15, connect=wsgi_app.AGENT_CONNECT_TIMEOUT))
+    if response.status_code != 400:
+        response.raise_for_status()
+    wsgi_app.known_agent_sessions.set((user_id, session_id))
+
+async def post_agent_run(user_id: str, session_id: str, payload: dict) -> httpx.Response:
+    """Envía un turno a `/run`; ante un 404 recrea la sesión y reintenta una vez."""
+    response = await agent_post(f"{wsgi_app.AGENT_API_URL}/run", json=payload)
+    if response.status_code == 404:
+        logger.warning(f"El agente no encontró la sesión '{session_id}'. Recreándola y reintentando el turno.")
+        wsgi_app.known_agent_sessions.discard((user_id, session_id))
+        await ensure_agent_session_exists(user_id, session_id)
+        response = await agent_post(f"{wsgi_app.AGENT_API_URL}/run", json=payload)
+    return response
+
+def _agent_payload(user_id: str, session_id: str, text: str) -> dict:
+    return {
+        "app_name": wsgi_app.AGENT_APP_NAME,
+        "user_id": user_id,
+        "session_id": session_id,
+        "new_message": {
+            "role": "user",
+            "parts": [{"text": text}]
+        }
+    }
+
+async def build_sms_replies(from_number: str, message_body: str) -> list:
+    """Equivalente asíncrono de `app.build_sms_replies`."""
+    session_id = from_number
+    user_id = from_number
+    try:
+        await ensure_agent_session_exists(user_id, session_id)
+    except httpx.HTTPError as e:
+        logger.error(f"Error crítico al crear/verificar la sesión '{session_id}': {e}")
+        return [wsgi_app.SMS_SESSION_ERROR_MESSAGE]
+
+    responses_to_send = []
+    try:
+        agent_response = await post_agent_run(user_id, session_id, _agent_payload(user_id, session_id, message_body))
+        agent_response.raise_for_status()
+        agent_messages = wsgi_app.extract_agent_messages(agent_response.json())
+        responses_to_send.extend(wsgi_app.split_sms_reply(agent_messages))
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.error(f"Error procesando la respuesta del agente para {session_id}: {e}")
+
+    return wsgi_app.finalize_sms_replies(from_number, responses_to_send)
+
+async def send_sms_replies(from_number: str, responses_to_send: list):
+    """Envía las respuestas por la API REST de Twilio sin bloquear el event loop."""
+    try:
+        client = get_twilio_async_client()
+        for i, text_body in enumerate(responses_to_send):
+            await client.messages.create_async(to=from_number, from_=wsgi_app.TWILIO_PHONE_NUMBER, body=text_body)
+            logger.info(f"Respuesta ({i+1}/{len(responses_to_send)}) enviada a {from_number}: '{text_body}'")
+            if len(responses_to_send) > 1 and i < len(responses_to_send) - 1:
+                await asyncio.sleep(1.5)
+    except TwilioRestException as e:
+        logger.error(f"Error de Twilio al enviar respuesta a {from_number}: {e.msg}")
+
+async def process_sms_turn(from_number: str, message_body: str, inline_deadline: float = None) -> list:
+    """Equivalente asíncrono de `app.process_sms_turn`, serializado por remitente."""
+    async with session_turn_locks.hold(from_number):
+        responses_to_send = await build_sms_replies(from_number, message_body)
+
+        if inline_deadline is not None:
+            if time.monotonic() < inline_deadline:
+                wsgi_app.stats.incr("sms_delivery.inline_turns")
+                return responses_to_send
+            wsgi_app.stats.incr("sms_delivery.late_turns")
+            logger.warning(f"La respuesta para {from_number} superó el tiempo para TwiML. Se envía por REST.")
+
+        wsgi_app.stats.incr("sms_delivery.rest_turns")
+        await send_sms_replies(from_number, responses_to_send)
+        return []
+
+@app.post("/sms/receive")
+@observe_webhook("sms")
+async def receive_sms(request: Request):
+    """Recibe un SMS de Twilio, lo procesa con el agente y envía una o más respuestas."""
+    form = await request.form()
+    from_number = form.get('From')
+    message_body = form.get('Body')
+    logger.info(f"SMS recibido de {from_number}: '{message_body}'")
+
+    if not from_number or not message_body:
+        logger.warning("Webhook de Twilio recibido sin 'From' o 'Body'.")
+        return Response(str(MessagingResponse()), media_type="text/html")
+
+    received_at = time.monotonic()
+    if wsgi_app.SMS_PROCESSING_MODE == "async":
+        if sms_turn_queue.submit(process_sms_turn, from_number, message_body):
+            return Response(str(MessagingResponse()), media_type="text/html")
+        # Si la cola está llena, se procesa en esta misma petición para no perder el mensaje.
+        logger.warning(f"Cola de SMS llena. Procesando el turno de {from_number} dentro del webhook.")
+
+    inline_deadline = received_at + wsgi_app.SMS_INLINE_BUDGET if wsgi_app.SMS_DELIVERY_MODE == "inline" else None
+    twiml_response = MessagingResponse()
+    for text_body in await process_sms_turn(from_number, message_body, inline_deadline):
+        twiml_response.message(text_body)
+    return Response(str(twiml_response), media_type="text/html")
+
+def voice_agent_error_message(error: Exception, session_id: str) -> tuple:
+    """Traduce las excepciones de httpx a los mismos mensajes de voz de `app.py`."""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        logger.error(f"Error de conexión con el agente para la llamada {session_id}: {error}")
+        return wsgi_app.VOICE_AGENT_ERROR_MESSAGES["connection"]
+    if isinstance(error, httpx.TimeoutException):
+        logger.error(f"Timeout al conectar con el agente para la llamada {session_id}: {error}")
+        return wsgi_app.VOICE_AGENT_ERROR_MESSAGES["timeout"]
+    if isinstance(error, httpx.HTTPStatusError):
+        logger.error(f"Error HTTP del agente para la llamada {session_id}: {error}")
+        return wsgi_app.VOICE_AGENT_ERROR_MESSAGES["http"]
+    if isinstance(error, (ValueError, KeyError)):
+        logger.error(f"Error de formato en la respuesta del agente para la llamada {session_id}: {error}")
+        return wsgi_app.VOICE_AGENT_ERROR_MESSAGES["format"]
+    logger.error(f"Error de red inesperado con el agente para la llamada {session_id}: {error}")
+    return wsgi_app.VOICE_AGENT_ERROR_MESSAGES["network"]
+
+def _twiml(twiml_response: VoiceResponse) -> Response:
+    return Response(str(twiml_response), media_type="text/xml")
+
+@app.post("/voice")
+@observe_webhook("voice")
+async def voice_webhook(request: Request):
+    """Maneja las llamadas de voz entrantes y las respuestas del agente."""
+    form = await request.form()
+    user_speech = form.get('SpeechResult', "")
+    call_sid = form.get('CallSid')
+    from_number = form.get('From')
+
+    if not call_sid or not from_number:
+        logger.error("Webhook de voz recibido sin CallSid o From.")
+        twiml_response = VoiceResponse()
+        twiml_response.say(wsgi_app.VOICE_MISSING_PARAMS_MESSAGE, language='es-MX', voice='Polly.Mia-Neural')
+        twiml_response.hangup()
+        return _twiml(twiml_response)
+
+    session_id = call_sid
+    user_id = from_number
+    logger.info(f"Llamada (SID: {session_id}) de {user_id}. Transcripción: '{user_speech}'")
+
+    try:
+        await ensure_agent_session_exists(user_id, session_id)
+    except httpx.HTTPError as e:
+        logger.error(f"Error crítico al crear/verificar la sesión de voz '{session_id}': {e}")
+        twiml_response = VoiceResponse()
+        twiml_response.say(wsgi_app.VOICE_SESSION_ERROR_MESSAGE, language='es-MX', voice='Polly.Mia-Neural')
+        twiml_response.hangup()
+        return _twiml(twiml_response)
+
+    should_hangup = False
+    async with session_turn_locks.hold(session_id):
+        try:
+            agent_api_response = await post_agent_run(user_id, session_id, _agent_payload(user_id, session_id, user_speech))
+            agent_api_response.raise_for_status()
+            agent_messages = wsgi_app.extract_agent_messages(agent_api_response.json())
+            if agent_messages:
+                agent_text_response = "".join(agent_messages).strip()
+            else:
+                logger.warning(f"El agente respondió sin contenido de texto para la llamada {session_id}.")
+                agent_text_response = wsgi_app.VOICE_NO_TEXT_MESSAGE
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            agent_text_response, should_hangup = voice_agent_error_message(e, session_id)
+
+    if not agent_text_response:
+        agent_text_response = wsgi_app.VOICE_FALLBACK_MESSAGE
+
+    logger.info(f"Respuesta del agente para la llamada {session_id}: '{agent_text_response}'")
+    return _twiml(wsgi_app.build_voice_twiml(agent_text_response, should_hangup))
+
+@app.get("/stats")
+async def runtime_stats():
+    """Devuelve las estadísticas de ejecución del worker que atiende la petición."""
+    return JSONResponse(wsgi_app.stats.snapshot())
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Métricas en formato de Prometheus, igual que `/metrics` de la aplicación Flask."""
+    return Response(generate_latest(wsgi_app.metrics_registry()), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/health/agent")
+async def agent_health():
+    """Estado del cortocircuito hacia el agente; 503 mientras está abierto."""
+    circuit = wsgi_app.agent_circuit.describe()
+    return JSONResponse(circuit, status_code=503 if circuit["state"] == "open" else 200)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,127 @@
+"""
+Benchmark comparativo: app Flask (gunicorn gthread) contra la variante ASGI
+(gunicorn + UvicornWorker) de twilio-api.
+
+Levanta localmente un agente falso con latencia fija, ambas aplicaciones
+apuntando a él y envía webhooks de voz concurrentes a cada una. Reporta
+rendimiento (turnos/s) y latencias p50/p95/p99. No contacta a Twilio ni al
+agente real: las credenciales son ficticias y la entrega de SMS queda en TwiML.
+
+Uso:
+    python benchmark_asgi.py --requests 400 --concurrency 200 --agent-latency 2
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI, Request
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Agente falso: responde a la creación de sesión y a /run tras una latencia fija ---
+fake_agent = FastAPI()
+
+@fake_agent.post("/apps/{app_name}/users/{user_id}/sessions/{session_id}")
+async def fake_create_session(app_name: str, user_id: str, session_id: str):
+    return {"id": session_id}
+
+@fake_agent.post("/run")
+async def fake_run(request: Request):
+    await asyncio.sleep(float(os.environ.get("FAKE_AGENT_LATENCY", 2)))
+    return [{"content": {"parts": [{"text": "Hola, soy Sofía. ¿En qué puedo ayudarle?"}]}}]
+
+def _start(cmd: list, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(cmd, cwd=SERVICE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def _wait_ready(url: str, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"El servicio en {url} no respondió a tiempo.")
+
+def _percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def _drive(base_url: str, total: int, concurrency: int) -> dict:
+    """Envía `total` webhooks de voz con `concurrency` en vuelo y mide cada uno."""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    response = await client.post(f"{base_url}/voice", data={"CallSid": f"CA{i:032d}", "From": f"+1555{i:07d}", "SpeechResult": "hola"})
+                    if response.status_code != 200 or "<Gather" not in response.text:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.monotonic() - started
+
+    return {
+        "throughput": total / elapsed,
+        "p50": _percentile(latencies, 50),
+        "p95": _percentile(latencies, 95),
+        "p99": _percentile(latencies, 99),
+        "errors": errors,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400, help="Webhooks de voz a enviar a cada aplicación.")
+    parser.add_argument("--concurrency", type=int, default=200, help="Webhooks simultáneos en vuelo.")
+    parser.add_argument("--agent-latency", type=float, default=2.0, help="Latencia simulada del agente por turno (s).")
+    parser.add_argument("--workers", type=int, default=1, help="Workers de gunicorn para cada aplicación.")
+    parser.add_argument("--threads", type=int, default=8, help="Hilos por worker de la app Flask.")
+    args = parser.parse_args()
+
+    env = {
+        **os.environ,
+        "FAKE_AGENT_LATENCY": str(args.agent_latency),
+        "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "benchmark",
+        "TWILIO_PHONE_NUMBER": "+15550000000",
+        "AGENT_API_URL": "http://127.0.0.1:18900",
+        "WEBHOOK_DEDUPE_STORE": "off",
+        "THREADS": str(args.threads),
+        "ASGI_AGENT_MAX_CONNECTIONS": str(max(args.concurrency, 10)),
+    }
+    gunicorn = [sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--timeout", "120"]
+    processes = [
+        _start([sys.executable, "-m", "uvicorn", "benchmark_asgi:fake_agent", "--port", "18900", "--log-level", "warning"], env),
+        _start(gunicorn + ["--threads", str(args.threads), "--bind", "127.0.0.1:18901", "app:app"], env),
+        _start(gunicorn + ["-k", "uvicorn.workers.UvicornWorker", "--bind", "127.0.0.1:18902", "asgi_app:app"], env),
+    ]
+    try:
+        for port in (18900, 18901, 18902):
+            await _wait_ready(f"http://127.0.0.1:{port}/")
+
+        print(f"{args.requests} webhooks, {args.concurrency} concurrentes, latencia del agente {args.agent_latency}s, {args.workers} worker(s)")
+        print(f"{'app':<28}{'turnos/s':>10}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'errores':>9}")
+        for label, port in ((f"Flask gthread ({args.threads} hilos)", 18901), ("ASGI (uvicorn)", 18902)):
+            result = await _drive(f"http://127.0.0.1:{port}", args.requests, args.concurrency)
+            print(f"{label:<28}{result['throughput']:>10.1f}{result['p50']:>10.2f}{result['p95']:>10.2f}{result['p99']:>10.2f}{result['errors']:>9}")
+    finally:
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    asyncio.run(main())
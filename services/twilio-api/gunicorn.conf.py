@@ -0,0 +1,19 @@
+# Configuración de gunicorn que se carga automáticamente desde el directorio de
+# trabajo (./gunicorn.conf.py). Los parámetros de ejecución siguen en el CMD del
+# Dockerfile; aquí solo se definen los hooks para las métricas multiproceso.
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+def on_starting(server):
+    """Limpia las muestras de una ejecución anterior antes de lanzar los workers."""
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    """Marca como terminado al worker para que sus gauges en vivo dejen de reportarse."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,24 +1,78 @@
-import requests
+"""
+Pruebas del agente Sofía: chat interactivo y generador de carga.
+
+Modos:
+    chat   Conversación interactiva de una sola sesión contra `/run` del agente
+           (el comportamiento original de este script).
+    carga  Ejecuta N conversaciones sintéticas concurrentes a partir de guiones
+           o transcripciones grabadas, contra `/run` del agente o contra los
+           webhooks de twilio-api (`/sms/receive`, `/voice`) con payloads de
+           Twilio codificados como formulario. Reporta latencia por turno
+           (p50/p95/p99), tasa de errores y rendimiento.
+
+Con `--stub` todo corre en local: se levanta un agente falso con la latencia
+indicada y, para los objetivos de twilio-api, la propia twilio-api (gunicorn)
+apuntando a él con credenciales ficticias y entrega de SMS en el TwiML.
+
+Ejemplos:
+    python pruebas-agente-api.py chat
+    python pruebas-agente-api.py carga --stub --target voice --conversations 50 --concurrency 20
+    python pruebas-agente-api.py carga --target agent --base-url https://... --script conversaciones.json
+
+Formato de `--script`: JSON con una lista de conversaciones, donde cada
+conversación es una lista de mensajes del usuario (o un objeto con la clave
+"turns"); también se acepta JSONL con una conversación por línea.
+"""
+import argparse
 import json
-import time
+import os
 import random
-import uuid
+import re
+import subprocess
 import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
 
 # --- CONFIGURACIÓN ---
-BASE_URL = "https://agent-sofia-service-604477693185.us-central1.run.app"
+BASE_URL = os.environ.get("AGENT_API_URL", "https://agent-sofia-service-604477693185.us-central1.run.app")
 APP_NAME = "sofia_agent"
 USER_ID = "Test Api"
-CHAT_API_URL = f"{BASE_URL}/run"
 
-def test_agent_chat(session_id, message=""):
-    """
-    Envía un mensaje al endpoint del agente y muestra solo la respuesta de texto.
-    """
-    # Estructura del payload que espera el nuevo agente
-    payload = {
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Guion por defecto: el flujo habitual de identificación y consulta.
+DEFAULT_SCRIPT = [
+    ["Hola", "Me llamo Ana Pérez", "Mi fecha de nacimiento es el 2 de enero de 1980", "Quiero saber el estado de mi declaración de impuestos", "Gracias, eso es todo"],
+    ["Buenas tardes", "Soy Carlos y llamo por mi mamá, María López", "Soy su hijo", "Nació el 15 de marzo de 1955", "Necesitamos una cita para este año"],
+    ["Hola, soy cliente nuevo", "Mi nombre es Luis Gómez", "Quiero ayuda con mis taxes de 2024"],
+]
+
+# Textos que indican que twilio-api respondió con un mensaje de disculpa en lugar
+# de una respuesta del agente (ver los mensajes al usuario en app.py).
+FALLBACK_MARKERS = ("Lo siento", "Hemos encontrado un error", "Nuestro sistema está tardando", "No es posible conectarnos", "Se ha producido un error")
+
+def extract_agent_messages(response_data) -> list:
+    """Extrae las partes de texto de la respuesta de `/run`, ignorando las llamadas a funciones."""
+    agent_messages = []
+    if isinstance(response_data, list):
+        for turn in response_data:
+            if 'content' in turn and 'parts' in turn['content']:
+                for part in turn['content']['parts']:
+                    # Verificamos que el texto no esté vacío, pero lo guardamos completo para respetar los '\n'
+                    if 'text' in part and part.get('text'):
+                        agent_messages.append(part['text'])
+    return agent_messages
+
+def build_payload(user_id: str, session_id: str, message: str) -> dict:
+    # Estructura del payload que espera el agente
+    return {
         "app_name": APP_NAME,
-        "user_id": USER_ID,
+        "user_id": user_id,
         "session_id": session_id, # ID de sesión para mantener el contexto
         "new_message": {
             "role": "user",
@@ -28,23 +82,17 @@ def test_agent_chat(session_id, message=""):
         }
     }
 
+# --- Modo interactivo ---
+def test_agent_chat(base_url, session_id, message=""):
+    """
+    Envía un mensaje al endpoint del agente y muestra solo la respuesta de texto.
+    """
     try:
         # Hacemos la petición POST al agente con un timeout de 15 segundos
-        response = requests.post(CHAT_API_URL, json=payload, timeout=15)
+        response = requests.post(f"{base_url}/run", json=build_payload(USER_ID, session_id, message), timeout=15)
         response.raise_for_status()  # Lanza una excepción para respuestas de error (4xx o 5xx)
 
-        response_data = response.json()
-        
-        # Extraemos solo las partes de texto de la respuesta, ignorando las llamadas a funciones.
-        agent_messages = []
-        if isinstance(response_data, list):
-            for turn in response_data:
-                if 'content' in turn and 'parts' in turn['content']:
-                    for part in turn['content']['parts']:
-                        # Verificamos que el texto no esté vacío, pero lo guardamos completo para respetar los '\n'
-                        if 'text' in part and part.get('text'):
-                            agent_messages.append(part['text'])
-        
+        agent_messages = extract_agent_messages(response.json())
         if agent_messages:
             # Simulamos que el agente está "escribiendo" para una experiencia más natural.
             print("Sofía está escribiendo...", end="\r", flush=True)
@@ -65,25 +113,28 @@ def test_agent_chat(session_id, message=""):
         print("Error: La respuesta del agente no tiene el formato esperado.")
         print(f"Respuesta recibida: {response.text}")
 
-def delete_session(session_id):
+def delete_session(base_url, user_id, session_id, quiet=False):
     """
     Envía una petición DELETE para eliminar la sesión del agente.
     """
-    delete_session_url = f"{BASE_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
+    delete_session_url = f"{base_url}/apps/{APP_NAME}/users/{user_id}/sessions/{session_id}"
     try:
-        print(f"\nEliminando sesión: {session_id}...")
+        if not quiet:
+            print(f"\nEliminando sesión: {session_id}...")
         response = requests.delete(delete_session_url, timeout=10)
         response.raise_for_status()
-        print("¡Sesión eliminada exitosamente!")
+        if not quiet:
+            print("¡Sesión eliminada exitosamente!")
     except requests.exceptions.RequestException as e:
-        print(f"Advertencia: No se pudo eliminar la sesión. {e}")
+        if not quiet:
+            print(f"Advertencia: No se pudo eliminar la sesión. {e}")
 
-if __name__ == "__main__":
+def run_chat(args):
     # 1. Generar un ID de sesión dinámico para la nueva conversación.
     session_id = str(uuid.uuid4())
 
     # 2. Construir la URL para crear la sesión en el servidor del agente.
-    create_session_url = f"{BASE_URL}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
+    create_session_url = f"{args.base_url}/apps/{APP_NAME}/users/{USER_ID}/sessions/{session_id}"
 
     # 3. Realizar la llamada POST para crear la sesión.
     try:
@@ -103,10 +154,326 @@ if __name__ == "__main__":
             user_message = input("\nTú: ")
             if user_message.lower() in ['salir', 'exit']:
                 break
-            test_agent_chat(session_id=session_id, message=user_message)
+            test_agent_chat(args.base_url, session_id=session_id, message=user_message)
     except KeyboardInterrupt:
         # El bloque finally se encargará de la limpieza.
         pass
     finally:
         print("\nTerminando chat.")
-        delete_session(session_id)
+        delete_session(args.base_url, USER_ID, session_id)
+
+# --- Agente falso para pruebas locales ---
+class StubAgentHandler(BaseHTTPRequestHandler):
+    """
+    Imita los endpoints del agente que usa twilio-api: creación/eliminación de
+    sesión, `/run` y `/run_sse` (eventos parciales por oración y evento final
+    agregado). Cada turno tarda `latency` ± `jitter` segundos.
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 1.0
+    jitter = 0.0
+    reply = "Gracias por comunicarse con nosotros. Con gusto le ayudo.\n¿Me podría dar su nombre completo, por favor?"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _turn_delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def do_DELETE(self):
+        self._send(200, b"{}")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/run":
+            time.sleep(self._turn_delay())
+            self._send(200, json.dumps([{"content": {"role": "model", "parts": [{"text": self.reply}]}}]).encode())
+        elif self.path == "/run_sse":
+            self._stream_reply()
+        elif "/sessions/" in self.path:
+            self._send(200, json.dumps({"id": self.path.rsplit("/", 1)[-1], "state": {}}).encode())
+        else:
+            self._send(404, b'{"detail": "Not Found"}')
+
+    def _stream_reply(self):
+        sentences = [s for s in re.split(r'(?<=[.!?\n])\s*', self.reply) if s]
+        delay = self._turn_delay() / max(1, len(sentences))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [{"partial": True, "content": {"parts": [{"text": s + " "}]}} for s in sentences]
+        events.append({"content": {"parts": [{"text": self.reply}]}})
+        for i, event in enumerate(events):
+            if i < len(sentences):
+                time.sleep(delay)
+            chunk = f"data: {json.dumps(event)}\n\n".encode()
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+def start_stub_agent(port: int, latency: float, jitter: float) -> ThreadingHTTPServer:
+    handler = type("ConfiguredStubAgent", (StubAgentHandler,), {"latency": latency, "jitter": jitter})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_local_twilio_api(port: int, agent_url: str, args) -> subprocess.Popen:
+    """Levanta twilio-api con gunicorn apuntando al agente falso, sin tocar Twilio."""
+    env = {
+        **os.environ,
+        "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "carga",
+        "TWILIO_PHONE_NUMBER": "+15550000000",
+        "AGENT_API_URL": agent_url,
+        "SMS_DELIVERY_MODE": "inline",
+        "WEBHOOK_DEDUPE_STORE": "memory",
+        "VOICE_TURN_STORE": "memory" if args.workers == 1 else "file",
+    }
+    cmd = [
+        sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers), "--threads", str(args.threads), "--timeout", "120", "app:app",
+    ]
+    process = subprocess.Popen(cmd, cwd=SERVICE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("twilio-api no arrancó a tiempo.")
+
+# --- Generador de carga ---
+def load_conversations(path: str) -> list:
+    """Lee guiones o transcripciones grabadas (JSON o JSONL) como listas de mensajes."""
+    if not path:
+        return DEFAULT_SCRIPT
+    with open(path, encoding="utf-8") as f:
+        content = f.read().strip()
+    if content.startswith("["):
+        items = json.loads(content)
+    else:
+        items = [json.loads(line) for line in content.splitlines() if line.strip()]
+    conversations = [item["turns"] if isinstance(item, dict) else item for item in items]
+    return [[str(turn) for turn in conversation] for conversation in conversations if conversation]
+
+class LoadResults:
+    """Acumula latencias y errores por turno de forma segura entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.latencies_by_turn = {}
+        self.errors = {}
+        self.fallbacks = 0
+        self.conversations = 0
+
+    def record(self, turn_index: int, seconds: float, error: str = None, fallback: bool = False):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.latencies_by_turn.setdefault(turn_index, []).append(seconds)
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            if fallback:
+                self.fallbacks += 1
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def _classify_error(error: Exception) -> str:
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "conexion"
+    if isinstance(error, requests.exceptions.HTTPError):
+        return f"http_{error.response.status_code}"
+    return type(error).__name__
+
+def _is_fallback(text: str) -> bool:
+    return any(marker in text for marker in FALLBACK_MARKERS)
+
+def run_agent_conversation(http: requests.Session, base_url: str, index: int, turns: list, results: LoadResults, think_time: float):
+    """Conversación directa contra `/run` del agente, con su propia sesión."""
+    user_id = f"carga-{index}"
+    session_id = str(uuid.uuid4())
+    try:
+        http.post(f"{base_url}/apps/{APP_NAME}/users/{user_id}/sessions/{session_id}", timeout=15).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        results.record(0, 0.0, error=f"sesion_{_classify_error(e)}")
+        return
+
+    for turn_index, message in enumerate(turns, start=1):
+        started_at = time.monotonic()
+        error = None
+        try:
+            response = http.post(f"{base_url}/run", json=build_payload(user_id, session_id, message), timeout=60)
+            response.raise_for_status()
+            if not extract_agent_messages(response.json()):
+                error = "sin_texto"
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = _classify_error(e)
+        results.record(turn_index, time.monotonic() - started_at, error=error)
+        time.sleep(think_time)
+    delete_session(base_url, user_id, session_id, quiet=True)
+
+def run_sms_conversation(http: requests.Session, base_url: str, index: int, turns: list, results: LoadResults, think_time: float):
+    """Conversación por SMS contra el webhook `/sms/receive` de twilio-api."""
+    from_number = f"+1555{index:07d}"
+    for turn_index, message in enumerate(turns, start=1):
+        form = {
+            "MessageSid": f"SM{uuid.uuid4().hex}",
+            "AccountSid": "AC" + "0" * 32,
+            "From": from_number,
+            "To": "+15550000000",
+            "Body": message,
+            "NumMedia": "0",
+        }
+        started_at = time.monotonic()
+        error = None
+        fallback = False
+        try:
+            response = http.post(f"{base_url}/sms/receive", data=form, timeout=60)
+            response.raise_for_status()
+            fallback = _is_fallback(response.text)
+        except requests.exceptions.RequestException as e:
+            error = _classify_error(e)
+        results.record(turn_index, time.monotonic() - started_at, error=error, fallback=fallback)
+        time.sleep(think_time)
+
+def run_voice_conversation(http: requests.Session, base_url: str, index: int, turns: list, results: LoadResults, think_time: float):
+    """
+    Llamada contra el webhook `/voice` de twilio-api. El primer turno va sin
+    `SpeechResult`, como el webhook inicial de Twilio. Se siguen los Redirect a
+    `/voice/poll` o `/voice/continue` (modos "hold" y "stream") hasta obtener el
+    Gather o el Hangup, de modo que la latencia medida es la del turno completo.
+    """
+    call_sid = f"CA{uuid.uuid4().hex}"
+    from_number = f"+1555{index:07d}"
+    for turn_index, speech in enumerate([""] + turns, start=1):
+        form = {"CallSid": call_sid, "AccountSid": "AC" + "0" * 32, "From": from_number, "To": "+15550000000", "CallStatus": "in-progress"}
+        if speech:
+            form["SpeechResult"] = speech
+            form["Confidence"] = "0.92"
+        started_at = time.monotonic()
+        error = None
+        fallback = False
+        hung_up = False
+        try:
+            response = http.post(f"{base_url}/voice", data=form, timeout=60)
+            response.raise_for_status()
+            spoken = response.text
+            for _ in range(20):
+                redirect = re.search(r"<Redirect[^>]*>([^<]+)</Redirect>", response.text)
+                if "<Gather" in response.text or "<Hangup" in response.text or not redirect:
+                    break
+                response = http.post(f"{base_url}{redirect.group(1).replace('&amp;', '&')}", data=form, timeout=60)
+                response.raise_for_status()
+                spoken += response.text
+            fallback = _is_fallback(spoken)
+            hung_up = "<Hangup" in response.text
+        except requests.exceptions.RequestException as e:
+            error = _classify_error(e)
+        results.record(turn_index, time.monotonic() - started_at, error=error, fallback=fallback)
+        if error or hung_up:
+            break
+        time.sleep(think_time)
+
+CONVERSATION_RUNNERS = {
+    "agent": run_agent_conversation,
+    "sms": run_sms_conversation,
+    "voice": run_voice_conversation,
+}
+
+def print_report(results: LoadResults, elapsed: float, args):
+    turns = len(results.latencies)
+    errors = sum(results.errors.values())
+    print(f"\nObjetivo: {args.target} en {args.base_url}")
+    print(f"Conversaciones: {results.conversations}  Concurrencia: {args.concurrency}  Duración: {elapsed:.1f}s")
+    print(f"Turnos: {turns}  Rendimiento: {turns / elapsed if elapsed else 0:.2f} turnos/s")
+    print(f"Errores: {errors} ({errors / turns * 100 if turns else 0:.1f}%) {results.errors or ''}")
+    if args.target != "agent":
+        print(f"Respuestas de disculpa: {results.fallbacks} ({results.fallbacks / turns * 100 if turns else 0:.1f}%)")
+    print(f"\n{'turno':<8}{'n':>6}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}{'máx (s)':>10}")
+    rows = [(str(i), results.latencies_by_turn[i]) for i in sorted(results.latencies_by_turn)] + [("todos", results.latencies)]
+    for label, values in rows:
+        print(f"{label:<8}{len(values):>6}{percentile(values, 50):>10.3f}{percentile(values, 95):>10.3f}{percentile(values, 99):>10.3f}{max(values, default=0):>10.3f}")
+
+def run_load(args):
+    conversations = load_conversations(args.script)
+    stub_server = None
+    twilio_api = None
+    if args.stub:
+        stub_server = start_stub_agent(args.stub_port, args.stub_latency, args.stub_jitter)
+        agent_url = f"http://127.0.0.1:{args.stub_port}"
+        if args.target == "agent":
+            args.base_url = agent_url
+        else:
+            twilio_api = start_local_twilio_api(args.stub_port + 1, agent_url, args)
+            args.base_url = f"http://127.0.0.1:{args.stub_port + 1}"
+
+    runner = CONVERSATION_RUNNERS[args.target]
+    results = LoadResults()
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+
+    def one(index: int):
+        runner(http, args.base_url, index, conversations[index % len(conversations)], results, args.think_time)
+        with results._lock:
+            results.conversations += 1
+
+    print(f"Ejecutando {args.conversations} conversaciones ({args.target}) con concurrencia {args.concurrency}...")
+    started_at = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(one, range(args.conversations)))
+    finally:
+        elapsed = time.monotonic() - started_at
+        if twilio_api is not None:
+            twilio_api.terminate()
+        if stub_server is not None:
+            stub_server.shutdown()
+    print_report(results, elapsed, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode")
+
+    chat_parser = subparsers.add_parser("chat", help="Chat interactivo de una sesión contra el agente.")
+    chat_parser.add_argument("--base-url", default=BASE_URL, help="URL del agente (por defecto AGENT_API_URL o Cloud Run).")
+
+    load_parser = subparsers.add_parser("carga", help="Conversaciones concurrentes con métricas de latencia.")
+    load_parser.add_argument("--target", choices=sorted(CONVERSATION_RUNNERS), default="agent", help="`agent` (/run directo), `sms` o `voice` (webhooks de twilio-api).")
+    load_parser.add_argument("--base-url", default=BASE_URL, help="URL del agente o de twilio-api según --target.")
+    load_parser.add_argument("--conversations", type=int, default=20, help="Conversaciones a ejecutar.")
+    load_parser.add_argument("--concurrency", type=int, default=10, help="Conversaciones simultáneas.")
+    load_parser.add_argument("--script", help="Guiones o transcripciones (JSON/JSONL). Por defecto, un guion incluido.")
+    load_parser.add_argument("--think-time", type=float, default=0.0, help="Pausa entre turnos de una conversación (s).")
+    load_parser.add_argument("--stub", action="store_true", help="Ejecuta todo en local contra un agente falso.")
+    load_parser.add_argument("--stub-port", type=int, default=18700, help="Puerto del agente falso (twilio-api usa el siguiente).")
+    load_parser.add_argument("--stub-latency", type=float, default=1.0, help="Latencia del agente falso por turno (s).")
+    load_parser.add_argument("--stub-jitter", type=float, default=0.2, help="Variación aleatoria de la latencia (± s).")
+    load_parser.add_argument("--workers", type=int, default=1, help="Workers de gunicorn para la twilio-api local.")
+    load_parser.add_argument("--threads", type=int, default=8, help="Hilos por worker de la twilio-api local.")
+
+    args = parser.parse_args()
+    if args.mode == "carga":
+        run_load(args)
+    else:
+        if args.mode is None:
+            args.base_url = BASE_URL
+        run_chat(args)